@@ -1,31 +1,53 @@
-import firebase_admin
-from firebase_admin import credentials, db
 import time
-import subprocess
+BOOT_STARTED = time.perf_counter() # start-up timing includes the imports below
 import datetime
 import os
 import sys
 import json
-import re
-import smtplib
 import uuid
 import platform
 import socket
 import traceback
-import urllib.request
-import zipfile
+import threading
 import shutil
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
+import copy
+from concurrent.futures import ThreadPoolExecutor
+from control_channel import ControlChannel, FirebaseBackend
+from job_runner import JobScheduler, JobCancelled, CancelToken
+from file_index import FileIndex, DEFAULT_FULL_SYNC_DAYS, scan_tree
+from snapshots import SnapshotCatalog
+from write_queue import WriteBehindQueue
+from scheduler import Timetable
+from retention import plan_retention, purge_folders, list_job_root, retention_enabled, DEFAULT_PURGE_WORKERS
+from rclone_progress import (StatePublisher, StatsEvent, FileErrorEvent, RetryEvent, progress_fields, format_duration,
+                             merge_stats)
+from rclone_backend import SubprocessBackend, RcloneError, create_backend
+from transfer_tuning import TransferTuner, schedule_for, tightest_limit, parse_size
+from metrics import Metrics, MetricsFile, MetricsServer, PhaseClock, TimedBackend
+from notifier import Notifier
+from startup_cache import StartupCache, file_key
+from run_journal import RunJournal, interrupted_runs, DEFAULT_RESUME_MAX_AGE
+from log_rollup import plan_rollup, merge_aggregates, DEFAULT_KEEP, DEFAULT_ROLLUP_INTERVAL
+from resource_governor import Governor
+from storage_ledger import StorageLedger, DEFAULT_RECONCILE_DAYS
 
 # --- CONFIGURATION ---
 RCLONE_REMOTE = "gdrive"
 RCLONE_VERSION = "v1.65.0"
 RCLONE_URL = f"https://downloads.rclone.org/{RCLONE_VERSION}/rclone-{RCLONE_VERSION}-windows-amd64.zip"
+HEARTBEAT_INTERVAL = 30 # seconds; the Fleet View marks a system offline after 120s
+LOOP_TICK = 5 # seconds; upper bound on how long the loop sleeps between control checks
+STATS_INTERVAL = 300 # seconds between agent-wide stats writes (global_config `stats_interval`)
+RCLONE_MODE = "rcd" # "rcd": one long-lived rclone daemon; "subprocess": one rclone process per operation
+CHECKPOINT_FILES = 2000 # large uploads are committed to the file index in batches of this many files...
+CHECKPOINT_BYTES = 1024 ** 3 # ...or this many bytes, whichever comes first
 
 # --- GLOBAL STATE ---
 AGENT_ID = None
 RCLONE_BIN = "rclone" # Default to PATH, updated by ensure_rclone
+RCLONE = SubprocessBackend(RCLONE_BIN) # Replaced by start_rclone once the binary is known
+BWLIMIT = None # Limit last applied to the rclone daemon
+RCLONE_INSTALLED_VERSION = None # Reported in the meta node
 
 # 2. Identity Persistence (Crucial for preventing Ghost Agents)
 # store in %APPDATA%/KriplaniBackup on Windows, or ~/.kriplanibackup on others
@@ -41,30 +63,80 @@ if not os.path.exists(config_dir):
         config_dir = os.getcwd() # Fallback
 
 IDENTITY_FILE = os.path.join(config_dir, "agent_identity.json")
+FILE_INDEX = FileIndex(os.path.join(config_dir, "file_index.db"))
+HASH_MANIFEST_DB = os.path.join(config_dir, "hash_manifest.db")
+HASH_MANIFEST = None # integrity.HashManifest, opened by the first verification
+MANIFEST_DIR = os.path.join(config_dir, "manifests")
+RESTORE_DIR = os.path.join(config_dir, "restores")
+RUNS_DIR = os.path.join(config_dir, "runs")
+CHUNK_CACHE_DB = os.path.join(config_dir, "chunk_cache.db")
+PACK_CACHE_DB = os.path.join(config_dir, "pack_cache.db")
+# chunk_store.CHUNKS_DIR / pack_store.PACKS_DIR; the engines themselves are only imported by jobs that use them.
+CHUNKS_DIR, PACKS_DIR = "Chunks", "Packs"
+STORE_DIRS = {'chunked': CHUNKS_DIR, 'packed': PACKS_DIR} # engines that keep their data outside Current_Mirror
+LEDGER = StorageLedger(os.path.join(config_dir, "storage_ledger.json"), STORE_DIRS.values())
+WRITE_JOURNAL = os.path.join(config_dir, "write_journal.jsonl")
+SCHEDULE_STATE_FILE = os.path.join(config_dir, "schedule_state.json")
+TUNER = TransferTuner(os.path.join(config_dir, "transfer_tuning.json"))
+METRICS = Metrics()
+METRICS_FILE = MetricsFile(os.path.join(config_dir, "metrics"))
+NOTIFIER = Notifier(METRICS)
+STARTUP_CACHE = StartupCache(os.path.join(config_dir, "startup_cache.json"))
+CONTINUOUS = None # watcher.ContinuousProtection, started once a job turns continuous mode on
+GOVERNOR = Governor(report=lambda job_id, record: WRITES.reference(
+    f'runtime_state/{AGENT_ID}/job_states/{job_id}/governor').set(record))
 
 # --- RESOURCE HANDLING ---
-def get_resource_path(relative_path): 
+def get_resource_path(relative_path):
+    """ Get absolute path to resource, works for dev and for PyInstaller """
+    try:
+        base_path = sys._MEIPASS
+    except Exception:
+        base_path = os.path.abspath(os.path.dirname(__file__))
+    return os.path.join(base_path, relative_path)
+
+KEY_PATH = get_resource_path("serviceAccountKey.json")
 
 # --- DEPENDENCY MANAGEMENT ---
 def ensure_rclone():
     """ 
-    Checks if rclone is available. 
-    1. Checks local folder (highest priority).
+    Checks if rclone is available (see locate_rclone). The resolved path is
+    cached and reused while the bundled/local candidates and PATH are unchanged.
+    """
+    global RCLONE_BIN
+
+    bundled_bin = get_resource_path("rclone.exe")
+    local_bin = os.path.join(os.getcwd(), "rclone.exe" if platform.system() == "Windows" else "rclone")
+    def candidates_key():
+        return [file_key(bundled_bin), file_key(local_bin), os.environ.get("PATH", "")]
+
+    cached = STARTUP_CACHE.get("rclone_path", candidates_key())
+    if cached and file_key(cached):
+        print(f"✅ Using rclone: {cached} (cached)")
+        RCLONE_BIN = cached
+        return
+
+    locate_rclone(bundled_bin, local_bin)
+    resolved = shutil.which(RCLONE_BIN) or RCLONE_BIN
+    if file_key(resolved):
+        STARTUP_CACHE.put("rclone_path", candidates_key(), os.path.abspath(resolved))
+
+def locate_rclone(bundled_bin, local_bin):
+    """ 
+    1. Checks the bundled binary, then the local folder.
     2. Checks system PATH.
     3. Downloads if missing (Windows only logic mostly, but safe to have).
     """
     global RCLONE_BIN
-    
+
     # 1. Check Bundled Resource (PyInstaller _MEIPASS)
     # When running as onefile, rclone.exe will be extracted to sys._MEIPASS
-    bundled_bin = get_resource_path("rclone.exe")
     if os.path.exists(bundled_bin):
         print(f"✅ Found bundled Rclone: {bundled_bin}")
         RCLONE_BIN = bundled_bin
         return
 
     # 2. Check Local (Updates/Dev)
-    local_bin = os.path.join(os.getcwd(), "rclone.exe" if platform.system() == "Windows" else "rclone")
     if os.path.exists(local_bin):
         print(f"✅ Found local rclone: {local_bin}")
         RCLONE_BIN = local_bin
@@ -80,6 +152,9 @@ def ensure_rclone():
     if platform.system() == "Windows":
         print(f"⬇️ Rclone not found. Downloading {RCLONE_VERSION}...")
         try:
+            import urllib.request
+            import zipfile
+
             zip_path = "rclone.zip"
             urllib.request.urlretrieve(RCLONE_URL, zip_path)
             
@@ -106,20 +181,34 @@ def ensure_rclone():
 
 
 # --- FIREBASE INIT ---
-try:
-    if not os.path.exists(KEY_PATH):
-        print(f"❌ CRITICAL: serviceAccountKey.json not found at {KEY_PATH}")
+# Every database access goes through DATABASE (get / set / update / delete / listen), so the agent
+# can also run against control_channel.FakeRealtimeDatabase (see benchmark.py).
+DATABASE = None
+
+def init_firebase():
+    global DATABASE
+    try:
+        import firebase_admin
+        from firebase_admin import credentials
+
+        if not os.path.exists(KEY_PATH):
+            print(f"❌ CRITICAL: serviceAccountKey.json not found at {KEY_PATH}")
+            sys.exit(1)
+
+        cred = credentials.Certificate(KEY_PATH)
+        # NOTE: You must update the databaseURL to your specific project's URL if not already set correctly.
+        firebase_admin.initialize_app(cred, {
+            'databaseURL': 'https://kriplani-builders-default-rtdb.asia-southeast1.firebasedatabase.app' 
+        })
+        DATABASE = TimedBackend(FirebaseBackend(), METRICS)
+        print("✅ Connected to Firebase Command Center")
+    except Exception as e:
+        print(f"❌ Failed to connect to Firebase: {e}")
         sys.exit(1)
 
-    cred = credentials.Certificate(KEY_PATH)
-    # NOTE: You must update the databaseURL to your specific project's URL if not already set correctly.
-    firebase_admin.initialize_app(cred, {
-        'databaseURL': 'https://kriplani-builders-default-rtdb.asia-southeast1.firebasedatabase.app' 
-    })
-    print("✅ Connected to Firebase Command Center")
-except Exception as e:
-    print(f"❌ Failed to connect to Firebase: {e}")
-    sys.exit(1)
+# All state / log / heartbeat writes go through this queue (one multi-path update per flush).
+WRITES = WriteBehindQueue(lambda batch: DATABASE.update('/', batch), WRITE_JOURNAL,
+                          on_rejected=lambda path, reason: METRICS.inc("writes_rejected_total"))
 
 
 # --- IDENTITY MANAGEMENT ---
@@ -183,23 +272,27 @@ def register_agent():
     """Updates the systems/{uuid}/meta node with host info."""
     
     # Improve IP detection
+    hostname = socket.gethostname()
     try:
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         # doesn't even have to be reachable
         s.connect(('8.8.8.8', 1))
         ip_address = s.getsockname()[0]
         s.close()
+        STARTUP_CACHE.put("ip_address", hostname, ip_address)
     except Exception:
-        ip_address = socket.gethostbyname(socket.gethostname())
+        # Offline at boot: the last known address avoids a slow name lookup
+        ip_address = STARTUP_CACHE.get("ip_address", hostname) or socket.gethostbyname(hostname)
 
     meta = {
-        "hostname": socket.gethostname(),
+        "hostname": hostname,
         "os": f"{platform.system()} {platform.release()}",
         "version": "2.2.0 (Stable Identity)",
         "ip": ip_address,
+        "rclone_version": RCLONE_INSTALLED_VERSION,
         "last_boot": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     }
-    db.reference(f'systems/{AGENT_ID}/meta').update(meta)
+    WRITES.reference(f'systems/{AGENT_ID}/meta').update(meta)
     print("📡 Registered System Metadata")
 
 # --- HELPER FUNCTIONS ---
@@ -215,111 +308,85 @@ def parse_rclone_size(bytes_int):
 
 def send_email_alert(job_name, status, details_html, recipients_str, smtp_settings):
     """
-    Sends email using provided SMTP settings. 
-    smtp_settings should be a dict: {server, port, email, password}
-    """
-    if not recipients_str or not smtp_settings or "xxxx" in smtp_settings.get('password', ''):
-        return
-
-    recipients = [email.strip() for email in recipients_str.split(',') if email.strip()]
-    if not recipients: return
-
-    sender_email = smtp_settings.get('email')
-    sender_password = smtp_settings.get('password')
-    smtp_server = smtp_settings.get('server', 'smtp.gmail.com')
-    smtp_port = int(smtp_settings.get('port', 587))
-
-    msg = MIMEMultipart()
-    msg['From'] = f"Backup Agent <{sender_email}>"
-    msg['To'] = ", ".join(recipients)
-    msg['Subject'] = f"[{status}] {job_name} - {socket.gethostname()}"
-
-    color = "#10B981" if status == "SUCCESS" else "#EF4444"
-    body = f"""
-    <html><body style="font-family: sans-serif; color: #333;">
-        <div style="border: 1px solid #ddd; border-radius: 8px; overflow: hidden; max-width: 600px;">
-          <div style="background-color: {color}; padding: 15px; color: white; text-align: center;">
-            <h2 style="margin:0;">{job_name}: {status}</h2>
-          </div>
-          <div style="padding: 20px;">
-            <p><strong>System:</strong> {socket.gethostname()}</p>
-            <p><strong>Time:</strong> {datetime.datetime.now().strftime("%Y-%m-%d %I:%M %p")}</p>
-            <table style="width: 100%; border-collapse: collapse;">{details_html}</table>
-          </div>
-        </div>
-    </body></html>
+    Queues an email alert; NOTIFIER sends it in the background (pooled SMTP
+    session, retries, optional digest). smtp_settings is global_config `smtp`:
+    {server, port, email, password, tls}
     """
-    msg.attach(MIMEText(body, 'html'))
-
-    try:
-        server = smtplib.SMTP(smtp_server, smtp_port)
-        server.starttls()
-        server.login(sender_email, sender_password)
-        server.sendmail(sender_email, recipients, msg.as_string())
-        server.quit()
-    except Exception as e:
-        print(f"❌ Email Failed: {e}")
-
-
-
+    NOTIFIER.notify(job_name, status, details_html, recipients_str, smtp_settings)
 
 
 # --- CONFIGURATION ---
+def start_rclone():
+    """Starts the rclone backend (a persistent rcd daemon unless RCLONE_MODE says otherwise)."""
+    global RCLONE
+    RCLONE = create_backend(RCLONE_BIN, RCLONE_MODE)
+
+def probe_rclone_version():
+    """Version of RCLONE_BIN for the meta node, cached per binary (size + mtime)."""
+    global RCLONE_INSTALLED_VERSION
+    def probe():
+        try:
+            return RCLONE.version()
+        except Exception as e:
+            print(f"⚠️ Could not read rclone version: {e}")
+            return None
+    RCLONE_INSTALLED_VERSION = STARTUP_CACHE.cached("rclone_version", file_key(shutil.which(RCLONE_BIN) or RCLONE_BIN), probe)
+
 def configure_rclone():
     """Confirms 'gdrive' remote exists in rclone.conf, creates it if missing."""
     try:
-        # Check if remote exists
-        result = subprocess.run([RCLONE_BIN, "listremotes"], capture_output=True, text=True)
-        if "gdrive:" in result.stdout:
-            print("✅ Rclone remote 'gdrive' found.")
+        # The check is skipped while rclone.conf is unchanged since it last found the remote.
+        binary = file_key(shutil.which(RCLONE_BIN) or RCLONE_BIN)
+        environment = [os.environ.get(name) for name in ("RCLONE_CONFIG", "APPDATA", "HOME", "XDG_CONFIG_HOME")]
+        config_file = STARTUP_CACHE.cached("rclone_config_path", [binary, environment], RCLONE.config_path)
+        if STARTUP_CACHE.get("gdrive_remote", file_key(config_file)):
+            print("✅ Rclone remote 'gdrive' found (cached).")
             return
 
-        print("⚙️ Configuring 'gdrive' remote with Service Account...")
-        subprocess.run([
-            RCLONE_BIN, "config", "create", "gdrive", "drive", 
-            "scope", "drive", 
-            "service_account_file", KEY_PATH
-        ], check=True)
-        print("✅ Rclone remote 'gdrive' created.")
+        # Check if remote exists
+        if "gdrive:" in RCLONE.listremotes():
+            print("✅ Rclone remote 'gdrive' found.")
+        else:
+            print("⚙️ Configuring 'gdrive' remote with Service Account...")
+            RCLONE.config_create("gdrive", "drive", {"scope": "drive", "service_account_file": KEY_PATH})
+            print("✅ Rclone remote 'gdrive' created.")
+        STARTUP_CACHE.put("gdrive_remote", file_key(config_file), True)
     except Exception as e:
         print(f"⚠️ Failed to configure rclone: {e}")
 
-# --- SCHEDULING LOGIC ---
-def check_schedule(schedule_config):
-    """
-    Returns True if the job should run NOW.
-    Supports:
-    - Daily: { "type": "daily", "time": "HH:MM" }
-    - Monthly: { "type": "monthly", "day": 1, "time": "HH:MM" }
-    """
-    now = datetime.datetime.now()
-    current_time = now.strftime("%H:%M")
-    current_day = now.day
-
-    sched_type = schedule_config.get('type', 'daily')
-    sched_time = schedule_config.get('time', '00:00')
-
-    if sched_type == 'daily':
-        return current_time == sched_time
-    
-    if sched_type == 'monthly':
-        sched_day = int(schedule_config.get('day', 1))
-        return current_day == sched_day and current_time == sched_time
-    
-    return False
-
-def perform_backup(job_id, job_config, global_config):
+# --- BACKUP ---
+def rclone_sync(source_path, destination, cancel_token, files_from=None, options=None, publisher=None,
+                command="sync"):
+    """Runs rclone sync (or copy), raising on failure. Returns the final StatsEvent (or None)."""
+    # Progress arrives as typed events (JSON log or rc stats); the publisher coalesces the writes.
+    file_errors = 0
+    def on_event(event):
+        nonlocal file_errors
+        if isinstance(event, StatsEvent):
+            if publisher:
+                message = f"Syncing... {parse_rclone_size(event.bytes)}"
+                if event.total_bytes:
+                    message += f" of {parse_rclone_size(event.total_bytes)}"
+                message += f" ({parse_rclone_size(event.speed)}/s, ETA {format_duration(event.eta)})"
+                publisher.publish({"progress": progress_fields(event), "detailed_message": message})
+        elif isinstance(event, FileErrorEvent):
+            file_errors += 1
+        elif isinstance(event, RetryEvent):
+            print(f"   🔁 rclone retry {event.attempt}/{event.max_attempts}")
+            if publisher:
+                publisher.publish({"retries": event.attempt})
+
+    options = GOVERNOR.limit_options(options, RCLONE.live_bwlimit) # capped while the host is busy
+    try:
+        return getattr(RCLONE, command)(source_path, destination, files_from=files_from, options=options,
+                                        cancel_token=cancel_token, on_event=on_event)
+    finally:
+        if publisher:
+            publisher.publish({"file_errors": file_errors}, force=True)
+
+def job_remote(job_config, quiet=False):
+    """(base_remote, job root path) of a job, e.g. ("gdrive:", "Backups/Tally")."""
     job_name = job_config.get('name', 'Unknown Job')
-    source_path = job_config.get('source_path')
-
-    if not source_path:
-        print(f"⚠️ Error: Job '{job_name}' has no Local Source Path configured. Skipping.")
-        db.reference(f'runtime_state/{AGENT_ID}/job_states/{job_id}').update({
-            "status": "Error",
-            "detailed_message": "Configuration Error: Local Source Path is missing."
-        })
-        return
-    
     # Handle Remote Configuration (Folder Path vs Folder ID)
     raw_remote = job_config.get('remote_folder', 'Backups')
     
@@ -328,7 +395,8 @@ def perform_backup(job_id, job_config, global_config):
     # 2. Shared Drive Root IDs are usually ~19 chars (starts with 0A).
     # We use backend connection string syntax: gdrive,root_folder_id=XXX:
     if len(raw_remote) > 15 and "/" not in raw_remote and " " not in raw_remote:
-        print(f"🔗 Detected Folder ID: {raw_remote}")
+        if not quiet:
+            print(f"🔗 Detected Folder ID: {raw_remote}")
         base_remote = f"gdrive,root_folder_id={raw_remote}:"
         remote_root = "" # Root is determined by ID
     else:
@@ -340,204 +408,1136 @@ def perform_backup(job_id, job_config, global_config):
     # Construct paths
     # If base_remote has ID, we append path directly. 
     # e.g. gdrive,root_folder_id=XXX:/Marketing/Current_Mirror
-    full_remote_path = f"{remote_root}/{destination_subfolder}".strip("/") 
+    return base_remote, f"{remote_root}/{destination_subfolder}".strip("/")
+
+def job_destinations(job_config, quiet=False):
+    """
+    [(destination id, base_remote, job root, settings)] of a job; the first is the primary.
+    Without `destinations` the job has the single destination built from remote_folder.
+    An entry with `remote` names any rclone remote or a local directory (e.g. a NAS share);
+    an entry without one uses the job's remote_folder / destination_subfolder logic.
+    """
+    configured = job_config.get('destinations') or []
+    if not configured:
+        return [("primary", *job_remote(job_config, quiet), {})]
+    destinations = []
+    for index, settings in enumerate(configured):
+        dest_id = str(settings.get('id') or f"destination_{index + 1}")
+        if settings.get('remote'):
+            base_remote, root = "", settings['remote'].rstrip("/\\")
+        else:
+            overrides = {k: settings[k] for k in ('remote_folder', 'destination_subfolder') if k in settings}
+            base_remote, root = job_remote(dict(job_config, **overrides), quiet)
+        destinations.append((dest_id, base_remote, root, settings))
+    return destinations
+
+def destination_options(settings, options=None):
+    """Per-destination transfer settings (`transfers`, `checkers`, `bwlimit`) on top of options.
+
+    The rcd's `--bwlimit` is one daemon-wide bucket (and rclone ignores a per-job `_config` BwLimit), so in
+    rcd mode a destination's limit is split across its transfers as `--bwlimit-file`. That can only tighten
+    the shared limit; "off" cannot lift it there.
+    """
+    options = dict(options or {})
+    for name in ("transfers", "checkers"):
+        if settings.get(name):
+            options[name] = int(settings[name])
+    if not settings.get('bwlimit'):
+        return options
+    if not RCLONE.live_bwlimit:
+        options["bwlimit"] = settings['bwlimit']
+        return options
+    try:
+        rate = parse_size(settings['bwlimit'])
+    except ValueError:
+        print(f"Warning: ignoring bad bwlimit {settings['bwlimit']!r} for destination {settings.get('id')!r}.")
+        return options
+    if rate is None:
+        print(f"Warning: bwlimit 'off' for destination {settings.get('id')!r} cannot lift the shared rcd limit; ignored.")
+        return options
+    per_file = max(1, rate // int(options.get("transfers") or 4) // 1024)
+    options["bwlimit-file"] = f"{per_file}k"
+    return options
+
+def destination_ref(job_id, dest_id):
+    return WRITES.reference(f'runtime_state/{AGENT_ID}/job_states/{job_id}/destinations/{dest_id}')
+
+def checkpoint_batches(scan):
+    """Splits a large upload into batches of CHECKPOINT_FILES files / CHECKPOINT_BYTES bytes."""
+    batches, batch, size = [], [], 0
+    for path in sorted(scan.changed):
+        if path not in scan.entries:
+            continue
+        if batch and (len(batch) >= CHECKPOINT_FILES or size + scan.entries[path][0] > CHECKPOINT_BYTES):
+            batches.append(batch)
+            batch, size = [], 0
+        batch.append(path)
+        size += scan.entries[path][0]
+    if batch:
+        batches.append(batch)
+    return batches
+
+def sync_mirror(scan, mirror, options, cancel_token, publisher=None, journal=None):
+    """
+    Brings a Current_Mirror up to date with a scan: full sync, changed paths only, or nothing.
+    Large uploads first go out in batches (rclone copy) that are committed to the file index
+    one by one, so a run cut short by a crash or reboot only re-sends the batches it never finished.
+    """
+    stats = None
+    batches = checkpoint_batches(scan)
+    if len(batches) > 1:
+        list_path = os.path.join(config_dir, f"checkpoint_{scan.job_id}.txt")
+        for number, batch in enumerate(batches, 1):
+            print(f"   📦 Upload batch {number}/{len(batches)} ({len(batch)} files)")
+            with open(list_path, "w", encoding="utf-8") as f:
+                f.writelines(path + "\n" for path in batch)
+            try:
+                stats = merge_stats(stats, rclone_sync(scan.source_path, mirror, cancel_token, files_from=list_path,
+                                                       options=options, publisher=publisher, command="copy"))
+            finally:
+                os.remove(list_path)
+            entries = {path: scan.entries[path] for path in batch}
+            FILE_INDEX.commit_paths(scan.job_id, entries, [])
+            if journal is not None:
+                journal.progress(len(batch), sum(size for size, _ in entries.values()))
+        # What is left: deletions, and for a full sync the comparison with the remote (no uploads).
+        scan = copy.copy(scan)
+        scan.changed = []
+
+    if scan.full_sync:
+        return merge_stats(stats, rclone_sync(scan.source_path, mirror, cancel_token, options=options,
+                                              publisher=publisher))
+    if not scan.has_changes:
+        return stats
+    list_path = scan.write_files_from(os.path.join(config_dir, f"files_from_{scan.job_id}.txt"))
+    try:
+        return merge_stats(stats, rclone_sync(scan.source_path, mirror, cancel_token, files_from=list_path,
+                                              options=options, publisher=publisher))
+    finally:
+        os.remove(list_path)
+
+def perform_backup(job_id, job_config, global_config, cancel_token=None, trigger_type="Scheduled", resume=None):
+    """
+    One backup run. resume is the RunJournal of an interrupted run of this job:
+    its snapshot name is reused and phases it completed are not repeated.
+    """
+    cancel_token = cancel_token or CancelToken()
+    job_name = job_config.get('name', 'Unknown Job')
+    source_path = job_config.get('source_path')
+
+    if not source_path:
+        print(f"⚠️ Error: Job '{job_name}' has no Local Source Path configured. Skipping.")
+        WRITES.reference(f'runtime_state/{AGENT_ID}/job_states/{job_id}').update({
+            "status": "Error",
+            "detailed_message": "Configuration Error: Local Source Path is missing."
+        })
+        return
     
+    destinations = job_destinations(job_config)
+    primary_id, base_remote, full_remote_path, primary = destinations[0]
     mirror_path = f"{full_remote_path}/Current_Mirror"
-    timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    snapshot_mode = job_config.get('snapshot_mode', global_config.get('snapshot_mode', 'full'))
+    engine = job_config.get('engine', 'rclone') # 'rclone' (mirror + snapshot), 'chunked' (dedup store) or 'packed' (tar packs)
+    timestamp = resume.record["timestamp"] if resume else datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
     backup_path = f"{full_remote_path}/Backup_{timestamp}"
 
     print(f"\n🚀 Starting Job: {job_name} ({source_path})")
     print(f"   Destination: {base_remote}{backup_path}")
 
     # Update Job State -> Running
-    state_ref = db.reference(f'runtime_state/{AGENT_ID}/job_states/{job_id}')
-    state_ref.update({"status": "Running", "detailed_message": "Syncing...", "start_time": timestamp})
+    state_ref = WRITES.reference(f'runtime_state/{AGENT_ID}/job_states/{job_id}')
+    state_ref.update({"status": "Running", "detailed_message": "Syncing...", "start_time": timestamp,
+                      "progress": None, "retries": 0, "file_errors": 0})
+    publisher = StatePublisher(state_ref.update, interval=float(global_config.get('progress_interval', 5)))
 
     if not os.path.exists(source_path):
         err = f"Source not found: {source_path}"
         state_ref.update({"status": "Error", "detailed_message": err})
         return
 
+    # Checkpoint journal: resumed, or started fresh once leftovers of an earlier run are cleaned up.
+    if resume:
+        journal = resume
+        journal.resume()
+        print(f"   ♻️ Resuming interrupted run (was in phase '{journal.record.get('phase')}', "
+              f"{journal.record.get('files_done', 0)} files already uploaded)")
+    else:
+        journal = RunJournal(os.path.join(RUNS_DIR, f"{job_id}.json"))
+        if journal.record:
+            discard_run(journal, "superseded by a new run")
+        journal.begin(job_id, trigger_type, timestamp, source_path, engine,
+                      [f"{base}{root}" for _, base, root, _ in destinations])
+
     bytes_transferred = 0
+    run_status = "Error"
+    phases = PhaseClock(METRICS, "phase_seconds", job=job_id)
+    # Transfer settings learned from earlier runs; a daemon is bandwidth-limited live by the main loop instead.
+    options = TUNER.options_for(job_id, job_config, enabled=global_config.get('adaptive_transfers', True))
+    bandwidth = schedule_for(job_config, global_config)
+    if bandwidth and not RCLONE.live_bwlimit:
+        options["bwlimit"] = bandwidth.rclone_timetable()
+    options = destination_options(primary, options)
+    stats = None
+    fanout = None # extra destinations, each on its own thread
+    replicas = {}
+    primary_ref = destination_ref(job_id, destinations[0][0]) if len(destinations) > 1 else None
     try:
         # 1. Sync
         # We assume the user wants 'Snapshot' style history.
         # Strategy: Sync to Mirror (Incremental), then Copy Mirror to Backup_Timestamp (Server-Side)
-        
-        process = subprocess.Popen(
-            [RCLONE_BIN, "sync", source_path, f"{base_remote}{mirror_path}",
-             "--transfers", "8", "--use-json-log", "--stats", "1s"],
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+        # The local file index tells us what changed, so unchanged trees skip rclone entirely.
+        state_ref.update({"detailed_message": "Scanning for changes..."})
+        phases.start("scan")
+        journal.phase("scan")
+        scan = FILE_INDEX.diff(
+            job_id, source_path, f"{base_remote}{full_remote_path}/{STORE_DIRS[engine]}" if engine in STORE_DIRS else f"{base_remote}{mirror_path}",
+            hash_files=job_config.get('index_hashes', False),
+            full_sync_days=job_config.get('full_sync_days', global_config.get('full_sync_days', DEFAULT_FULL_SYNC_DAYS))
         )
-        
-        # Simple stats monitoring
-        last_error_lines = []
-        while True:
-            line = process.stderr.readline()
-            if not line and process.poll() is not None: break
-            if line:
-                try:
-                    log_entry = json.loads(line)
-                    if 'stats' in log_entry: 
-                        bytes_transferred = log_entry['stats'].get('bytes', 0)
-                    elif 'level' in log_entry and log_entry['level'] == 'error':
-                        # Capture structured rclone errors
-                        last_error_lines.append(log_entry.get('msg', ''))
-                except:
-                    # Capture raw non-JSON errors (like auth failure)
-                    last_error_lines.append(line.strip())
-                    pass
-        
-        if process.returncode != 0: 
-            error_msg = "; ".join(last_error_lines[-3:]) # Last 3 errors
-            if not error_msg: error_msg = "Rclone Sync Failed (Unknown Error)"
-            raise Exception(error_msg)
-
-        # 2. Snapshot (Copy)
-        state_ref.update({"detailed_message": f"Creating Snapshot: Backup_{timestamp}..."})
-        subprocess.run([RCLONE_BIN, "copy", f"{base_remote}{mirror_path}", f"{base_remote}{backup_path}",
-                        "--server-side-across-configs"], check=True)
-
-        # 3. Retention
-        retention = job_config.get('retention', {}).get('days', 60)
-        # Note: Retention check needs to run differently if using dynamic connection string?
-        # Actually, rclone lsd supports it.
+        cancel_token.check()
+
+        # Extra destinations reuse this scan and start uploading alongside the primary sync below.
+        if len(destinations) > 1:
+            if engine in STORE_DIRS:
+                print(f"   ⚠️ Extra destinations need the rclone engine; only {destinations[0][0]} is backed up")
+            else:
+                fanout = ThreadPoolExecutor(max_workers=len(destinations) - 1, thread_name_prefix="fanout")
+                replicas = {d[0]: fanout.submit(replicate, job_id, job_config, global_config, d, scan,
+                                                timestamp, cancel_token, journal) for d in destinations[1:]}
+            primary_ref.update({"status": "Running", "detailed_message": "Syncing...", "error": None,
+                                "remote": f"{base_remote}{full_remote_path}"})
+
+        phases.start("sync")
+        journal.phase("sync")
+        primary_root = f"{base_remote}{full_remote_path}"
+        if engine == 'chunked':
+            # Chunk engine: only new chunks are uploaded and the manifest itself is the snapshot.
+            state_ref.update({"detailed_message": "Chunking changed files..."})
+            def chunk_progress(done, total, uploaded):
+                cancel_token.check()
+                publisher.publish({"detailed_message": f"Chunking... {done}/{total} files, {parse_rclone_size(uploaded)} new"})
+            store = chunk_store(job_id, base_remote, full_remote_path, cancel_token)
+            manifest, bytes_transferred = store.backup(
+                source_path, f"Backup_{timestamp}", scan.entries, on_progress=chunk_progress
+            )
+            publisher.publish({"file_errors": len(store.skipped)}, force=True) # unreadable files keep their last version
+            LEDGER.add(job_id, primary_id, primary_root, CHUNKS_DIR, bytes_transferred)
+            LEDGER.set_folder(job_id, primary_id, primary_root, f"Backup_{timestamp}", len(json.dumps(manifest).encode("utf-8")))
+            publisher.flush()
+        elif engine == 'packed':
+            # Pack engine: small files travel in a few large tar uploads; unchanged packs are reused.
+            state_ref.update({"detailed_message": "Packing changed files..."})
+            def pack_progress(done, total, uploaded):
+                publisher.publish({"detailed_message": f"Packing... {done}/{total} files, {parse_rclone_size(uploaded)} uploaded"})
+            store = pack_store(job_id, base_remote, full_remote_path, cancel_token)
+            manifest, bytes_transferred = store.backup(
+                source_path, f"Backup_{timestamp}", scan.entries, on_progress=pack_progress
+            )
+            publisher.publish({"file_errors": len(store.skipped)}, force=True) # unreadable files keep their last version
+            LEDGER.add(job_id, primary_id, primary_root, PACKS_DIR, bytes_transferred)
+            LEDGER.set_folder(job_id, primary_id, primary_root, f"Backup_{timestamp}", len(json.dumps(manifest).encode("utf-8")))
+            publisher.flush()
+        elif scan.full_sync or scan.has_changes:
+            if scan.full_sync:
+                state_ref.update({"detailed_message": "Syncing (full)..."})
+            else:
+                print(f"   📝 {len(scan.changed)} changed, {len(scan.deleted)} deleted since last run")
+                state_ref.update({"detailed_message": f"Syncing {len(scan.changed) + len(scan.deleted)} changed files..."})
+            stats = sync_mirror(scan, f"{base_remote}{mirror_path}", options, cancel_token, publisher, journal)
+        else:
+            print("   ✅ No changes since last run. Skipping sync.")
+        FILE_INDEX.commit(scan)
+        if engine not in STORE_DIRS:
+            LEDGER.set_folder(job_id, primary_id, primary_root, "Current_Mirror", tree_bytes(scan.entries))
+        if stats:
+            bytes_transferred = stats.bytes
+            governed = GOVERNOR.job_totals(job_id)
+            # A run slowed down by the governor says nothing about the link.
+            if not (governed["throttled_s"] or governed["suspended_s"]):
+                tuning = TUNER.record(job_id, options, stats, job_config)
+                if tuning:
+                    state_ref.update({"tuning": tuning})
+
+        # 2. Snapshot
+        # full: server-side copy of the whole mirror.
+        # incremental: copy only what changed since the last snapshot, plus a manifest.
+        phases.start("snapshot")
+        journal.phase("snapshot")
+        if engine in STORE_DIRS:
+            pass # Backup_{timestamp}/_chunk_manifest.json or _pack_manifest.json was written in step 1
+        elif journal.record["snapshots"].get(primary_root) == "done":
+            print(f"   📸 Backup_{timestamp} was completed before the interruption")
+        elif snapshot_mode == 'incremental':
+            journal.snapshot_state(primary_root, "pending")
+            state_ref.update({"detailed_message": f"Creating Snapshot: Backup_{timestamp}..."})
+            catalog = snapshot_catalog(job_id, base_remote, full_remote_path)
+            manifest, copied = catalog.create(
+                f"Backup_{timestamp}", scan.entries, f"{base_remote}{mirror_path}",
+                os.path.join(config_dir, f"snapshot_{job_id}.txt"), cancel_token=cancel_token
+            )
+            print(f"   📸 Incremental snapshot: {len(copied)} of {len(manifest['files'])} files stored")
+            journal.snapshot_state(primary_root, "done")
+            LEDGER.update_folders(job_id, primary_id, primary_root, catalog.stored_bytes([f"Backup_{timestamp}"]))
+        else:
+            journal.snapshot_state(primary_root, "pending")
+            state_ref.update({"detailed_message": f"Creating Snapshot: Backup_{timestamp}..."})
+            RCLONE.copy(f"{base_remote}{mirror_path}", f"{base_remote}{backup_path}",
+                        options={"server-side-across-configs": True}, cancel_token=cancel_token)
+            journal.snapshot_state(primary_root, "done")
+            LEDGER.set_folder(job_id, primary_id, primary_root, f"Backup_{timestamp}", tree_bytes(scan.entries))
+
+        # 3. Verification (mirror only; the chunk and pack engines checksum their own objects)
+        integrity = None
+        from integrity import verify_policy
+        verify = verify_policy(job_config, global_config)
+        if engine not in STORE_DIRS and verify["enabled"]:
+            cancel_token.check()
+            phases.start("verify")
+            journal.phase("verify")
+            state_ref.update({"detailed_message": "Verifying uploaded files..."})
+            integrity = verify_integrity(job_id, source_path, f"{base_remote}{mirror_path}", scan.entries,
+                                         verify, cancel_token)
+            state_ref.update({"integrity": integrity.summary() if integrity else {"error": "verification failed"}})
+
+        # 4. Retention
+        cancel_token.check()
+        phases.start("retention")
+        journal.phase("retention")
+        retention = job_config.get('retention') or global_config.get('retention_policy') or {'days': 60}
         # We pass the full path relative to the base connection
-        enforce_retention(base_remote, full_remote_path, retention)
+        plan = enforce_retention(base_remote, full_remote_path, retention, job_id, snapshot_mode,
+                                 int(global_config.get('retention_workers', DEFAULT_PURGE_WORKERS)))
+        if plan is not None:
+            state_ref.update({"retention": plan.summary()})
+            account_retention(job_id, primary_id, base_remote, full_remote_path, plan, snapshot_mode)
+            phases.start("gc")
+            if engine == 'chunked' and not plan.dry_run:
+                freed = chunk_store(job_id, base_remote, full_remote_path).collect_garbage(plan.remaining)
+                LEDGER.add(job_id, primary_id, primary_root, CHUNKS_DIR, -(freed or 0))
+            elif engine == 'packed' and not plan.dry_run:
+                freed = pack_store(job_id, base_remote, full_remote_path).collect_garbage(
+                    plan.remaining, os.path.join(config_dir, f"pack_gc_{job_id}.txt"))
+                LEDGER.add(job_id, primary_id, primary_root, PACKS_DIR, -(freed or 0))
+        reconcile_storage(job_id, primary_id, primary_root, global_config)
+
+        # 5. Extra destinations (already running since the sync phase)
+        failed_destinations = {}
+        if replicas:
+            phases.start("fanout")
+            state_ref.update({"detailed_message": "Waiting for other destinations..."})
+            for dest_id, future in replicas.items():
+                try:
+                    future.result()
+                except JobCancelled:
+                    raise
+                except Exception as e:
+                    failed_destinations[dest_id] = str(e)
+        if primary_ref:
+            primary_ref.update({"status": "Success", "detailed_message": f"Done. Backup_{timestamp}",
+                                "last_run": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                                "bytes": bytes_transferred})
 
         # Success
+        phases.stop()
+        run_status = "Success"
+        journal.finish()
         size_str = parse_rclone_size(bytes_transferred)
         success_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         
+        done_message = f"Done. {size_str} uploaded to Backup_{timestamp}"
+        if integrity and integrity.problems:
+            done_message += f" ⚠️ {len(integrity.problems)} files failed verification"
+        if failed_destinations:
+            done_message += f" ⚠️ Failed destinations: {', '.join(sorted(failed_destinations))}"
         state_ref.update({
             "status": "Success", 
-            "detailed_message": f"Done. {size_str} uploaded to Backup_{timestamp}",
+            "detailed_message": done_message,
             "last_run": success_time,
             "last_size": size_str
         })
-        
-        # Logs
-        log_entry = {
-            "timestamp": success_time,
-            "job_name": job_name,
-            "status": "Success",
-            "size": size_str,
-            "type": "Scheduled"
-        }
-        db.reference(f'logs/{AGENT_ID}').push(log_entry)
 
         # Email
         email_recipients = job_config.get('email_recipients', global_config.get('default_email_recipients', ''))
         smtp_settings = global_config.get('smtp', {})
         details = f"<tr><td>Job:</td><td>{job_name}</td></tr><tr><td>Data:</td><td>{size_str}</td></tr>"
+        if integrity:
+            details += (f"<tr><td>Verified:</td><td>{integrity.checked} files, "
+                        f"{len(integrity.problems)} failed</td></tr>")
+        for dest_id in replicas:
+            outcome = f"Failed: {failed_destinations[dest_id]}" if dest_id in failed_destinations else "OK"
+            details += f"<tr><td>{dest_id}:</td><td>{outcome}</td></tr>"
+        phases.start("email")
         send_email_alert(job_name, "SUCCESS", details, email_recipients, smtp_settings)
 
+    except JobCancelled as e:
+        run_status = "Cancelled"
+        print(f"🛑 Job Cancelled: {job_name}")
+        journal.abandon(str(e))
+        state_ref.update({"status": "Cancelled", "detailed_message": str(e)})
+        if primary_ref:
+            primary_ref.update({"status": "Cancelled", "detailed_message": str(e)})
+
     except Exception as e:
         print(f"❌ Job Failed: {e}")
+        journal.abandon(str(e))
         state_ref.update({"status": "Error", "detailed_message": str(e)})
+        if primary_ref:
+            primary_ref.update({"status": "Error", "detailed_message": str(e), "error": str(e)})
         
         # Email Failure
         email_recipients = job_config.get('email_recipients', global_config.get('default_email_recipients', ''))
         smtp_settings = global_config.get('smtp', {})
+        phases.start("email")
         send_email_alert(job_name, "FAILURE", f"<tr><td>Error:</td><td>{str(e)}</td></tr>", email_recipients, smtp_settings)
 
-def enforce_retention(base_remote, start_remote_path, retention_days):
-    if not retention_days: return
+    finally:
+        if fanout is not None:
+            fanout.shutdown(wait=True) # never leave an upload running after the job has ended
+        phases.stop()
+        publish_run_stats(job_id, run_status, phases, bytes_transferred)
+        publish_storage(job_id)
+        log_run(job_id, job_name, run_status, trigger_type, bytes_transferred, phases.total)
+
+def replicate(job_id, job_config, global_config, destination, primary_scan, timestamp, cancel_token, journal=None):
+    """
+    One extra destination of a fan-out job: mirror sync, full snapshot and
+    retention, reusing the primary's scan (one walk, hashes computed once).
+    Each destination keeps its own file index state, so one that failed gets
+    its missed changes on the next run. Returns the bytes uploaded; raises on failure.
+    journal (the run's RunJournal) tracks upload batches and the snapshot state.
+    """
+    dest_id, base_remote, root, settings = destination
+    dest_ref = destination_ref(job_id, dest_id)
+    publisher = StatePublisher(dest_ref.update, interval=float(global_config.get('progress_interval', 5)))
+    mirror = f"{base_remote}{root}/Current_Mirror"
+    dest_ref.update({"status": "Running", "detailed_message": "Syncing...", "error": None,
+                     "remote": f"{base_remote}{root}", "progress": None})
     try:
-        keep_days = int(retention_days)
-        print(f"🧹 Retention Check: {start_remote_path} (Keep {keep_days} days)")
-        
-        # List directories
-        # Path is {base_remote}{start_remote_path}
-        cmd = [RCLONE_BIN, "lsd", f"{base_remote}{start_remote_path}"]
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        
-        if result.returncode != 0: return
-
-        now = datetime.datetime.now()
-        for line in result.stdout.splitlines():
-            parts = line.strip().split()
-            if not parts: continue
-            folder_name = parts[-1]
-            if folder_name == "Current_Mirror": continue
-
-            # Match Backup_YYYY-MM-DD...
-            match = re.search(r"Backup_(\d{4}-\d{2}-\d{2})", folder_name)
-            if match:
+        scan = FILE_INDEX.diff(f"{job_id}@{dest_id}", primary_scan.source_path, mirror,
+                               hash_files=job_config.get('index_hashes', False),
+                               full_sync_days=job_config.get('full_sync_days', global_config.get('full_sync_days', DEFAULT_FULL_SYNC_DAYS)),
+                               base=primary_scan)
+        stats = sync_mirror(scan, mirror, destination_options(settings), cancel_token, publisher, journal)
+        FILE_INDEX.commit(scan)
+        dest_root = f"{base_remote}{root}"
+        LEDGER.set_folder(job_id, dest_id, dest_root, "Current_Mirror", tree_bytes(scan.entries))
+        if not (journal and journal.record["snapshots"].get(dest_root) == "done"):
+            publisher.publish({"detailed_message": f"Creating Snapshot: Backup_{timestamp}..."}, force=True)
+            if journal:
+                journal.snapshot_state(dest_root, "pending")
+            RCLONE.copy(mirror, f"{dest_root}/Backup_{timestamp}",
+                        options={"server-side-across-configs": True}, cancel_token=cancel_token)
+            if journal:
+                journal.snapshot_state(dest_root, "done")
+            LEDGER.set_folder(job_id, dest_id, dest_root, f"Backup_{timestamp}", tree_bytes(scan.entries))
+        cancel_token.check()
+        retention = job_config.get('retention') or global_config.get('retention_policy') or {'days': 60}
+        plan = enforce_retention(base_remote, root, retention,
+                                 workers=int(global_config.get('retention_workers', DEFAULT_PURGE_WORKERS)))
+        if plan is not None:
+            account_retention(job_id, dest_id, base_remote, root, plan)
+        reconcile_storage(job_id, dest_id, dest_root, global_config)
+        uploaded = stats.bytes if stats else 0
+        METRICS.inc("uploaded_bytes_total", uploaded, job=job_id, destination=dest_id)
+        print(f"   📦 {dest_id}: {parse_rclone_size(uploaded)} uploaded to Backup_{timestamp}")
+        publisher.flush()
+        dest_ref.update({"status": "Success", "detailed_message": f"Done. Backup_{timestamp}",
+                         "last_run": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "bytes": uploaded,
+                         "retention": plan.summary() if plan else None})
+        return uploaded
+    except JobCancelled as e:
+        publisher.flush()
+        dest_ref.update({"status": "Cancelled", "detailed_message": str(e)})
+        raise
+    except Exception as e:
+        print(f"   ❌ Destination {dest_id} failed: {e}")
+        publisher.flush()
+        METRICS.inc("destination_failures_total", job=job_id, destination=dest_id)
+        dest_ref.update({"status": "Error", "detailed_message": str(e), "error": str(e)})
+        raise
+
+def discard_run(journal, reason):
+    """Purges the partial Backup_ folders of an unfinished run and drops its journal."""
+    record = journal.record
+    print(f"🧹 Cleaning up unfinished run of {record['job_id']} ({journal.snapshot}): {reason}")
+    for root in journal.partial_snapshots():
+        try:
+            RCLONE.purge(f"{root}/{journal.snapshot}")
+            print(f"   🗑️ Removed partial snapshot {root}/{journal.snapshot}")
+        except RcloneError as e:
+            if not e.not_found:
+                print(f"   ⚠️ Could not remove {root}/{journal.snapshot}: {e}")
+                return # keep the journal; the next attempt tries again
+        except Exception as e:
+            print(f"   ⚠️ Could not remove {root}/{journal.snapshot}: {e}")
+            return
+    snapshot_catalog(record['job_id'], "", "").forget(journal.snapshot) # a half-written incremental manifest
+    journal.finish()
+
+def resume_backup(job_id, job_config, global_config, journal, cancel_token):
+    """
+    Continues a run interrupted by a crash or reboot, or cleans it up when it
+    cannot be continued (job gone or changed, run failed, or older than
+    global_config `resume_max_age_hours`).
+    """
+    record = journal.record
+    max_age = float(global_config.get('resume_max_age_hours', DEFAULT_RESUME_MAX_AGE))
+    reason = None
+    if not job_config.get('source_path'):
+        reason = "job no longer exists"
+    elif job_config.get('source_path') != record.get('source_path'):
+        reason = "source folder changed"
+    elif job_config.get('engine', 'rclone') != record.get('engine'):
+        reason = "engine changed"
+    elif record.get('abandoned'):
+        reason = f"run ended with: {record['abandoned']}"
+    elif journal.age_hours() > max_age:
+        reason = f"interrupted more than {max_age:g}h ago"
+    if reason:
+        discard_run(journal, reason)
+        return
+    METRICS.inc("runs_resumed_total", job=job_id)
+    perform_backup(job_id, job_config, global_config, cancel_token, record.get('trigger_type', "Scheduled"),
+                   resume=journal)
+
+def run_job(job_id, job_config, global_config, cancel_token, trigger_type):
+    """JobScheduler entry point: continuous-mode pushes, restores, resumed runs or a full backup run."""
+    if trigger_type == "Continuous":
+        push_changes(job_id, job_config, global_config, cancel_token)
+    elif trigger_type == "Restore":
+        perform_restore(job_id, job_config, global_config, job_config['restore_request'], cancel_token)
+    elif trigger_type == "Resume":
+        resume_backup(job_id, job_config, global_config, job_config['resume_run'], cancel_token)
+    else:
+        perform_backup(job_id, job_config, global_config, cancel_token, trigger_type)
+
+def push_changes(job_id, job_config, global_config, cancel_token):
+    """
+    Continuous mode: syncs one batch of settled changed paths into Current_Mirror
+    (--files-from) and records them in the file index. No snapshot is made; the
+    scheduled run still creates Backup_{timestamp}.
+    """
+    collector, settings = CONTINUOUS.collector(job_id) if CONTINUOUS else (None, None)
+    if collector is None:
+        return
+    paths, rescan = collector.take(settings["batch_size"])
+    source_path = job_config['source_path']
+    _, base_remote, full_remote_path, _ = job_destinations(job_config, quiet=True)[0]
+    mirror = f"{base_remote}{full_remote_path}/Current_Mirror"
+    state_ref = WRITES.reference(f'runtime_state/{AGENT_ID}/job_states/{job_id}')
+    try:
+        if rescan:
+            # Events were lost: diff the tree against the file index instead.
+            scan = FILE_INDEX.diff(job_id, source_path, mirror, full_sync_days=0)
+            if scan.full_sync:
+                return # no usable state yet; the scheduled run does the full sync
+            paths = sorted(set(paths) | set(scan.changed) | set(scan.deleted))
+
+        entries, deleted = {}, []
+        for path in paths:
+            full = os.path.join(source_path, *path.split("/"))
+            if os.path.isdir(full):
+                entries.update({f"{path}/{rel}": meta for rel, meta in scan_tree(full).items()})
+            elif os.path.isfile(full):
+                st = os.stat(full)
+                entries[path] = (st.st_size, st.st_mtime_ns)
+            else:
+                deleted += FILE_INDEX.paths_under(job_id, path) or [path]
+        deleted = sorted(set(deleted) - set(entries))
+        if not entries and not deleted:
+            return
+
+        options = TUNER.options_for(job_id, job_config, enabled=False)
+        bandwidth = schedule_for(job_config, global_config)
+        if bandwidth and not RCLONE.live_bwlimit:
+            options["bwlimit"] = bandwidth.rclone_timetable()
+        list_path = os.path.join(config_dir, f"continuous_{job_id}.txt")
+        with open(list_path, "w", encoding="utf-8") as f:
+            f.writelines(path + "\n" for path in sorted(entries) + deleted)
+        try:
+            stats = rclone_sync(source_path, mirror, cancel_token, files_from=list_path, options=options)
+        finally:
+            os.remove(list_path)
+        FILE_INDEX.commit_paths(job_id, entries, deleted)
+    except Exception as e:
+        collector.put_back(paths, rescan)
+        print(f"⚠️ Continuous push for {job_id} failed: {e}")
+        state_ref.update({"continuous": dict(CONTINUOUS.status(job_id) or {}, error=str(e))})
+        return
+
+    pushed_bytes = stats.bytes if stats else 0
+    print(f"🔄 {job_id}: pushed {len(entries)} changed, {len(deleted)} deleted to Current_Mirror")
+    METRICS.inc("continuous_pushes_total", job=job_id)
+    METRICS.inc("uploaded_bytes_total", pushed_bytes, job=job_id)
+    state_ref.update({"continuous": dict(CONTINUOUS.status(job_id) or {}, error=None,
+                                         last_push=datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                                         last_push_files=len(entries) + len(deleted),
+                                         last_push_bytes=pushed_bytes)})
+
+def perform_restore(job_id, job_config, global_config, request, cancel_token):
+    """
+    Restores a Backup_ snapshot of a job into a local folder (see restore.py).
+    Progress goes to job_states/{job}/restore; the job's own backup status is left alone.
+    """
+    restore_ref = WRITES.reference(f'runtime_state/{AGENT_ID}/job_states/{job_id}/restore')
+    publisher = StatePublisher(restore_ref.update, interval=float(global_config.get('progress_interval', 5)))
+    job_name = job_config.get('name', 'Unknown Job')
+    engine = job_config.get('engine', 'rclone')
+    _, base_remote, full_remote_path, _ = job_destinations(job_config, quiet=True)[0]
+    job_root = f"{base_remote}{full_remote_path}"
+    journal = None
+    started = time.time()
+    restored_bytes = 0
+    from restore import (RestoreJournal, RestoreResult, restore_request, restore_id, list_snapshots, pick_snapshot,
+                         default_target, plan_restore, run_restore)
+    try:
+        request = restore_request(dict(request, job_id=job_id), job_config, global_config)
+        if not request["snapshot"]:
+            request["snapshot"] = pick_snapshot(list_snapshots(RCLONE, job_root), at=request["at"])
+        if not request["target"]:
+            request["target"] = default_target(job_config.get('source_path'), request["snapshot"])
+        snapshot, target = request["snapshot"], request["target"]
+        print(f"\n📥 Restoring {job_name}: {snapshot} -> {target}")
+        restore_ref.set({"status": "Running", "snapshot": snapshot, "target": target, "paths": request["paths"],
+                         "started": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                         "detailed_message": "Listing snapshot..."})
+
+        if engine in STORE_DIRS:
+            # Chunk and pack stores rebuild files from their own verified objects.
+            store = (chunk_store if engine == 'chunked' else pack_store)(job_id, base_remote, full_remote_path, cancel_token)
+            restored = store.restore(snapshot, target, request["paths"])
+            summary = {"files_total": restored, "files_done": restored, "failed": 0}
+        else:
+            journal = RestoreJournal(os.path.join(RESTORE_DIR, f"{restore_id(request)}.jsonl"))
+            if journal.start(request):
+                print(f"   ♻️ Resuming: {len(journal.done)} files already restored")
+            plan = plan_restore(RCLONE, snapshot_catalog(job_id, base_remote, full_remote_path), job_root,
+                                snapshot, request["paths"], request["hash_type"])
+            def progress(result):
+                publisher.publish({
+                    "files_done": result.files_done, "files_total": result.files_total,
+                    "bytes_done": result.bytes_done, "bytes_total": result.bytes_total,
+                    "detailed_message": f"Restoring... {result.files_done}/{result.files_total} files, "
+                                        f"{parse_rclone_size(result.bytes_done)} of {parse_rclone_size(result.bytes_total)}"})
+            progress(RestoreResult(plan, target, len(journal.done)))
+            result = run_restore(RCLONE, job_root, plan, target, journal, request["workers"], request["transfers"],
+                                 request["verify"], request["hash_type"], cancel_token, progress)
+            summary = result.summary()
+            restored_bytes = result.bytes_done
+            if result.failed:
+                journal.stop("failed")
+            else:
+                journal.finish(summary)
+            METRICS.inc("restored_bytes_total", result.bytes_done, job=job_id)
+        publisher.flush()
+
+        failed = summary["failed"]
+        message = f"Restored {summary['files_done']} files from {snapshot} to {target}"
+        if failed:
+            message += f" ⚠️ {failed} files failed verification"
+        print(f"   ✅ {message}")
+        restore_ref.update(dict(summary, status="Error" if failed else "Success", detailed_message=message,
+                                finished=datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+        status = "Restore Failed" if failed else "Restored"
+    except JobCancelled as e:
+        print(f"🛑 Restore Cancelled: {job_name}")
+        if journal is not None:
+            journal.stop("cancelled")
+        publisher.flush()
+        restore_ref.update({"status": "Cancelled", "detailed_message": str(e)})
+        status = "Restore Cancelled"
+    except Exception as e:
+        print(f"❌ Restore Failed: {e}")
+        publisher.flush()
+        restore_ref.update({"status": "Error", "detailed_message": str(e)})
+        status = "Restore Failed"
+    log_run(job_id, job_name, status, "Restore", restored_bytes, time.time() - started)
+
+def verify_integrity(job_id, source_path, mirror, entries, policy, cancel_token):
+    """
+    Checks new/changed files and a random sample of the rest against one hash
+    listing of the mirror. Failed files are dropped from the file index (and,
+    if mismatched, deleted from the mirror) so the next run uploads them again.
+    Returns the VerifyResult, or None if verification itself failed.
+    """
+    global HASH_MANIFEST
+    from integrity import HashManifest, verify_mirror
+    try:
+        if HASH_MANIFEST is None:
+            HASH_MANIFEST = HashManifest(HASH_MANIFEST_DB)
+        result = verify_mirror(RCLONE, HASH_MANIFEST, job_id, source_path, mirror, entries, policy, cancel_token)
+    except JobCancelled:
+        raise
+    except Exception as e:
+        print(f"⚠️ Verification Error: {e}")
+        return None
+    print(f"   🔍 Verified {result.checked} files ({result.sampled} sampled, {result.hashed} hashed): "
+          f"{len(result.mismatched)} mismatched, {len(result.missing)} missing")
+    METRICS.inc("verified_files_total", result.checked, job=job_id)
+    METRICS.inc("verification_failures_total", len(result.problems), job=job_id)
+    if result.problems and policy["repair"]:
+        try:
+            if result.mismatched:
+                list_path = os.path.join(config_dir, f"verify_{job_id}.txt")
+                with open(list_path, "w", encoding="utf-8") as f:
+                    f.writelines(path + "\n" for path in result.mismatched)
                 try:
-                    folder_date = datetime.datetime.strptime(match.group(1), "%Y-%m-%d")
-                    age_days = (now - folder_date).days
-                    if age_days > keep_days:
-                        print(f"   🗑️ PURGING: {folder_name} ({age_days} days old)...")
-                        subprocess.run([RCLONE_BIN, "purge", f"{base_remote}{start_remote_path}/{folder_name}"], check=True)
-                except ValueError:
-                    continue
+                    RCLONE.delete(mirror, files_from=list_path)
+                finally:
+                    os.remove(list_path)
+            FILE_INDEX.forget_paths(job_id, result.problems)
+            print(f"   🔁 {len(result.problems)} files will be uploaded again on the next run")
+        except Exception as e:
+            print(f"⚠️ Could not schedule re-upload: {e}")
+    return result
+
+def publish_run_stats(job_id, status, phases, bytes_transferred):
+    """Numeric run record: stats/{agent}/jobs/{job}/last_run and the local metrics file."""
+    METRICS.inc("runs_total", job=job_id, status=status)
+    METRICS.inc("uploaded_bytes_total", bytes_transferred, job=job_id)
+    METRICS.observe("run_seconds", phases.total, job=job_id)
+    record = {
+        "status": status,
+        "ended": int(time.time()),
+        "duration_s": phases.total,
+        "bytes": bytes_transferred,
+        "phases": phases.laps,
+        "governor": GOVERNOR.job_totals(job_id),
+    }
+    WRITES.reference(f'stats/{AGENT_ID}/jobs/{job_id}/last_run').set(record)
+    METRICS_FILE.append(dict(record, kind="run", job=job_id))
+
+def log_run(job_id, job_name, status, trigger_type, bytes_transferred, duration_s):
+    """One entry in logs/{agent}; numbers only, log_rollup folds old entries into aggregates."""
+    WRITES.reference(f'logs/{AGENT_ID}').push({
+        "timestamp": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "job_id": job_id,
+        "job_name": job_name,
+        "status": status,
+        "type": trigger_type,
+        "bytes": bytes_transferred,
+        "duration_s": round(duration_s, 1),
+    })
+
+def compact_logs(global_config):
+    """
+    Keeps the newest global_config `log_keep` entries of logs/{agent} and folds
+    the rest into log_rollups/{agent}/daily and /monthly (see log_rollup.py).
+    Aggregates and deletions go out as one multi-path update.
+    """
+    if not WRITES.idle:
+        return None # an earlier compaction (or a deletion) may not have landed yet
+    try:
+        plan = plan_rollup(DATABASE.get(f'logs/{AGENT_ID}'), int(global_config.get('log_keep', DEFAULT_KEEP)))
+        if not plan.compacted:
+            return plan
+        updates = {}
+        for period, groups in (("daily", plan.daily), ("monthly", plan.monthly)):
+            for key, aggregate in groups.items():
+                path = f'log_rollups/{AGENT_ID}/{period}/{key}'
+                updates[path] = merge_aggregates(DATABASE.get(path), aggregate)
+        updates.update({f'logs/{AGENT_ID}/{key}': None for key in plan.compacted})
+        updates[f'log_rollups/{AGENT_ID}/updated'] = int(time.time())
+        WRITES.update('/', updates)
+        METRICS.inc("log_entries_compacted_total", len(plan.compacted))
+        print(f"🗜️ Compacted {len(plan.compacted)} log entries into {len(plan.daily)} days, "
+              f"{len(plan.monthly)} months ({plan.kept} kept)")
+        return plan
+    except Exception as e:
+        print(f"⚠️ Log compaction failed: {e}")
+        return None
+
+def bundle_mode():
+    """How the agent is running: "script", or the PyInstaller layout ("onefile" unpacks to a temp dir)."""
+    if not getattr(sys, 'frozen', False):
+        return "script"
+    bundle_dir = os.path.abspath(getattr(sys, '_MEIPASS', ''))
+    return "onedir" if bundle_dir.startswith(os.path.dirname(os.path.abspath(sys.executable))) else "onefile"
+
+def publish_startup_stats(startup):
+    """Start-up timing per phase: stats/{agent}/startup and the local metrics file."""
+    record = {
+        "started": int(time.time()),
+        "duration_s": round(time.perf_counter() - BOOT_STARTED, 3),
+        "phases": startup.laps,
+        "bundle": bundle_mode(),
+        "cache_hits": STARTUP_CACHE.hits,
+        "cache_misses": STARTUP_CACHE.misses,
+    }
+    print(f"⏱️ Started in {record['duration_s']:.2f}s ("
+          + ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in startup.laps.items()) + ")")
+    WRITES.reference(f'stats/{AGENT_ID}/startup').set(record)
+    METRICS_FILE.append(dict(record, kind="startup"))
+
+def publish_agent_stats():
+    """Agent-wide numbers: loop cost, Firebase latency, rclone usage, phase averages."""
+    counters, gauges, _ = METRICS.samples()
+    gauge = {name: value for name, labels, value in gauges if not labels}
+    record = {
+        "updated": int(time.time()),
+        "uptime_s": int(time.time() - METRICS.started),
+        "loop": METRICS.timer_summary("loop_iteration_seconds", "loop").get("main", {}),
+        "firebase": METRICS.timer_summary("firebase_call_seconds", "op"),
+        "firebase_errors": sum(v for name, _, v in counters if name == "firebase_errors_total"),
+        "phases": METRICS.timer_summary("phase_seconds", "phase"),
+        "rclone": {
+            "mode": RCLONE.mode,
+            "processes": gauge.get("rclone_processes_spawned", 0),
+            "rc_calls": gauge.get("rclone_rc_calls", 0),
+        },
+        "write_backlog": gauge.get("write_queue_backlog", 0),
+        "jobs_running": gauge.get("jobs_running", 0),
+    }
+    WRITES.reference(f'stats/{AGENT_ID}/agent').set(record)
+    METRICS_FILE.append(dict(record, kind="agent"))
+
+def tree_bytes(entries):
+    return sum(size for size, _ in entries.values())
+
+def account_retention(job_id, dest_id, base_remote, job_root, plan, snapshot_mode='full'):
+    """Storage ledger after retention: purged folders are freed, rebased incremental folders re-sized."""
+    if plan.dry_run:
+        return
+    root = f"{base_remote}{job_root}"
+    freed = LEDGER.remove(job_id, dest_id, root, plan.purge)
+    if freed:
+        print(f"   📉 Retention freed {parse_rclone_size(freed)}")
+    if snapshot_mode == 'incremental':
+        # Files still needed were moved into kept folders; their manifests say how much each holds now.
+        LEDGER.update_folders(job_id, dest_id, root,
+                              snapshot_catalog(job_id, base_remote, job_root).stored_bytes(plan.remaining))
+
+def reconcile_storage(job_id, dest_id, job_root, global_config):
+    """
+    Every global_config `storage_reconcile_days` one recursive listing of the
+    job root replaces the ledger's figures (also the first time a root is seen).
+    """
+    if not LEDGER.reconcile_due(job_id, dest_id, global_config.get('storage_reconcile_days', DEFAULT_RECONCILE_DAYS)):
+        return
+    try:
+        drift = LEDGER.reconcile(job_id, dest_id, job_root, list_job_root(RCLONE, job_root, with_sizes=True))
+        print(f"   📏 Storage reconciled for {job_root} (ledger was off by {parse_rclone_size(abs(drift))})")
+    except Exception as e:
+        print(f"⚠️ Storage reconcile failed: {e}")
+
+def publish_storage(job_id):
+    """Ledger totals: stats/{agent}/jobs/{job}/storage and stats/{agent}/storage (numbers), plus the schema's display string."""
+    totals = LEDGER.agent_totals()
+    WRITES.reference(f'stats/{AGENT_ID}/jobs/{job_id}/storage').set(LEDGER.job_totals(job_id))
+    WRITES.reference(f'stats/{AGENT_ID}').update({
+        "storage": totals,
+        "total_cloud_storage_used_str": parse_rclone_size(totals["bytes"]),
+    })
+
+def snapshot_catalog(job_id, base_remote, job_root):
+    return SnapshotCatalog(RCLONE, os.path.join(MANIFEST_DIR, job_id), base_remote, job_root)
+
+def continuous_protection(jobs):
+    """The watcher service, imported and started the first time any job asks for continuous mode."""
+    global CONTINUOUS
+    if CONTINUOUS is None and any((job or {}).get('continuous') for job in jobs.values()):
+        from watcher import ContinuousProtection
+        CONTINUOUS = ContinuousProtection()
+    return CONTINUOUS
+
+def chunk_store(job_id, base_remote, job_root, cancel_token=None):
+    from chunk_store import ChunkStore
+    return ChunkStore(RCLONE, base_remote, job_root, CHUNK_CACHE_DB,
+                      os.path.join(config_dir, "chunk_staging", job_id), cancel_token=cancel_token)
+
+def pack_store(job_id, base_remote, job_root, cancel_token=None):
+    from pack_store import PackStore
+    return PackStore(RCLONE, base_remote, job_root, PACK_CACHE_DB, cancel_token=cancel_token)
+
+def enforce_retention(base_remote, start_remote_path, policy, job_id=None, snapshot_mode='full',
+                      workers=DEFAULT_PURGE_WORKERS):
+    """
+    Applies the retention policy to Backup_* folders. Returns the RetentionPlan,
+    or None when retention is off or failed.
+    """
+    if not retention_enabled(policy): return None
+    try:
+        root = f"{base_remote}{start_remote_path}"
+        print(f"🧹 Retention Check: {start_remote_path} ({policy})")
+
+        # One listing, keep set computed in memory
+        plan = plan_retention(RCLONE, root, policy)
+        if plan.dry_run:
+            print(f"   📋 Dry run: would purge {len(plan.purge)} folders, reclaiming {parse_rclone_size(plan.reclaim_bytes)}")
+            return plan
+        if not plan.purge:
+            return plan
+
+        # Incremental snapshots reference older folders; move still-needed files forward first.
+        # A job switched back to full mode still has the manifests of its incremental snapshots.
+        catalog = snapshot_catalog(job_id, base_remote, start_remote_path) if job_id else None
+        if catalog and (snapshot_mode == 'incremental' or catalog.has_manifests()):
+            releasable = set(catalog.release(plan.purge, plan.remaining,
+                                             os.path.join(config_dir, f"retention_{job_id}.txt")))
+            for name in plan.purge:
+                if name not in releasable:
+                    plan.keep[name] = ["dependency"]
+            plan.purge = [name for name in plan.purge if name in releasable]
+
+        purged, failed = purge_folders(RCLONE, root, plan.purge, workers)
+        for name in failed:
+            plan.keep[name] = ["purge failed"]
+        plan.purge = purged
+        return plan
     except Exception as e:
         print(f"⚠️ Retention Error: {e}")
+        return None
 
 # --- MAIN LOOP ---
 
+def mark_job_queued(job_id, trigger_type):
+    if trigger_type == "Continuous":
+        return # background pushes do not touch the job's status
+    if trigger_type == "Restore":
+        WRITES.reference(f'runtime_state/{AGENT_ID}/job_states/{job_id}/restore').set({
+            "status": "Queued", "detailed_message": "Waiting for a free worker..."
+        })
+        return
+    WRITES.reference(f'runtime_state/{AGENT_ID}/job_states/{job_id}').update({
+        "status": "Queued", "detailed_message": "Waiting for a free worker..."
+    })
+
+def mark_job_cancelled(job_id, trigger_type):
+    """A queued run was dropped before it started; replaces its "Queued" state."""
+    if trigger_type == "Continuous":
+        return
+    state = {"status": "Cancelled", "detailed_message": "Stopped by administrator before it started"}
+    if trigger_type == "Restore":
+        WRITES.reference(f'runtime_state/{AGENT_ID}/job_states/{job_id}/restore').update(state)
+        return
+    WRITES.reference(f'runtime_state/{AGENT_ID}/job_states/{job_id}').update(state)
+
+def submit_restores(scheduler, pending, jobs, global_config):
+    """Queues restore requests; one whose job is busy stays pending until the job is free."""
+    for request in list(pending):
+        job_id = request.get("job_id")
+        if job_id not in jobs:
+            print(f"⚠️ Restore requested for unknown job {job_id!r}")
+            pending.remove(request)
+        elif scheduler.submit(job_id, dict(jobs[job_id], restore_request=request), global_config, "Restore"):
+            print(f"📥 Restore queued for {job_id}")
+            pending.remove(request)
+
+def heartbeat_loop(stop_event):
+    """Runs on its own thread so a long backup never makes the agent look dead."""
+    while not stop_event.is_set():
+        try:
+            WRITES.reference(f'systems/{AGENT_ID}/heartbeat').set(int(time.time()))
+        except Exception as e:
+            print(f"⚠️ Heartbeat failed: {e}")
+        stop_event.wait(HEARTBEAT_INTERVAL)
+
+def handle_force_stop(scheduler, target):
+    """control/{id}/force_stop: true stops every job, a job id stops just that one."""
+    GOVERNOR.release(RCLONE) # a suspended rclone could not act on the stop
+    stopped = scheduler.cancel(target)
+    if stopped:
+        print(f"🛑 Force stop requested: {', '.join(stopped)}")
+
+def govern(scheduler, global_config):
+    """Resource governor tick: throttles or suspends rclone while the host is busy (global_config `governor`)."""
+    try:
+        level = GOVERNOR.tick(RCLONE, scheduler.running_jobs(), global_config)
+        if level:
+            METRICS.inc("governor_changes_total", level=level)
+    except Exception as e:
+        print(f"⚠️ Governor error: {e}")
+
+def apply_bandwidth(scheduler, jobs, global_config):
+    """Keeps the daemon's bandwidth limit on the timetable of whatever is running (tightest wins)."""
+    global BWLIMIT
+    if not RCLONE.live_bwlimit:
+        return
+    running = scheduler.running_jobs()
+    limits = [schedule_for(jobs.get(job_id, {}), global_config).limit_at() for job_id in running]
+    limits = limits or [schedule_for({}, global_config).limit_at()]
+    limit = tightest_limit(limits + [GOVERNOR.bwlimit]) # the governor's limit while the host is busy
+    if limit != BWLIMIT:
+        try:
+            RCLONE.set_bwlimit(limit)
+            print(f"🚦 Bandwidth limit: {limit}")
+            BWLIMIT = limit
+        except Exception as e:
+            print(f"⚠️ Could not change bandwidth limit: {e}")
+
 def main():
+    startup = PhaseClock(METRICS, "startup_seconds")
+    startup.record("imports", time.perf_counter() - BOOT_STARTED)
+    startup.start("firebase")
+    init_firebase()
+    startup.start("rclone")
     ensure_rclone()
+    start_rclone()
+    probe_rclone_version()
+    startup.start("remote")
     configure_rclone() # Auto-config gdrive
+    startup.start("identity")
     get_or_create_identity()
+    WRITES.start()
+    NOTIFIER.start()
+    startup.start("register")
     register_agent()
+    # Make sure our meta node exists before the kill switch starts watching it.
+    WRITES.flush(timeout=15)
     install_startup()
+
+    startup.start("channel")
+    scheduler = JobScheduler(run_job, on_queued=mark_job_queued, on_cancelled=mark_job_cancelled)
+    timetable = Timetable(SCHEDULE_STATE_FILE, seed=AGENT_ID)
+
+    # Config, jobs and triggers are pushed to us; the loop only reads the local cache.
+    channel = ControlChannel(DATABASE, AGENT_ID,
+                             on_force_stop=lambda target: handle_force_stop(scheduler, target))
+    channel.start()
+    startup.stop()
+    publish_startup_stats(startup)
+
+    stop_heartbeat = threading.Event()
+    threading.Thread(target=heartbeat_loop, args=(stop_heartbeat,), name="heartbeat", daemon=True).start()
+
+    METRICS.add_collector(lambda: {
+        "rclone_processes_spawned": RCLONE.process_count,
+        "rclone_rc_calls": getattr(RCLONE, "calls", 0),
+        "write_queue_backlog": WRITES.backlog,
+        "notification_backlog": NOTIFIER.backlog,
+        "jobs_running": len(scheduler.running_jobs()),
+    })
+    metrics_server = MetricsServer(METRICS)
+    last_stats = time.time()
+    # Restores interrupted by a crash or shutdown continue from their checkpoint journal.
+    pending_restores = []
+    if os.path.isdir(RESTORE_DIR) and os.listdir(RESTORE_DIR):
+        from restore import unfinished_restores
+        pending_restores = unfinished_restores(RESTORE_DIR)
+    # Backup runs cut short the same way are resumed (or cleaned up) once the job list is known.
+    interrupted = interrupted_runs(RUNS_DIR)
+    last_rollup = 0 # first compaction once the channel is up
+    rollup = None
     
     print(f"👀 Agent {AGENT_ID} Active. Waiting for instructions...")
-    
-    # Simple mechanism to prevent double-running in the same minute
-    last_processed_minute = ""
+
 
     while True:
+        loop_started = time.perf_counter()
         try:
             # 1. Existence Check (Kill Switch)
             # If the system node has been deleted by Admin, the agent should decommission itself.
-            system_check = db.reference(f'systems/{AGENT_ID}').get()
-            if system_check is None:
+            # (Ignored while our own registration is still queued.)
+            if channel.system_deleted and WRITES.idle:
                 print(f"⛔ System ID {AGENT_ID} not found in registry (Deleted by Admin).")
                 print("   Agent is decommissioning...")
+                stop_heartbeat.set()
+                channel.stop()
+                GOVERNOR.release(RCLONE)
+                scheduler.shutdown()
+                if CONTINUOUS:
+                    CONTINUOUS.stop()
+                RCLONE.close()
+                # Drop queued writes and remove any heartbeat that raced the deletion (no ghost node).
+                WRITES.discard()
+                DATABASE.delete(f'systems/{AGENT_ID}')
                 sys.exit(0)
 
-            # 2. Heartbeat (Only if system exists)
-            db.reference(f'systems/{AGENT_ID}/heartbeat').set(int(time.time()))
-
-            # 2. Fetch Configuration
-            global_config = db.reference(f'global_config').get() or {}
-            jobs = db.reference(f'configurations/{AGENT_ID}').get() or {}
-
-            # 3. Check Manual Triggers (Control)
-            manual_trigger_job_id = db.reference(f'control/{AGENT_ID}/trigger_now').get()
+            # 2. Configuration (local cache, kept current by the change streams)
+            global_config = channel.global_config
+            jobs = channel.jobs
+            scheduler.configure(global_config)
+            NOTIFIER.configure(global_config)
+
+            # Interrupted runs go first, so a due schedule does not start over what is half done
+            if interrupted and channel.loaded:
+                for journal in interrupted:
+                    job_id = journal.record['job_id']
+                    print(f"♻️ Found interrupted run of {job_id} ({journal.snapshot})")
+                    scheduler.submit(job_id, dict(jobs.get(job_id) or {"name": job_id}, resume_run=journal),
+                                     global_config, "Resume")
+                interrupted = []
+
+            # 3. Scheduled Runs (next-fire-time queue; missed runs are caught up once)
+            timetable.refresh(jobs, global_config)
+            for job_id, nominal in timetable.pop_due():
+                print(f"⏰ Schedule due for {job_id} ({nominal:%Y-%m-%d %H:%M})")
+                if scheduler.submit(job_id, jobs[job_id], global_config, "Scheduled"):
+                    timetable.record_run(job_id, nominal)
+                else:
+                    print(f"   ⏭️ {job_id} is already running, skipping.")
+            govern(scheduler, global_config)
+            apply_bandwidth(scheduler, jobs, global_config)
+
+            # Continuous mode: watchers follow the job list; settled changes go out as small pushes
+            continuous = continuous_protection(jobs)
+            if continuous:
+                continuous.refresh(jobs)
+                for job_id in continuous.ready_jobs():
+                    scheduler.submit(job_id, jobs[job_id], global_config, "Continuous")
+
+            # Restores (control/{id}/restore) wait for the job to be idle, then run on the worker pool
+            while True:
+                request = channel.next_restore()
+                if request is None:
+                    break
+                pending_restores.append(request)
+            submit_restores(scheduler, pending_restores, jobs, global_config)
+
+            # Metrics: loop cost (without the wait below), optional local endpoint, periodic stats node
+            METRICS.observe("loop_iteration_seconds", time.perf_counter() - loop_started, loop="main")
+            metrics_server.configure(global_config.get('metrics_port'))
+            if time.time() - last_stats >= float(global_config.get('stats_interval', STATS_INTERVAL)):
+                last_stats = time.time()
+                publish_agent_stats()
+            rollup_interval = float(global_config.get('log_rollup_interval', DEFAULT_ROLLUP_INTERVAL)) * 3600
+            if (channel.loaded and time.time() - last_rollup >= rollup_interval
+                    and (rollup is None or not rollup.is_alive())):
+                last_rollup = time.time()
+                rollup = threading.Thread(target=compact_logs, args=(global_config,), name="log-rollup", daemon=True)
+                rollup.start()
+
+            # 4. Manual Triggers (Control) - wakes up as soon as one is pushed
+            wait = timetable.seconds_until_next()
+            manual_trigger_job_id = channel.next_trigger(timeout=LOOP_TICK if wait is None else min(LOOP_TICK, wait))
             if manual_trigger_job_id:
-                # Clear trigger immediately to acknowledge
-                db.reference(f'control/{AGENT_ID}/trigger_now').delete()
+                jobs = channel.jobs
+                global_config = channel.global_config
                 if manual_trigger_job_id in jobs:
                     print(f"⚡ Manual Trigger received for {manual_trigger_job_id}")
-                    perform_backup(manual_trigger_job_id, jobs[manual_trigger_job_id], global_config)
+                    scheduler.submit(manual_trigger_job_id, jobs[manual_trigger_job_id], global_config, "Manual")
                 elif manual_trigger_job_id == "ALL":
                     for jid, jconf in jobs.items():
-                        perform_backup(jid, jconf, global_config)
-
-            # 4. Scheduled Checks
-            current_minute = datetime.datetime.now().strftime("%Y-%m-%d %H:%M")
-            if current_minute != last_processed_minute:
-                # New minute, check schedules
-                last_processed_minute = current_minute
-                for job_id, job_config in jobs.items():
-                    schedule = job_config.get('schedule', {})
-                    if check_schedule(schedule):
-                        print(f"⏰ Schedule matched for {job_id}")
-                        perform_backup(job_id, job_config, global_config)
-
-            time.sleep(5)
+                        scheduler.submit(jid, jconf, global_config, "Manual")
 
         except KeyboardInterrupt:
             print("\nExiting...")
+            stop_heartbeat.set()
+            channel.stop()
+            GOVERNOR.release(RCLONE)
+            scheduler.shutdown()
+            if CONTINUOUS:
+                CONTINUOUS.stop()
+            NOTIFIER.stop()
+            metrics_server.stop()
+            RCLONE.close()
+            WRITES.stop()
             sys.exit(0)
         except Exception:
             print(f"Glitch (Unexpected Error):")
             traceback.print_exc()
             time.sleep(10)
 
+def restore_cli(argv):
+    """`agent.py restore <job root> ...`: restore.py's command line with the agent's rclone and remote."""
+    global RCLONE
+    from restore import main as restore_main
+    ensure_rclone()
+    RCLONE = SubprocessBackend(RCLONE_BIN)
+    configure_rclone()
+    return restore_main(argv, rclone=RCLONE)
+
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["restore"]:
+        sys.exit(restore_cli(sys.argv[2:]))
     main()
\ No newline at end of file
@@ -0,0 +1,347 @@
+"""
+Offline benchmark for the backup pipeline.
+
+Runs the real perform_backup() (scan, sync, snapshot, retention) over many
+simulated days against a synthetic source tree, with:
+
+- the database replaced by control_channel.FakeRealtimeDatabase,
+- the "gdrive" remote replaced by an rclone alias to a local directory
+  (private rclone.conf, nothing outside the work directory is touched),
+- a simulated clock, so snapshot names, retention and the weekly full sync
+  behave as they would over real days.
+
+Every day mutates the tree (edits, new files, deletions) and records the
+agent's own per-phase timings (stats/{agent}/jobs/{job}/last_run). The
+results are written as JSON, and --compare prints the change against an
+earlier result file.
+
+    python benchmark.py --files 5000 --days 14 --profile mixed --out before.json
+    python benchmark.py --files 5000 --days 14 --profile mixed --out after.json --compare before.json
+
+Only needs Python and rclone; runs fully offline on Linux.
+"""
+import argparse
+import datetime
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+# Size profiles: log-normal (median bytes, sigma), capped.
+PROFILES = {
+    "small": (4 * 1024, 1.0, 1024 * 1024),
+    "mixed": (32 * 1024, 2.0, 64 * 1024 * 1024),
+    "large": (4 * 1024 * 1024, 1.0, 256 * 1024 * 1024),
+}
+JOB_ID = "bench_job"
+AGENT_ID = "bench-agent"
+PHASES = ("scan", "sync", "snapshot", "verify", "retention", "gc", "fanout", "email")
+
+
+# --- SYNTHETIC TREE ---
+class SyntheticTree:
+    def __init__(self, root, profile, dirs, seed):
+        self.root = root
+        self.median, self.sigma, self.cap = PROFILES[profile]
+        self.dirs = max(1, dirs)
+        self.rng = random.Random(seed)
+        self.files = []
+        self.counter = 0
+
+    def _size(self):
+        return min(self.cap, int(self.rng.lognormvariate(math.log(self.median), self.sigma)))
+
+    def _write(self, rel, size):
+        path = os.path.join(self.root, rel)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            remaining = size
+            while remaining:
+                block = min(remaining, 4 * 1024 * 1024)
+                f.write(self.rng.randbytes(block))
+                remaining -= block
+        return size
+
+    def add(self):
+        d = self.rng.randrange(self.dirs)
+        rel = f"dir_{d // 10:03d}/sub_{d:04d}/file_{self.counter:07d}.dat"
+        self.counter += 1
+        self.files.append(rel)
+        return self._write(rel, self._size())
+
+    def edit(self):
+        rel = self.rng.choice(self.files)
+        path = os.path.join(self.root, rel)
+        size = os.path.getsize(path)
+        patch = self.rng.randbytes(min(64 * 1024, max(1, size // 10)))
+        with open(path, "r+b") as f:
+            if self.rng.random() < 0.3: # append, like a growing ledger
+                f.seek(0, os.SEEK_END)
+            else:
+                f.seek(self.rng.randrange(max(1, size)))
+            f.write(patch)
+        return len(patch)
+
+    def delete(self):
+        rel = self.files.pop(self.rng.randrange(len(self.files)))
+        os.remove(os.path.join(self.root, rel))
+
+    def generate(self, count):
+        return sum(self.add() for _ in range(count))
+
+    def mutate(self, change_rate, add_rate, delete_rate):
+        n = len(self.files)
+        counts = {
+            "edited": min(n, int(round(n * change_rate))),
+            "added": int(round(n * add_rate)),
+            "deleted": min(max(0, n - 1), int(round(n * delete_rate))),
+        }
+        for _ in range(counts["deleted"]):
+            self.delete()
+        for _ in range(counts["edited"]):
+            self.edit()
+        for _ in range(counts["added"]):
+            self.add()
+        return counts
+
+
+# --- SIMULATED CLOCK ---
+class SimulatedClock:
+    """Replaces datetime.datetime.now() in the agent modules with simulated day + real elapsed time."""
+
+    def __init__(self, start):
+        self.day_start = start
+        self.real_start = time.monotonic()
+
+    def set_day(self, when):
+        self.day_start = when
+        self.real_start = time.monotonic()
+
+    def now(self):
+        return self.day_start + datetime.timedelta(seconds=time.monotonic() - self.real_start)
+
+    def install(self, modules):
+        clock = self
+
+        class SimulatedDateTime(datetime.datetime):
+            @classmethod
+            def now(cls, tz=None):
+                value = clock.now()
+                return cls(value.year, value.month, value.day, value.hour, value.minute,
+                           value.second, value.microsecond)
+
+        shim = types.SimpleNamespace(**{name: getattr(datetime, name) for name in dir(datetime)
+                                        if not name.startswith("_")})
+        shim.datetime = SimulatedDateTime
+        for module in modules:
+            module.datetime = shim
+
+
+def tree_size(root):
+    files, total = 0, 0
+    for dirpath, _, names in os.walk(root):
+        for name in names:
+            files += 1
+            total += os.path.getsize(os.path.join(dirpath, name))
+    return files, total
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * pct / 100.0
+    low, high = math.floor(k), math.ceil(k)
+    return values[low] + (values[high] - values[low]) * (k - low)
+
+
+# --- RUN ---
+def run(args):
+    workdir = os.path.abspath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix="backup_bench_")
+    home = os.path.join(workdir, "home")
+    source = os.path.join(workdir, "source")
+    remote = os.path.join(workdir, "remote")
+    for path in (home, source, remote):
+        os.makedirs(path, exist_ok=True)
+
+    # Private state: config_dir follows HOME / APPDATA, rclone reads RCLONE_CONFIG.
+    os.environ["HOME"] = home
+    os.environ["APPDATA"] = home
+    rclone_conf = os.path.join(workdir, "rclone.conf")
+    with open(rclone_conf, "w") as f:
+        f.write(f"[gdrive]\ntype = alias\nremote = {remote}\n")
+    os.environ["RCLONE_CONFIG"] = rclone_conf
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import agent
+    import file_index
+    import retention
+    import snapshots
+    from control_channel import FakeRealtimeDatabase
+
+    clock = SimulatedClock(datetime.datetime.combine(datetime.date(2024, 1, 1), datetime.time(21, 0)))
+    clock.install([agent, file_index, retention, snapshots])
+
+    agent.DATABASE = FakeRealtimeDatabase()
+    agent.AGENT_ID = AGENT_ID
+    agent.RCLONE_MODE = args.rclone_mode
+    agent.ensure_rclone()
+    agent.start_rclone()
+    agent.WRITES.start()
+
+    job_config = {
+        "name": "Benchmark",
+        "source_path": source,
+        "remote_folder": "Backups",
+        "engine": args.engine,
+        "snapshot_mode": args.snapshot_mode,
+        "retention": {"keep_daily_days": args.keep_daily, "keep_weekly_weeks": args.keep_weekly},
+    }
+    if args.destinations > 1:
+        # Fan-out: the aliased "gdrive" remote plus plain local directories (e.g. a NAS share)
+        job_config["destinations"] = [{"id": "drive"}] + [
+            {"id": f"local{n}", "remote": os.path.join(workdir, f"local{n}")} for n in range(1, args.destinations)]
+    global_config = {"progress_interval": 5}
+
+    print(f"🧪 Generating {args.files} files ({args.profile}) in {source}")
+    tree = SyntheticTree(source, args.profile, args.dirs, args.seed)
+    generated = tree.generate(args.files)
+    print(f"   {generated / 1024 / 1024:.1f} MiB")
+
+    days = []
+    try:
+        for day in range(args.days):
+            clock.set_day(datetime.datetime.combine(datetime.date(2024, 1, 1) + datetime.timedelta(days=day),
+                                                    datetime.time(21, 0)))
+            changes = tree.mutate(args.change_rate, args.add_rate, args.delete_rate) if day else \
+                {"edited": 0, "added": args.files, "deleted": 0}
+            processes_before = agent.RCLONE.process_count
+            calls_before = getattr(agent.RCLONE, "calls", 0)
+
+            start = time.perf_counter()
+            agent.perform_backup(JOB_ID, job_config, global_config)
+            total = time.perf_counter() - start
+            agent.WRITES.flush(timeout=30)
+            state = agent.DATABASE.get(f"runtime_state/{AGENT_ID}/job_states/{JOB_ID}") or {}
+            last_run = agent.DATABASE.get(f"stats/{AGENT_ID}/jobs/{JOB_ID}/last_run") or {}
+            phases = last_run.get("phases") or {}
+
+            remote_files, remote_bytes = tree_size(remote)
+            record = {
+                "day": day,
+                "date": clock.day_start.strftime("%Y-%m-%d"),
+                "changes": changes,
+                "status": state.get("status"),
+                "message": state.get("detailed_message"),
+                "total_s": round(total, 4),
+                "phases": {phase: phases.get(phase, 0.0) for phase in PHASES},
+                "uploaded_bytes": last_run.get("bytes"),
+                "rclone_processes": agent.RCLONE.process_count - processes_before,
+                "rc_calls": getattr(agent.RCLONE, "calls", 0) - calls_before,
+                "remote_files": remote_files,
+                "remote_bytes": remote_bytes,
+            }
+            if args.destinations > 1:
+                record["destinations"] = {dest_id: (dest or {}).get("status")
+                                          for dest_id, dest in (state.get("destinations") or {}).items()}
+            days.append(record)
+            print(f"📅 Day {day:3d} {record['status']}: {total:7.2f}s "
+                  + " ".join(f"{p}={record['phases'][p]:.2f}" for p in PHASES)
+                  + f" remote={remote_bytes / 1024 / 1024:.1f}MiB")
+    finally:
+        agent.WRITES.stop()
+        agent.RCLONE.close()
+        if not args.workdir and not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "config": vars(args),
+        "environment": environment(agent.RCLONE_BIN, agent.RCLONE.mode),
+        "days": days,
+        "summary": summarize(days),
+    }
+
+
+def environment(rclone_bin, rclone_mode):
+    try:
+        version = subprocess.run([rclone_bin, "version"], capture_output=True, text=True).stdout.splitlines()[0]
+    except (OSError, IndexError):
+        version = None
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "rclone": version,
+        "rclone_mode": rclone_mode,
+        "timestamp": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+    }
+
+
+def summarize(days):
+    incremental = [d for d in days[1:] if d["status"] == "Success"]
+    summary = {
+        "failures": sum(1 for d in days if d["status"] != "Success"),
+        "total_s": round(sum(d["total_s"] for d in days), 4),
+        "first_run_s": days[0]["total_s"] if days else None,
+        "incremental_mean_s": round(sum(d["total_s"] for d in incremental) / len(incremental), 4) if incremental else None,
+        "incremental_p95_s": percentile([d["total_s"] for d in incremental], 95),
+        "rclone_processes": sum(d["rclone_processes"] for d in days),
+        "rc_calls": sum(d["rc_calls"] for d in days),
+        "final_remote_bytes": days[-1]["remote_bytes"] if days else None,
+    }
+    for phase in PHASES:
+        values = [d["phases"][phase] for d in incremental]
+        summary[f"{phase}_mean_s"] = round(sum(values) / len(values), 4) if values else None
+    return summary
+
+
+def compare(current, baseline):
+    print("\n📊 Compared with baseline:")
+    for key, value in current["summary"].items():
+        old = baseline.get("summary", {}).get(key)
+        if not isinstance(value, (int, float)) or not isinstance(old, (int, float)):
+            continue
+        change = f"{100.0 * (value - old) / old:+.1f}%" if old else "n/a"
+        print(f"   {key:24s} {old:>14.4f} -> {value:>14.4f}  ({change})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the backup pipeline.")
+    parser.add_argument("--files", type=int, default=2000, help="files in the initial tree")
+    parser.add_argument("--dirs", type=int, default=50, help="leaf directories to spread files over")
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="mixed", help="file size distribution")
+    parser.add_argument("--days", type=int, default=7, help="simulated days (day 0 is the first full backup)")
+    parser.add_argument("--change-rate", type=float, default=0.02, help="fraction of files edited per day")
+    parser.add_argument("--add-rate", type=float, default=0.005, help="fraction of files added per day")
+    parser.add_argument("--delete-rate", type=float, default=0.002, help="fraction of files deleted per day")
+    parser.add_argument("--engine", choices=["rclone", "chunked", "packed"], default="rclone")
+    parser.add_argument("--snapshot-mode", choices=["full", "incremental"], default="full")
+    parser.add_argument("--keep-daily", type=int, default=7, help="retention: keep_daily_days")
+    parser.add_argument("--keep-weekly", type=int, default=4, help="retention: keep_weekly_weeks")
+    parser.add_argument("--destinations", type=int, default=1, help="destinations per job (extra ones are local directories)")
+    parser.add_argument("--rclone-mode", choices=["rcd", "subprocess"], default="rcd")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--workdir", help="work directory (kept); default is a temp dir removed afterwards")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary work directory")
+    parser.add_argument("--out", default="benchmark_results.json", help="JSON results file")
+    parser.add_argument("--compare", help="earlier results file to compare with")
+    args = parser.parse_args()
+
+    results = run(args)
+    with open(args.out, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\n💾 Results written to {args.out}")
+    if args.compare:
+        with open(args.compare, "r") as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,15 @@
+import argparse
 import os
 import subprocess
 import sys
 import shutil
 
-def build():
-    print("🚀 Building Kriplani Backup Agent for Windows (Offline Bundle)...")
+def build(onedir=False):
+    """
+    onefile (default): a single .exe that unpacks itself to a temp folder on every launch.
+    onedir: a folder with the .exe and its files already unpacked (faster start), zipped for distribution.
+    """
+    print(f"🚀 Building Kriplani Backup Agent for Windows (Offline Bundle, {'onedir' if onedir else 'onefile'})...")
     
     # 1. Check for Credentials
     if not os.path.exists("serviceAccountKey.json"):
@@ -25,14 +30,17 @@ def build():
     # Bundle both the Key and the Rclone binary
     separator = ";" if os.name == 'nt' else ":"
     
+    name = "KriplaniBackupAgent" if onedir else "KriplaniBackupAgent_Installer"
     cmd = [
         "pyinstaller",
         "--noconfirm",
-        "--onefile",
+        "--onedir" if onedir else "--onefile",
         "--noconsole", 
-        "--name", "KriplaniBackupAgent_Installer",
+        "--name", name,
         f"--add-data", f"serviceAccountKey.json{separator}.",
         f"--add-data", f"rclone.exe{separator}.",
+        # Not used by the agent; keeps the bundle (and its unpack time) smaller
+        "--exclude-module", "tkinter",
         "agent.py"
     ]
     
@@ -40,8 +48,17 @@ def build():
     subprocess.check_call(cmd)
     
     print("\n✅ Build Complete!")
-    print(f"📂 Output: {os.path.abspath('dist/KriplaniBackupAgent_Installer.exe')}")
-    print("👉 This .exe now contains Rclone inside it. No internet validation required on client.")
+    if onedir:
+        archive = shutil.make_archive(os.path.join("dist", name), "zip", "dist", name)
+        print(f"📂 Output: {os.path.abspath(os.path.join('dist', name, name + '.exe'))}")
+        print(f"📦 Archive: {os.path.abspath(archive)}")
+        print("👉 Extract the whole folder on the client (e.g. to %LOCALAPPDATA%) and run the .exe from there.")
+    else:
+        print(f"📂 Output: {os.path.abspath('dist/KriplaniBackupAgent_Installer.exe')}")
+        print("👉 This .exe now contains Rclone inside it. No internet validation required on client.")
 
 if __name__ == "__main__":
-    build()
+    parser = argparse.ArgumentParser(description="Build the Windows agent with PyInstaller.")
+    parser.add_argument("--onedir", action="store_true",
+                        help="build an unpacked folder instead of a single .exe (faster start-up)")
+    build(parser.parse_args().onedir)
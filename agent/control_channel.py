@@ -0,0 +1,382 @@
+"""
+Push-based control plane for the backup agent.
+
+Instead of re-reading systems/, global_config, configurations/ and control/
+every few seconds, the agent opens one change stream per node and keeps an
+in-memory copy that the main loop reads for free. Manual triggers are handed
+over the moment they arrive. If a stream drops, that node is polled with
+exponential backoff until a listener can be re-established.
+
+The database is reached through a small backend interface (get / set /
+update / delete / listen) so the same logic runs against Firebase or against
+FakeRealtimeDatabase for local testing.
+"""
+import copy
+import queue
+import threading
+import time
+
+
+# --- PATH HELPERS ---
+def _split(path):
+    return [p for p in str(path).split("/") if p]
+
+
+def _get_in(tree, parts):
+    node = tree
+    for part in parts:
+        if not isinstance(node, dict) or part not in node:
+            return None
+        node = node[part]
+    return node
+
+
+def _set_in(tree, parts, value):
+    """Returns a new tree with value stored at parts (None deletes)."""
+    if not parts:
+        return _prune(copy.deepcopy(value))
+    tree = dict(tree) if isinstance(tree, dict) else {}
+    head, rest = parts[0], parts[1:]
+    child = _set_in(tree.get(head), rest, value)
+    if child is None:
+        tree.pop(head, None)
+    else:
+        tree[head] = child
+    return tree or None
+
+
+def _prune(value):
+    """RTDB semantics: empty dicts and None children do not exist."""
+    if isinstance(value, dict):
+        pruned = {k: _prune(v) for k, v in value.items()}
+        pruned = {k: v for k, v in pruned.items() if v is not None}
+        return pruned or None
+    return value
+
+
+def apply_event(tree, event_type, path, data):
+    """Applies an RTDB stream event ('put' / 'patch') to a cached tree."""
+    parts = _split(path)
+    if event_type == "put":
+        return _set_in(tree, parts, data)
+    if event_type == "patch":
+        for key, value in (data or {}).items():
+            tree = _set_in(tree, parts + _split(key), value)
+        return tree
+    return tree
+
+
+# --- BACKENDS ---
+class FirebaseBackend:
+    """Backend on top of firebase_admin.db (must already be initialised)."""
+
+    def __init__(self):
+        from firebase_admin import db
+        self._db = db
+
+    def get(self, path):
+        return self._db.reference(path).get()
+
+    def set(self, path, value):
+        self._db.reference(path).set(value)
+
+    def update(self, path, values):
+        self._db.reference(path).update(values)
+
+    def delete(self, path):
+        self._db.reference(path).delete()
+
+    def listen(self, path, callback):
+        registration = self._db.reference(path).listen(
+            lambda event: callback(event.event_type, event.path, event.data)
+        )
+        return _FirebaseListener(registration)
+
+
+class _FirebaseListener:
+    def __init__(self, registration):
+        self._registration = registration
+
+    def is_alive(self):
+        # firebase_admin gives up silently once its SSE thread dies.
+        thread = getattr(self._registration, "_thread", None)
+        return thread is None or thread.is_alive()
+
+    def close(self):
+        try:
+            self._registration.close()
+        except Exception:
+            pass
+
+
+class FakeRealtimeDatabase:
+    """
+    In-memory stand-in for the Realtime Database.
+    Delivers 'put' / 'patch' events to listeners the same way the SSE stream
+    does, and can simulate a dropped connection with disconnect().
+    """
+
+    def __init__(self, data=None):
+        self._data = _prune(copy.deepcopy(data)) if data else None
+        self._lock = threading.RLock()
+        self._listeners = []
+        self.reads = 0
+        self.offline = False
+
+    def get(self, path):
+        with self._lock:
+            self._check_online()
+            self.reads += 1
+            return copy.deepcopy(_get_in(self._data, _split(path)))
+
+    def set(self, path, value):
+        self._write(path, "put", value)
+
+    def update(self, path, values):
+        self._write(path, "patch", values)
+
+    def delete(self, path):
+        self._write(path, "put", None)
+
+    def listen(self, path, callback):
+        with self._lock:
+            self._check_online()
+            listener = _FakeListener(self, _split(path), callback)
+            self._listeners.append(listener)
+            snapshot = copy.deepcopy(_get_in(self._data, listener.parts))
+        callback("put", "/", snapshot)
+        return listener
+
+    def disconnect(self):
+        """Kills every open stream and refuses new ones until reconnect()."""
+        with self._lock:
+            self.offline = True
+            for listener in self._listeners:
+                listener.alive = False
+            self._listeners = []
+
+    def reconnect(self):
+        with self._lock:
+            self.offline = False
+
+    def _check_online(self):
+        if self.offline:
+            raise ConnectionError("FakeRealtimeDatabase is offline")
+
+    def _write(self, path, event_type, value):
+        parts = _split(path)
+        with self._lock:
+            self._check_online()
+            self._data = apply_event(self._data, event_type, path, value)
+            deliveries = []
+            for listener in list(self._listeners):
+                lp = listener.parts
+                if parts[:len(lp)] == lp:
+                    rel = "/" + "/".join(parts[len(lp):])
+                    deliveries.append((listener, event_type, rel, copy.deepcopy(value)))
+                elif lp[:len(parts)] == parts:
+                    deliveries.append((listener, "put", "/", copy.deepcopy(_get_in(self._data, lp))))
+        for listener, etype, rel, data in deliveries:
+            if listener.alive:
+                listener.callback(etype, rel, data)
+
+
+class _FakeListener:
+    def __init__(self, db, parts, callback):
+        self._db = db
+        self.parts = parts
+        self.callback = callback
+        self.alive = True
+
+    def is_alive(self):
+        return self.alive
+
+    def close(self):
+        self.alive = False
+        with self._db._lock:
+            if self in self._db._listeners:
+                self._db._listeners.remove(self)
+
+
+# --- CONTROL CHANNEL ---
+class _WatchedNode:
+    def __init__(self, key, path):
+        self.key = key
+        self.path = path
+        self.listener = None
+        self.loaded = False
+        self.next_poll = 0
+        self.backoff = 0
+
+
+class ControlChannel:
+    """
+    Keeps systems/{id}/meta, global_config, configurations/{id} and
+    control/{id} mirrored locally and queues manual triggers as they arrive.
+    A `force_stop` flag (true, or a job id) is passed to on_force_stop straight
+    from the stream thread so running jobs can be cancelled without waiting
+    for the main loop. A `restore` request (a dict, see restore.py) is queued
+    for the main loop like a trigger.
+    """
+
+    def __init__(self, backend, agent_id, poll_interval=5, max_backoff=300, on_force_stop=None):
+        self.backend = backend
+        self.agent_id = agent_id
+        self.on_force_stop = on_force_stop
+        self.poll_interval = poll_interval
+        self.max_backoff = max_backoff
+
+        self._lock = threading.RLock()
+        self._cache = {}
+        self._triggers = queue.Queue()
+        self._restores = queue.Queue()
+        self._changed = threading.Event()
+        self._stop = threading.Event()
+        self._watchdog = None
+        self._nodes = [
+            _WatchedNode("meta", f"systems/{agent_id}/meta"),
+            _WatchedNode("global_config", "global_config"),
+            _WatchedNode("jobs", f"configurations/{agent_id}"),
+            _WatchedNode("control", f"control/{agent_id}"),
+        ]
+
+    # --- lifecycle ---
+    def start(self):
+        for node in self._nodes:
+            self._connect(node)
+        self._watchdog = threading.Thread(target=self._watch, name="control-watchdog", daemon=True)
+        self._watchdog.start()
+
+    def stop(self):
+        self._stop.set()
+        for node in self._nodes:
+            if node.listener:
+                node.listener.close()
+                node.listener = None
+
+    # --- cached views ---
+    @property
+    def system_deleted(self):
+        """True only once we have positively seen the system node disappear."""
+        node = self._node("meta")
+        with self._lock:
+            return node.loaded and self._cache.get("meta") is None
+
+    @property
+    def global_config(self):
+        with self._lock:
+            return copy.deepcopy(self._cache.get("global_config") or {})
+
+    @property
+    def jobs(self):
+        with self._lock:
+            return copy.deepcopy(self._cache.get("jobs") or {})
+
+    @property
+    def control(self):
+        with self._lock:
+            return copy.deepcopy(self._cache.get("control") or {})
+
+    @property
+    def loaded(self):
+        """True once every node has been read at least once (jobs are known)."""
+        return all(n.loaded for n in self._nodes)
+
+    @property
+    def streaming(self):
+        return all(n.listener is not None and n.listener.is_alive() for n in self._nodes)
+
+    def next_trigger(self, timeout=None):
+        """Blocks until a manual trigger arrives (job id or "ALL"), or returns None on timeout."""
+        try:
+            return self._triggers.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def next_restore(self):
+        """Returns the next queued restore request, or None."""
+        try:
+            return self._restores.get_nowait()
+        except queue.Empty:
+            return None
+
+    def wait_for_change(self, timeout=None):
+        """Blocks until any cached node changes. Returns True if something changed."""
+        changed = self._changed.wait(timeout)
+        self._changed.clear()
+        return changed
+
+    # --- internals ---
+    def _node(self, key):
+        return next(n for n in self._nodes if n.key == key)
+
+    def _connect(self, node):
+        try:
+            node.listener = self.backend.listen(
+                node.path, lambda etype, path, data, n=node: self._on_event(n, etype, path, data)
+            )
+            node.backoff = 0
+            return True
+        except Exception as e:
+            print(f"⚠️ Stream for {node.path} unavailable ({e}). Falling back to polling.")
+            node.listener = None
+            return False
+
+    def _on_event(self, node, event_type, path, data):
+        with self._lock:
+            self._cache[node.key] = apply_event(self._cache.get(node.key), event_type, path, data)
+            node.loaded = True
+        self._changed.set()
+        if node.key == "control":
+            stop = self._consume_flag("force_stop")
+            if stop and self.on_force_stop:
+                self.on_force_stop(None if stop is True else stop)
+            trigger = self._consume_flag("trigger_now")
+            if trigger:
+                self._triggers.put(trigger)
+            restore = self._consume_flag("restore")
+            if isinstance(restore, dict):
+                self._restores.put(restore)
+
+    def _consume_flag(self, name):
+        """Reads and clears a one-shot control flag. Returns its value, or None."""
+        with self._lock:
+            value = (self._cache.get("control") or {}).get(name)
+            if not value:
+                return None
+            # Acknowledge locally first so the echo of our own delete is a no-op.
+            self._cache["control"] = _set_in(self._cache.get("control"), [name], None)
+        try:
+            self.backend.delete(f"control/{self.agent_id}/{name}")
+        except Exception as e:
+            print(f"⚠️ Failed to clear {name}: {e}")
+        return value
+
+    def _poll(self, node):
+        try:
+            data = self.backend.get(node.path)
+            self._on_event(node, "put", "/", data)
+            return True
+        except Exception as e:
+            print(f"⚠️ Poll of {node.path} failed: {e}")
+            return False
+
+    def _watch(self):
+        """Detects dead streams and polls those nodes with exponential backoff until they reconnect."""
+        while not self._stop.wait(1):
+            now = time.monotonic()
+            for node in self._nodes:
+                if node.listener is not None and node.listener.is_alive():
+                    continue
+                if now < node.next_poll:
+                    continue
+                if node.listener is not None:
+                    print(f"📴 Stream for {node.path} dropped.")
+                    node.listener.close()
+                    node.listener = None
+                ok = self._poll(node) and self._connect(node)
+                if ok:
+                    print(f"📶 Stream for {node.path} restored.")
+                    continue
+                node.backoff = min(self.max_backoff, (node.backoff * 2) or self.poll_interval)
+                node.next_poll = now + node.backoff
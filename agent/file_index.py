@@ -0,0 +1,186 @@
+"""
+Local file-state index used to avoid needless rclone work.
+
+For every job we remember (path, size, mtime, optional hash) of each file as
+it was after the last successful sync, in a small SQLite database next to
+agent_identity.json. Before a run the source tree is walked locally and
+diffed against that state:
+
+- nothing changed          -> the sync can be skipped entirely
+- some files changed       -> rclone only needs those paths (--files-from)
+- no usable previous state -> fall back to a full sync
+
+A full sync is still forced every `full_sync_days` so that anything changed
+on the remote side behind our back is eventually repaired.
+"""
+import datetime
+import hashlib
+import os
+import sqlite3
+import threading
+
+DEFAULT_FULL_SYNC_DAYS = 7
+HASH_BLOCK = 1024 * 1024
+
+
+def hash_file(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def scan_tree(source_path):
+    """Returns {relative/posix/path: (size, mtime_ns)} for every regular file under source_path."""
+    entries = {}
+    stack = [source_path]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            st = entry.stat(follow_symlinks=False)
+                            rel = os.path.relpath(entry.path, source_path).replace(os.sep, "/")
+                            entries[rel] = (st.st_size, st.st_mtime_ns)
+                    except OSError:
+                        continue
+        except OSError:
+            continue
+    return entries
+
+
+class ScanResult:
+    def __init__(self, job_id, source_path, destination, entries, changed, deleted, full_sync, hashes):
+        self.job_id = job_id
+        self.source_path = source_path
+        self.destination = destination
+        self.entries = entries # {path: (size, mtime_ns)} of the whole tree
+        self.changed = changed # new or modified paths
+        self.deleted = deleted # paths gone since the last run
+        self.full_sync = full_sync
+        self.hashes = hashes # {path: sha1} when hashing is enabled
+
+    @property
+    def has_changes(self):
+        return bool(self.changed or self.deleted)
+
+    @property
+    def changed_bytes(self):
+        return sum(self.entries[p][0] for p in self.changed if p in self.entries)
+
+    def write_files_from(self, list_path):
+        """Writes changed + deleted paths in rclone --files-from format."""
+        with open(list_path, "w", encoding="utf-8") as f:
+            for path in sorted(self.changed + self.deleted):
+                f.write(path + "\n")
+        return list_path
+
+
+class FileIndex:
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS files (
+                job_id TEXT NOT NULL, path TEXT NOT NULL,
+                size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, hash TEXT,
+                PRIMARY KEY (job_id, path))""")
+            conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY, source_path TEXT, destination TEXT,
+                last_full_sync TEXT)""")
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def _load(self, conn, job_id):
+        rows = conn.execute("SELECT path, size, mtime_ns, hash FROM files WHERE job_id = ?", (job_id,))
+        return {path: (size, mtime_ns, digest) for path, size, mtime_ns, digest in rows}
+
+    def diff(self, job_id, source_path, destination, hash_files=False, full_sync_days=DEFAULT_FULL_SYNC_DAYS,
+             base=None):
+        """
+        Walks source_path and compares it with the state recorded after the last sync.
+        With base (a ScanResult of the same tree, e.g. for another destination of
+        the job) the walk and any hashes already computed are reused.
+        """
+        entries = base.entries if base is not None else scan_tree(source_path)
+        computed = base.hashes if base is not None else {}
+        with self._lock, self._connect() as conn:
+            known = self._load(conn, job_id)
+            job = conn.execute("SELECT source_path, destination, last_full_sync FROM jobs WHERE job_id = ?",
+                               (job_id,)).fetchone()
+
+        full_sync = job is None or job[0] != source_path or job[1] != destination
+        if not full_sync and full_sync_days:
+            try:
+                last_full = datetime.datetime.strptime(job[2], "%Y-%m-%d %H:%M:%S")
+                full_sync = (datetime.datetime.now() - last_full).days >= int(full_sync_days)
+            except (TypeError, ValueError):
+                full_sync = True
+
+        changed, hashes = [], {}
+        for path, (size, mtime_ns) in entries.items():
+            previous = known.get(path)
+            if previous and previous[0] == size and previous[1] == mtime_ns:
+                if previous[2]:
+                    hashes[path] = previous[2]
+                continue
+            if hash_files:
+                try:
+                    hashes[path] = computed.get(path) or hash_file(os.path.join(source_path, path))
+                except OSError:
+                    changed.append(path)
+                    continue
+                # Touched but identical content (e.g. Tally re-saving an unchanged file)
+                if previous and previous[0] == size and previous[2] == hashes[path]:
+                    continue
+            changed.append(path)
+        deleted = [p for p in known if p not in entries]
+
+        return ScanResult(job_id, source_path, destination, entries, changed, deleted, full_sync, hashes)
+
+    def commit(self, scan):
+        """Records the scanned state as synced. Call only after rclone succeeded."""
+        rows = [(scan.job_id, path, size, mtime_ns, scan.hashes.get(path))
+                for path, (size, mtime_ns) in scan.entries.items()]
+        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with self._lock, self._connect() as conn:
+            conn.execute("DELETE FROM files WHERE job_id = ?", (scan.job_id,))
+            conn.executemany("INSERT INTO files (job_id, path, size, mtime_ns, hash) VALUES (?, ?, ?, ?, ?)", rows)
+            if scan.full_sync:
+                conn.execute("INSERT OR REPLACE INTO jobs (job_id, source_path, destination, last_full_sync) "
+                             "VALUES (?, ?, ?, ?)", (scan.job_id, scan.source_path, scan.destination, now))
+
+    def paths_under(self, job_id, directory):
+        """Recorded paths below a directory (e.g. one that was just deleted)."""
+        prefix = directory.rstrip("/") + "/"
+        with self._lock, self._connect() as conn:
+            rows = conn.execute("SELECT path FROM files WHERE job_id = ? AND substr(path, 1, ?) = ?",
+                                (job_id, len(prefix), prefix))
+            return [row[0] for row in rows]
+
+    def commit_paths(self, job_id, entries, deleted):
+        """
+        Records single files as synced (continuous mode) without touching the
+        rest of the job's state. entries is {path: (size, mtime_ns)}.
+        """
+        with self._lock, self._connect() as conn:
+            conn.executemany("INSERT OR REPLACE INTO files (job_id, path, size, mtime_ns, hash) VALUES (?, ?, ?, ?, NULL)",
+                             [(job_id, path, size, mtime_ns) for path, (size, mtime_ns) in entries.items()])
+            conn.executemany("DELETE FROM files WHERE job_id = ? AND path = ?", [(job_id, path) for path in deleted])
+
+    def forget_paths(self, job_id, paths):
+        """Drops single files so the next run treats them as changed (e.g. after a failed verification)."""
+        with self._lock, self._connect() as conn:
+            conn.executemany("DELETE FROM files WHERE job_id = ? AND path = ?", [(job_id, path) for path in paths])
+
+    def forget(self, job_id):
+        """Drops a job's state so its next run does a full sync."""
+        with self._lock, self._connect() as conn:
+            conn.execute("DELETE FROM files WHERE job_id = ?", (job_id,))
+            conn.execute("DELETE FROM jobs WHERE job_id = ?", (job_id,))
@@ -0,0 +1,196 @@
+"""
+Incremental integrity verification of Current_Mirror.
+
+A full `rclone check` re-reads every source file and lists every remote
+hash each night. Instead, a local hash manifest (SQLite, next to the file
+index) remembers the hash of every source file together with the size and
+mtime it was computed at, so only new or modified files are hashed again.
+
+Each run then:
+
+1. lists the mirror once, with hashes (one recursive lsjson),
+2. checks every file that is not verified yet (new, changed, or a past
+   failure) plus a random sample of already verified files, so silent
+   corruption of old data is caught over time,
+3. records the result. Mismatched remote copies are deleted and dropped
+   from the file index, so the next run uploads them again (`repair`).
+
+Policy (job `verify`, falling back to global_config `verification`):
+
+    enabled         default true
+    hash_type       md5 (default), sha1 or sha256; must be supported by the remote
+    sample_percent  share of verified files re-checked per run (default 1)
+    sample_min      at least this many (default 20)
+    repair          re-upload mismatched files on the next run (default true)
+"""
+import datetime
+import hashlib
+import math
+import os
+import random
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+HASH_TYPES = ("md5", "sha1", "sha256")
+HASH_BLOCK = 1024 * 1024
+HASH_WORKERS = 4
+DEFAULT_SAMPLE_PERCENT = 1
+DEFAULT_SAMPLE_MIN = 20
+MAX_REPORTED = 20 # problem paths listed in job_states
+
+
+def hash_file(path, hash_type):
+    h = hashlib.new(hash_type)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def verify_policy(job_config, global_config):
+    policy = dict(global_config.get("verification") or {})
+    policy.update(job_config.get("verify") or {})
+    hash_type = str(policy.get("hash_type", "md5")).lower()
+    if hash_type not in HASH_TYPES:
+        print(f"⚠️ Unsupported verification hash_type {hash_type!r}, using md5")
+        hash_type = "md5"
+    return {
+        "enabled": bool(policy.get("enabled", True)),
+        "hash_type": hash_type,
+        "sample_percent": float(policy.get("sample_percent", DEFAULT_SAMPLE_PERCENT)),
+        "sample_min": int(policy.get("sample_min", DEFAULT_SAMPLE_MIN)),
+        "repair": bool(policy.get("repair", True)),
+    }
+
+
+class HashManifest:
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS hashes (
+                job_id TEXT NOT NULL, path TEXT NOT NULL,
+                size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL,
+                hash_type TEXT NOT NULL, hash TEXT NOT NULL, verified TEXT,
+                PRIMARY KEY (job_id, path))""")
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def refresh(self, job_id, source_path, entries, hash_type, cancel_token=None):
+        """
+        Brings the manifest in line with entries ({path: (size, mtime_ns)}),
+        hashing only new or modified files. Returns ({path: (hash, verified)},
+        number of files hashed).
+        """
+        with self._lock, self._connect() as conn:
+            rows = conn.execute("SELECT path, size, mtime_ns, hash_type, hash, verified FROM hashes WHERE job_id = ?",
+                                (job_id,)).fetchall()
+        known = {row[0]: row[1:] for row in rows}
+        stale = [path for path, (size, mtime_ns) in entries.items()
+                 if path not in known or known[path][:3] != (size, mtime_ns, hash_type)]
+
+        def compute(path):
+            if cancel_token is not None:
+                cancel_token.check()
+            full = os.path.join(source_path, *path.split("/"))
+            try:
+                digest = hash_file(full, hash_type)
+                st = os.stat(full)
+            except OSError:
+                return path, None
+            if (st.st_size, st.st_mtime_ns) != tuple(entries[path]):
+                return path, None # changed while we read it; hashed again next run
+            return path, digest
+
+        fresh = {}
+        with ThreadPoolExecutor(max_workers=HASH_WORKERS) as pool:
+            for path, digest in pool.map(compute, stale):
+                if digest is not None:
+                    fresh[path] = digest
+
+        gone = [path for path in known if path not in entries]
+        with self._lock, self._connect() as conn:
+            conn.executemany("DELETE FROM hashes WHERE job_id = ? AND path = ?",
+                             [(job_id, path) for path in gone + [p for p in stale if p not in fresh]])
+            conn.executemany("INSERT OR REPLACE INTO hashes (job_id, path, size, mtime_ns, hash_type, hash, verified) "
+                             "VALUES (?, ?, ?, ?, ?, ?, NULL)",
+                             [(job_id, path, entries[path][0], entries[path][1], hash_type, digest)
+                              for path, digest in fresh.items()])
+
+        hashes = {path: (row[3], row[4]) for path, row in known.items() if path in entries and path not in stale}
+        hashes.update({path: (digest, None) for path, digest in fresh.items()})
+        return hashes, len(fresh)
+
+    def set_verified(self, job_id, paths, verified):
+        """verified is a timestamp string, or None to have the paths checked again next run."""
+        with self._lock, self._connect() as conn:
+            conn.executemany("UPDATE hashes SET verified = ? WHERE job_id = ? AND path = ?",
+                             [(verified, job_id, path) for path in paths])
+
+    def forget(self, job_id):
+        with self._lock, self._connect() as conn:
+            conn.execute("DELETE FROM hashes WHERE job_id = ?", (job_id,))
+
+
+class VerifyResult:
+    def __init__(self, hash_type, hashed, checked, sampled):
+        self.hash_type = hash_type
+        self.hashed = hashed # files (re)hashed locally this run
+        self.checked = checked # files compared with the remote
+        self.sampled = sampled # of which already verified before (random sample)
+        self.mismatched = [] # remote content differs
+        self.missing = [] # not on the remote
+        self.unverifiable = [] # remote has no hash of this type (e.g. Google Docs)
+
+    @property
+    def problems(self):
+        return sorted(self.mismatched + self.missing)
+
+    def summary(self):
+        return {
+            "hash_type": self.hash_type,
+            "hashed": self.hashed,
+            "checked": self.checked,
+            "sampled": self.sampled,
+            "mismatched": len(self.mismatched),
+            "missing": len(self.missing),
+            "unverifiable": len(self.unverifiable),
+            "problems": self.problems[:MAX_REPORTED],
+            "verified_at": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        }
+
+
+def verify_mirror(rclone, manifest, job_id, source_path, remote, entries, policy, cancel_token=None, rng=random):
+    """Checks the mirror at `remote` against the local hash manifest. Returns a VerifyResult."""
+    hash_type = policy["hash_type"]
+    hashes, hashed = manifest.refresh(job_id, source_path, entries, hash_type, cancel_token)
+
+    pending = [path for path, (_, verified) in hashes.items() if verified is None]
+    verified = [path for path, (_, verified) in hashes.items() if verified is not None]
+    count = min(len(verified), max(policy["sample_min"], math.ceil(len(verified) * policy["sample_percent"] / 100)))
+    sample = rng.sample(verified, count) if count else []
+
+    listing = {item["Path"]: item for item in rclone.list(remote, recursive=True, files_only=True,
+                                                           hash_type=hash_type)}
+    result = VerifyResult(hash_type, hashed, len(pending) + len(sample), len(sample))
+    ok = []
+    for path in pending + sample:
+        item = listing.get(path)
+        if item is None:
+            result.missing.append(path)
+            continue
+        remote_hash = (item.get("Hashes") or {}).get(hash_type)
+        if item.get("Size") != entries[path][0]:
+            result.mismatched.append(path)
+        elif not remote_hash:
+            result.unverifiable.append(path)
+        elif remote_hash.lower() != hashes[path][0]:
+            result.mismatched.append(path)
+        else:
+            ok.append(path)
+
+    manifest.set_verified(job_id, ok, datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+    manifest.set_verified(job_id, result.problems + result.unverifiable, None)
+    return result
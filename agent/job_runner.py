@@ -0,0 +1,207 @@
+"""
+Concurrent job execution for the backup agent.
+
+Backups run on a worker pool instead of inline in the main loop, so a long
+sync never stalls the heartbeat, control handling or other jobs.
+
+Limits:
+- global:  at most `max_concurrent_jobs` backups at once (global_config).
+- per job: a job may name a `concurrency_group`; jobs in the same group share
+           `concurrency_groups[group]` slots (default 1), e.g. to keep two jobs
+           reading the same disk from running side by side.
+- a job id is never running or queued twice. Background runs (continuous
+  mode pushes) give way: a scheduled or manual run replaces a queued one,
+  or waits behind a running one instead of being skipped.
+
+Cancellation is cooperative: each run gets a CancelToken. Cancelling it
+terminates the attached rclone process and makes the next check() raise.
+"""
+import collections
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_MAX_CONCURRENT_JOBS = 2
+MAX_WORKERS = 16 # hard cap on pool threads, whatever global_config asks for
+BACKGROUND_TRIGGERS = {"Continuous"}
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class CancelToken:
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._processes = set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self):
+        self._event.set()
+        with self._lock:
+            processes = list(self._processes)
+        for process in processes:
+            try:
+                process.terminate()
+            except Exception:
+                pass
+
+    def check(self):
+        if self.cancelled:
+            raise JobCancelled("Stopped by administrator")
+
+    def attach(self, process):
+        """Registers a child process so cancel() can terminate it."""
+        with self._lock:
+            self._processes.add(process)
+        if self.cancelled:
+            process.terminate()
+
+    def detach(self, process):
+        with self._lock:
+            self._processes.discard(process)
+
+    def run(self, cmd, check=True, input=None, **kwargs):
+        """subprocess.run() that can be interrupted by cancel()."""
+        self.check()
+        if input is not None:
+            kwargs['stdin'] = subprocess.PIPE
+        process = subprocess.Popen(cmd, **kwargs)
+        self.attach(process)
+        try:
+            stdout, stderr = process.communicate(input)
+        finally:
+            self.detach(process)
+        self.check()
+        if check and process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, cmd, stdout, stderr)
+        return subprocess.CompletedProcess(cmd, process.returncode, stdout, stderr)
+
+
+class _Run:
+    def __init__(self, job_id, job_config, global_config, trigger_type):
+        self.job_id = job_id
+        self.job_config = job_config
+        self.global_config = global_config
+        self.trigger_type = trigger_type
+        self.group = job_config.get('concurrency_group')
+        self.token = CancelToken()
+
+
+class JobScheduler:
+    """
+    Queues backup runs and executes them on a thread pool within the
+    configured limits. run_job(job_id, job_config, global_config, token, trigger_type)
+    does the actual work. on_queued / on_cancelled(job_id, trigger_type) let the
+    caller publish the state of runs that are waiting or dropped before starting.
+    """
+
+    def __init__(self, run_job, on_queued=None, on_cancelled=None):
+        self._run_job = run_job
+        self._on_queued = on_queued
+        self._on_cancelled = on_cancelled
+        self._lock = threading.Lock()
+        self._pending = collections.deque()
+        self._running = {}
+        self._group_counts = collections.Counter()
+        self.max_concurrent_jobs = DEFAULT_MAX_CONCURRENT_JOBS
+        self.group_limits = {}
+        self._pool = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="backup-job")
+
+    def configure(self, global_config):
+        """Picks up limits from global_config (safe to call every loop)."""
+        try:
+            limit = int(global_config.get('max_concurrent_jobs', DEFAULT_MAX_CONCURRENT_JOBS))
+        except (TypeError, ValueError):
+            limit = DEFAULT_MAX_CONCURRENT_JOBS
+        with self._lock:
+            self.max_concurrent_jobs = max(1, min(limit, MAX_WORKERS))
+            self.group_limits = dict(global_config.get('concurrency_groups') or {})
+        self._dispatch()
+
+    def submit(self, job_id, job_config, global_config, trigger_type="Scheduled"):
+        """Queues a run. Returns False if this job is already running or queued."""
+        background = trigger_type in BACKGROUND_TRIGGERS
+        with self._lock:
+            running = self._running.get(job_id)
+            queued = [r for r in self._pending if r.job_id == job_id]
+            if background and (running or queued):
+                return False
+            if running and running.trigger_type not in BACKGROUND_TRIGGERS:
+                return False
+            if any(r.trigger_type not in BACKGROUND_TRIGGERS for r in queued):
+                return False
+            for run in queued: # a real run covers whatever the background push had queued
+                self._pending.remove(run)
+            self._pending.append(_Run(job_id, job_config, global_config, trigger_type))
+        if self._on_queued:
+            self._on_queued(job_id, trigger_type)
+        self._dispatch()
+        return True
+
+    def cancel(self, job_id=None):
+        """Cancels one job (running or queued), or everything when job_id is None."""
+        with self._lock:
+            dropped = [r for r in self._pending if job_id is None or r.job_id == job_id]
+            for run in dropped:
+                self._pending.remove(run)
+            running = [r for jid, r in self._running.items() if job_id is None or jid == job_id]
+        for run in dropped + running:
+            run.token.cancel()
+        if self._on_cancelled:
+            for run in dropped: # never started, so nothing else will report them
+                self._on_cancelled(run.job_id, run.trigger_type)
+        return [r.job_id for r in dropped + running]
+
+    def running_jobs(self):
+        with self._lock:
+            return list(self._running)
+
+    def is_busy(self):
+        with self._lock:
+            return bool(self._running or self._pending)
+
+    def shutdown(self, wait=False):
+        self.cancel()
+        self._pool.shutdown(wait=wait)
+
+    # --- internals ---
+    def _group_limit(self, group):
+        try:
+            return max(1, int(self.group_limits.get(group, 1)))
+        except (TypeError, ValueError):
+            return 1
+
+    def _dispatch(self):
+        started = []
+        with self._lock:
+            for run in list(self._pending):
+                if len(self._running) >= self.max_concurrent_jobs:
+                    break
+                if run.job_id in self._running: # waiting for a background run of the same job
+                    continue
+                if run.group and self._group_counts[run.group] >= self._group_limit(run.group):
+                    continue
+                self._pending.remove(run)
+                self._running[run.job_id] = run
+                if run.group:
+                    self._group_counts[run.group] += 1
+                started.append(run)
+        for run in started:
+            self._pool.submit(self._execute, run)
+
+    def _execute(self, run):
+        try:
+            self._run_job(run.job_id, run.job_config, run.global_config, run.token, run.trigger_type)
+        except Exception as e:
+            print(f"❌ Job {run.job_id} crashed: {e}")
+        finally:
+            with self._lock:
+                self._running.pop(run.job_id, None)
+                if run.group:
+                    self._group_counts[run.group] -= 1
+            self._dispatch()
@@ -0,0 +1,180 @@
+"""
+Compaction of the run history under logs/{agent}.
+
+Every run pushes one entry to logs/{agent} and nothing used to trim it, so
+any read of the history grew with the age of the agent. Compaction keeps the
+newest `keep` raw entries and folds everything older into aggregates under a
+separate node:
+
+    log_rollups/{agent}/daily/2025-01-02
+    log_rollups/{agent}/monthly/2025-01
+    {
+      "runs": 31, "succeeded": 29, "failed": 1, "cancelled": 1,
+      "success_rate": 0.935, "bytes": 73400320,
+      "duration_s": {"p50": 41.2, "p90": 118.0, "p99": 290.5, "max": 301.7},
+      "durations": {"le_10": 0, "le_30": 9, ..., "le_inf": 0},
+      "types": {"Scheduled": 30, "Manual": 1},
+      "first": "2025-01-02 09:00:00", "last": "2025-01-02 21:00:04"
+    }
+
+Percentiles are interpolated from the fixed `durations` histogram, which is
+what makes a day that is compacted in two goes, or a month built from many
+days, mergeable without keeping every sample. Entries written before the
+numeric fields existed are folded in with their display size parsed back.
+"""
+import datetime
+import re
+
+DEFAULT_KEEP = 200 # raw entries left in logs/{agent} (global_config `log_keep`)
+DEFAULT_ROLLUP_INTERVAL = 24 # hours between compactions (global_config `log_rollup_interval`)
+DURATION_BUCKETS = (10, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200, 14400, 43200, 86400) # seconds
+SUCCESS = ("Success", "Restored")
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+_SIZE_RE = re.compile(r"^\s*([\d.]+)\s*([KMGTP]?B)\s*$")
+_UNITS = {"B": 0, "KB": 1, "MB": 2, "GB": 3, "TB": 4, "PB": 5}
+
+
+def bucket_key(bound):
+    # Firebase turns objects with small integer keys into arrays, hence the prefix.
+    return f"le_{bound}"
+
+
+BUCKET_KEYS = [bucket_key(b) for b in DURATION_BUCKETS] + ["le_inf"]
+
+
+def entry_bytes(entry):
+    """Bytes of a log entry: the numeric field, or the old display string ("12.50 MB")."""
+    value = entry.get("bytes")
+    if isinstance(value, (int, float)):
+        return int(value)
+    match = _SIZE_RE.match(str(entry.get("size") or ""))
+    if not match:
+        return 0
+    return int(float(match.group(1)) * 1024 ** _UNITS[match.group(2)])
+
+
+def entry_time(entry):
+    try:
+        return datetime.datetime.strptime(entry.get("timestamp", ""), TIME_FORMAT)
+    except (TypeError, ValueError):
+        return None
+
+
+def outcome(status):
+    if status in SUCCESS:
+        return "succeeded"
+    if "Cancelled" in str(status):
+        return "cancelled"
+    return "failed"
+
+
+def empty_aggregate():
+    return {
+        "runs": 0, "succeeded": 0, "failed": 0, "cancelled": 0, "bytes": 0, "max_s": 0.0,
+        "durations": {key: 0 for key in BUCKET_KEYS}, "types": {}, "first": None, "last": None,
+    }
+
+
+def add_entry(aggregate, entry):
+    aggregate["runs"] += 1
+    aggregate[outcome(entry.get("status"))] += 1
+    aggregate["bytes"] += entry_bytes(entry)
+    kind = str(entry.get("type") or "Unknown").replace("/", "_").replace(".", "_")
+    aggregate["types"][kind] = aggregate["types"].get(kind, 0) + 1
+    duration = entry.get("duration_s")
+    if isinstance(duration, (int, float)):
+        bound = next((b for b in DURATION_BUCKETS if duration <= b), None)
+        key = bucket_key(bound) if bound is not None else "le_inf"
+        aggregate["durations"][key] += 1
+        aggregate["max_s"] = max(aggregate["max_s"], float(duration))
+    stamp = entry.get("timestamp")
+    if stamp:
+        aggregate["first"] = min(filter(None, [aggregate["first"], stamp]))
+        aggregate["last"] = max(filter(None, [aggregate["last"], stamp]))
+
+
+def merge_aggregates(existing, new):
+    """Adds an aggregate to one already stored (either may be None) and refreshes the derived fields."""
+    merged = empty_aggregate()
+    for aggregate in (existing, new):
+        if not aggregate:
+            continue
+        for field in ("runs", "succeeded", "failed", "cancelled", "bytes"):
+            merged[field] += aggregate.get(field, 0)
+        merged["max_s"] = max(merged["max_s"], aggregate.get("max_s", 0.0))
+        for key, count in (aggregate.get("durations") or {}).items():
+            merged["durations"][key] = merged["durations"].get(key, 0) + count
+        for kind, count in (aggregate.get("types") or {}).items():
+            merged["types"][kind] = merged["types"].get(kind, 0) + count
+        for field, pick in (("first", min), ("last", max)):
+            values = [v for v in (merged[field], aggregate.get(field)) if v]
+            merged[field] = pick(values) if values else None
+    return finish(merged)
+
+
+def percentile(histogram, max_s, q):
+    """q-th percentile (0..1) of the bucketed durations, interpolated inside the bucket."""
+    counts = [histogram.get(key, 0) for key in BUCKET_KEYS]
+    total = sum(counts)
+    if not total:
+        return None
+    rank = q * total
+    lower = 0.0
+    for bound, count in zip(DURATION_BUCKETS + (max_s,), counts):
+        upper = min(bound, max_s) # nothing in a bucket is longer than the longest run
+        if count and rank <= count:
+            return round(lower + (upper - lower) * rank / count, 1)
+        rank -= count
+        lower = upper
+    return round(max_s, 1)
+
+
+def finish(aggregate):
+    runs = aggregate["runs"]
+    aggregate["success_rate"] = round(aggregate["succeeded"] / runs, 3) if runs else None
+    aggregate["duration_s"] = {
+        "p50": percentile(aggregate["durations"], aggregate["max_s"], 0.50),
+        "p90": percentile(aggregate["durations"], aggregate["max_s"], 0.90),
+        "p99": percentile(aggregate["durations"], aggregate["max_s"], 0.99),
+        "max": round(aggregate["max_s"], 1),
+    }
+    return aggregate
+
+
+class RollupPlan:
+    def __init__(self):
+        self.compacted = [] # push keys folded into aggregates (removed from logs/{agent})
+        self.kept = 0
+        self.daily = {} # {"YYYY-MM-DD": aggregate}
+        self.monthly = {} # {"YYYY-MM": aggregate}
+
+    def summary(self):
+        return {"compacted": len(self.compacted), "kept": self.kept,
+                "days": len(self.daily), "months": len(self.monthly)}
+
+
+def plan_rollup(logs, keep=DEFAULT_KEEP):
+    """
+    Splits logs/{agent} ({push_key: entry}) into the newest `keep` entries and
+    the older ones, which are aggregated per day and per month. Push keys sort
+    chronologically, so the split needs no timestamps.
+    """
+    plan = RollupPlan()
+    keys = sorted(k for k, v in (logs or {}).items() if isinstance(v, dict))
+    old = keys[:-keep] if keep > 0 else keys
+    plan.kept = len(keys) - len(old)
+    for key in old:
+        entry = logs[key]
+        when = entry_time(entry)
+        day = when.strftime("%Y-%m-%d") if when else "unknown"
+        month = when.strftime("%Y-%m") if when else "unknown"
+        for groups, period in ((plan.daily, day), (plan.monthly, month)):
+            if period not in groups:
+                groups[period] = empty_aggregate()
+            add_entry(groups[period], entry)
+        plan.compacted.append(key)
+    for groups in (plan.daily, plan.monthly):
+        for aggregate in groups.values():
+            finish(aggregate)
+    return plan
@@ -0,0 +1,282 @@
+"""
+In-process metrics for the agent: counters, gauges and timers.
+
+- Metrics is a small thread-safe registry. Timers keep count / sum / max /
+  last per label set, so phase timings can be averaged fleet-wide without
+  storing every sample.
+- PhaseClock times the consecutive phases of one backup run
+  (scan -> sync -> snapshot -> verify -> retention -> gc -> fanout -> email).
+- TimedBackend wraps a database backend (get / set / update / delete /
+  listen) and records the latency of every call.
+- MetricsServer serves the registry as Prometheus text on 127.0.0.1
+  (global_config `metrics_port`; off by default).
+- MetricsFile appends JSON snapshots to one file per day under config_dir
+  and deletes files older than `keep_days`.
+
+Everything published is a plain number; display strings are left to the UI.
+"""
+import datetime
+import json
+import os
+import threading
+import time
+
+PREFIX = "backup_agent_"
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._timers = {}
+        self._collectors = []
+        self.started = time.time()
+
+    def inc(self, name, value=1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._gauges[_key(name, labels)] = value
+
+    def observe(self, name, seconds, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            timer = self._timers.get(key)
+            if timer is None:
+                timer = self._timers[key] = {"count": 0, "sum": 0.0, "max": 0.0, "last": 0.0}
+            timer["count"] += 1
+            timer["sum"] += seconds
+            timer["max"] = max(timer["max"], seconds)
+            timer["last"] = seconds
+
+    def timer(self, name, **labels):
+        return _Timer(self, name, labels)
+
+    def add_collector(self, collect):
+        """collect() -> {gauge_name: value}; called whenever the registry is read."""
+        self._collectors.append(collect)
+
+    def _collect(self):
+        for collect in self._collectors:
+            try:
+                for name, value in collect().items():
+                    self.set(name, value)
+            except Exception as e:
+                print(f"⚠️ Metrics collector failed: {e}")
+
+    def samples(self):
+        """Returns (counters, gauges, timers) as lists of (name, labels, value)."""
+        self._collect()
+        with self._lock:
+            counters = [(n, dict(l), v) for (n, l), v in self._counters.items()]
+            gauges = [(n, dict(l), v) for (n, l), v in self._gauges.items()]
+            timers = [(n, dict(l), dict(v)) for (n, l), v in self._timers.items()]
+        return counters, gauges, timers
+
+    def timer_summary(self, name, label):
+        """{label_value: {count, mean_ms, max_ms}} for one timer, summed over its other labels."""
+        totals = {}
+        for timer_name, labels, value in self.samples()[2]:
+            if timer_name == name and label in labels:
+                total = totals.setdefault(labels[label], {"count": 0, "sum": 0.0, "max": 0.0})
+                total["count"] += value["count"]
+                total["sum"] += value["sum"]
+                total["max"] = max(total["max"], value["max"])
+        return {
+            key: {
+                "count": total["count"],
+                "mean_ms": round(1000 * total["sum"] / total["count"], 1) if total["count"] else 0,
+                "max_ms": round(1000 * total["max"], 1),
+            }
+            for key, total in totals.items()
+        }
+
+    def prometheus_text(self):
+        counters, gauges, timers = self.samples()
+        lines = []
+
+        def fmt(name, labels, value):
+            label_text = ",".join(f'{k}="{str(v)}"' for k, v in sorted(labels.items()))
+            return f"{PREFIX}{name}{{{label_text}}} {value}" if label_text else f"{PREFIX}{name} {value}"
+
+        for kind, samples in (("counter", counters), ("gauge", gauges)):
+            for name in sorted({s[0] for s in samples}):
+                lines.append(f"# TYPE {PREFIX}{name} {kind}")
+                lines += [fmt(n, l, v) for n, l, v in samples if n == name]
+        for name in sorted({t[0] for t in timers}):
+            lines.append(f"# TYPE {PREFIX}{name} summary")
+            for n, l, v in timers:
+                if n == name:
+                    lines.append(fmt(f"{name}_count", l, v["count"]))
+                    lines.append(fmt(f"{name}_sum", l, round(v["sum"], 6)))
+            lines.append(f"# TYPE {PREFIX}{name}_last gauge")
+            lines += [fmt(f"{name}_last", l, round(v["last"], 6)) for n, l, v in timers if n == name]
+        return "\n".join(lines) + "\n"
+
+
+class _Timer:
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.start
+        self.metrics.observe(self.name, self.elapsed, **self.labels)
+        return False
+
+
+class PhaseClock:
+    """Stopwatch for consecutive phases: start("sync") ends the running phase and begins the next."""
+
+    def __init__(self, metrics, name, **labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+        self.laps = {}
+        self._phase = None
+        self._started = None
+        self._created = time.perf_counter()
+
+    def start(self, phase):
+        self.stop()
+        self._phase, self._started = phase, time.perf_counter()
+
+    def record(self, phase, seconds):
+        """Adds a lap measured elsewhere (e.g. the imports before main())."""
+        self.laps[phase] = round(self.laps.get(phase, 0.0) + seconds, 3)
+        self.metrics.observe(self.name, seconds, phase=phase, **self.labels)
+
+    def stop(self):
+        if self._phase is None:
+            return
+        phase, self._phase = self._phase, None
+        self.record(phase, time.perf_counter() - self._started)
+
+    @property
+    def total(self):
+        return round(time.perf_counter() - self._created, 3)
+
+
+class TimedBackend:
+    """Database backend wrapper that times every call (metric `firebase_call_seconds{op=...}`)."""
+
+    def __init__(self, backend, metrics):
+        self._backend = backend
+        self._metrics = metrics
+
+    def _timed(self, op, *args):
+        start = time.perf_counter()
+        try:
+            return getattr(self._backend, op)(*args)
+        except Exception:
+            self._metrics.inc("firebase_errors_total", op=op)
+            raise
+        finally:
+            self._metrics.observe("firebase_call_seconds", time.perf_counter() - start, op=op)
+
+    def get(self, path):
+        return self._timed("get", path)
+
+    def set(self, path, value):
+        return self._timed("set", path, value)
+
+    def update(self, path, values):
+        return self._timed("update", path, values)
+
+    def delete(self, path):
+        return self._timed("delete", path)
+
+    def listen(self, path, callback):
+        return self._timed("listen", path, callback)
+
+
+class MetricsServer:
+    """Serves GET /metrics on 127.0.0.1:port in a daemon thread."""
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.port = None
+        self._server = None
+
+    def configure(self, port):
+        port = int(port or 0)
+        if port == (self.port or 0):
+            return
+        self.stop()
+        if port:
+            import http.server # only needed when the endpoint is enabled
+            metrics = self.metrics
+
+            class Handler(http.server.BaseHTTPRequestHandler):
+                def do_GET(self):
+                    if self.path.split("?", 1)[0] not in ("/", "/metrics"):
+                        self.send_error(404)
+                        return
+                    body = metrics.prometheus_text().encode("utf-8")
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain; version=0.0.4")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, *args):
+                    pass
+
+            try:
+                self._server = http.server.ThreadingHTTPServer(("127.0.0.1", port), Handler)
+            except OSError as e:
+                print(f"⚠️ Metrics endpoint unavailable on port {port}: {e}")
+                return
+            threading.Thread(target=self._server.serve_forever, name="metrics", daemon=True).start()
+            print(f"📈 Metrics on http://127.0.0.1:{port}/metrics")
+        self.port = port
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        self.port = None
+
+
+class MetricsFile:
+    """Appends one JSON line per record to {directory}/metrics-YYYY-MM-DD.jsonl, keeping `keep_days` files."""
+
+    def __init__(self, directory, keep_days=14):
+        self.directory = directory
+        self.keep_days = keep_days
+        self._lock = threading.Lock()
+        self._day = None
+
+    def append(self, record):
+        today = datetime.date.today()
+        line = json.dumps(dict(record, ts=int(time.time())), separators=(",", ":"))
+        with self._lock:
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                with open(os.path.join(self.directory, f"metrics-{today:%Y-%m-%d}.jsonl"), "a") as f:
+                    f.write(line + "\n")
+                if self._day != today:
+                    self._day = today
+                    self._rotate(today)
+            except OSError as e:
+                print(f"⚠️ Could not write metrics file: {e}")
+
+    def _rotate(self, today):
+        cutoff = f"metrics-{today - datetime.timedelta(days=self.keep_days):%Y-%m-%d}.jsonl"
+        for name in os.listdir(self.directory):
+            if name.startswith("metrics-") and name.endswith(".jsonl") and name < cutoff:
+                os.remove(os.path.join(self.directory, name))
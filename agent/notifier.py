@@ -0,0 +1,307 @@
+"""
+Background email notifications.
+
+Jobs hand their result to Notifier.notify() and return at once; a single
+sender thread does all SMTP work, so a slow or unreachable mail server never
+holds up a backup.
+
+- One authenticated session per SMTP account is kept open and reused
+  (SmtpPool). It is closed after `idle_timeout` seconds without mail, and
+  reopened transparently if the server dropped it in the meantime.
+- A failed send is retried with exponential backoff (RETRY_DELAYS). Bad
+  credentials are not retried.
+- With a digest window (global_config `email_digest_window`, seconds) alerts
+  for the same recipients are held for that long after the first one and
+  sent as one digest, so `trigger_now: "ALL"` over many jobs sends a single
+  email. Without a window every alert is sent on its own, as before.
+
+smtp settings: {server, port, email, password, tls, idle_timeout}. `tls` is
+"starttls" (default), "ssl" or "none"; without a password no login is made,
+which is what a local test server such as aiosmtpd expects:
+
+    python -m aiosmtpd -n -l 127.0.0.1:8025
+    "smtp": {"server": "127.0.0.1", "port": 8025, "email": "agent@test", "tls": "none"}
+"""
+import datetime
+import socket
+import threading
+import time
+
+SMTP_TIMEOUT = 30 # seconds per SMTP command
+SMTP_IDLE_TIMEOUT = 120 # seconds an unused session stays open
+RETRY_DELAYS = [15, 60, 300, 900] # seconds before each retry; dropped after the last one
+STATUS_COLORS = {"SUCCESS": "#10B981", "FAILURE": "#EF4444"}
+
+
+def parse_recipients(recipients_str):
+    return [email.strip() for email in (recipients_str or "").split(",") if email.strip()]
+
+
+def _account_key(smtp_settings):
+    return (smtp_settings.get("server", "smtp.gmail.com"), int(smtp_settings.get("port", 587)),
+            smtp_settings.get("email"), smtp_settings.get("tls", "starttls"))
+
+
+# --- RENDERING ---
+def _frame(title, color, content):
+    return f"""
+    <html><body style="font-family: sans-serif; color: #333;">
+        <div style="border: 1px solid #ddd; border-radius: 8px; overflow: hidden; max-width: 600px;">
+          <div style="background-color: {color}; padding: 15px; color: white; text-align: center;">
+            <h2 style="margin:0;">{title}</h2>
+          </div>
+          <div style="padding: 20px;">
+            <p><strong>System:</strong> {socket.gethostname()}</p>
+            {content}
+          </div>
+        </div>
+    </body></html>
+    """
+
+
+def render_alert(alert):
+    """(subject, html) for a single job result."""
+    color = STATUS_COLORS.get(alert["status"], "#6B7280")
+    content = (f'<p><strong>Time:</strong> {alert["time"]:%Y-%m-%d %I:%M %p}</p>'
+               f'<table style="width: 100%; border-collapse: collapse;">{alert["details"]}</table>')
+    subject = f"[{alert['status']}] {alert['job_name']} - {socket.gethostname()}"
+    return subject, _frame(f"{alert['job_name']}: {alert['status']}", color, content)
+
+
+def render_digest(alerts):
+    """(subject, html) for several job results in one email."""
+    failed = sum(1 for a in alerts if a["status"] != "SUCCESS")
+    status = f"{failed} FAILED" if failed else "SUCCESS"
+    color = STATUS_COLORS["FAILURE"] if failed else STATUS_COLORS["SUCCESS"]
+    sections = "".join(
+        f'<h3 style="margin: 16px 0 4px; color: {STATUS_COLORS.get(a["status"], "#6B7280")};">'
+        f'{a["job_name"]}: {a["status"]}</h3>'
+        f'<p style="margin: 0;">{a["time"]:%Y-%m-%d %I:%M %p}</p>'
+        f'<table style="width: 100%; border-collapse: collapse;">{a["details"]}</table>'
+        for a in alerts)
+    subject = f"[{status}] {len(alerts)} backup jobs - {socket.gethostname()}"
+    return subject, _frame(f"{len(alerts)} jobs: {status}", color, sections)
+
+
+# --- SMTP SESSIONS ---
+class SmtpPool:
+    """Keeps one authenticated SMTP session per account. Only used from the sender thread."""
+
+    def __init__(self, idle_timeout=SMTP_IDLE_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self._sessions = {} # account key -> [smtp, last_used, idle_timeout]
+
+    def _open(self, smtp_settings):
+        import smtplib # loaded on first use, not at agent start-up
+        server, port, sender, tls = _account_key(smtp_settings)
+        if tls == "ssl":
+            smtp = smtplib.SMTP_SSL(server, port, timeout=SMTP_TIMEOUT)
+        else:
+            smtp = smtplib.SMTP(server, port, timeout=SMTP_TIMEOUT)
+            if tls == "starttls":
+                smtp.starttls()
+        try:
+            if smtp_settings.get("password"):
+                smtp.login(sender, smtp_settings["password"])
+        except BaseException:
+            smtp.close()
+            raise
+        return smtp
+
+    def send(self, smtp_settings, recipients, message):
+        import smtplib
+        key = _account_key(smtp_settings)
+        session = self._sessions.get(key)
+        if session is not None:
+            try:
+                session[0].sendmail(key[2], recipients, message)
+                session[1] = time.monotonic()
+                return
+            except smtplib.SMTPServerDisconnected:
+                self.close(key) # the server timed us out first: reconnect once
+            except BaseException:
+                self.close(key)
+                raise
+        smtp = self._open(smtp_settings)
+        idle_timeout = float(smtp_settings.get("idle_timeout") or self.idle_timeout)
+        self._sessions[key] = [smtp, time.monotonic(), idle_timeout]
+        try:
+            smtp.sendmail(key[2], recipients, message)
+        except BaseException:
+            self.close(key)
+            raise
+
+    def close(self, key):
+        import smtplib
+        session = self._sessions.pop(key, None)
+        if session is None:
+            return
+        try:
+            session[0].quit()
+        except (smtplib.SMTPException, OSError):
+            session[0].close()
+
+    def close_idle(self, now=None):
+        """Closes sessions unused for idle_timeout. Returns seconds until the next one expires, or None."""
+        now = now or time.monotonic()
+        remaining = []
+        for key, (_, last_used, idle_timeout) in list(self._sessions.items()):
+            left = last_used + idle_timeout - now
+            if left <= 0:
+                self.close(key)
+            else:
+                remaining.append(left)
+        return min(remaining) if remaining else None
+
+    def close_all(self):
+        for key in list(self._sessions):
+            self.close(key)
+
+
+# --- QUEUE ---
+class Notifier:
+    def __init__(self, metrics=None, idle_timeout=SMTP_IDLE_TIMEOUT):
+        self.metrics = metrics
+        self.pool = SmtpPool(idle_timeout)
+        self.digest_window = 0
+        self._pending = [] # alert dicts, oldest first
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopping = False
+
+    def configure(self, global_config):
+        try:
+            window = max(0.0, float(global_config.get("email_digest_window") or 0))
+        except (TypeError, ValueError):
+            window = 0.0
+        with self._cond:
+            if window != self.digest_window:
+                self.digest_window = window
+                self._cond.notify()
+
+    def notify(self, job_name, status, details_html, recipients_str, smtp_settings):
+        """Queues a job result. Returns immediately; does nothing if email is not configured."""
+        if not recipients_str or not smtp_settings or "xxxx" in smtp_settings.get("password", ""):
+            return False
+        recipients = parse_recipients(recipients_str)
+        if not recipients:
+            return False
+        alert = {
+            "job_name": job_name,
+            "status": status,
+            "details": details_html,
+            "time": datetime.datetime.now(),
+            "recipients": tuple(sorted(recipients)),
+            "smtp": dict(smtp_settings),
+            "queued": time.monotonic(),
+        }
+        with self._cond:
+            self._pending.append(alert)
+            self._cond.notify()
+        return True
+
+    @property
+    def backlog(self):
+        with self._cond:
+            return len(self._pending)
+
+    def start(self):
+        if self._thread is None:
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name="notifier", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=30):
+        """Sends whatever is pending (ignoring the digest window and backoff), then closes the sessions."""
+        thread = self._thread
+        if thread is None:
+            return
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        thread.join(timeout)
+        self._thread = None
+
+    # --- sender thread ---
+    def _batches(self, now):
+        """Pops the batches that are due: [(smtp, recipients, [alerts])]."""
+        groups = {}
+        for alert in self._pending:
+            key = (_account_key(alert["smtp"]), alert["recipients"])
+            groups.setdefault(key, []).append(alert)
+
+        due, wait = [], None
+        for (_, recipients), alerts in groups.items():
+            retry_at = max(a.get("retry_at", 0) for a in alerts)
+            ready_at = max(alerts[0]["queued"] + self.digest_window, retry_at)
+            if self._stopping or ready_at <= now:
+                if self.digest_window or len(alerts) == 1:
+                    due.append((alerts[-1]["smtp"], recipients, alerts))
+                else:
+                    due += [(a["smtp"], recipients, [a]) for a in alerts]
+                for alert in alerts:
+                    self._pending.remove(alert)
+            else:
+                wait = ready_at - now if wait is None else min(wait, ready_at - now)
+        return due, wait
+
+    def _run(self):
+        while True:
+            with self._cond:
+                due, wait = self._batches(time.monotonic())
+                stopping = self._stopping
+            if not due and not stopping:
+                idle = self.pool.close_idle()
+                if idle is not None:
+                    wait = idle if wait is None else min(wait, idle)
+                with self._cond:
+                    if not self._stopping:
+                        self._cond.wait(wait)
+                continue
+            for smtp_settings, recipients, alerts in due:
+                self._deliver(smtp_settings, recipients, alerts, final=stopping)
+            if stopping:
+                with self._cond:
+                    if not self._pending:
+                        break
+        self.pool.close_all()
+
+    def _deliver(self, smtp_settings, recipients, alerts, final=False):
+        import smtplib
+        from email.mime.multipart import MIMEMultipart
+        from email.mime.text import MIMEText
+
+        subject, body = render_alert(alerts[0]) if len(alerts) == 1 else render_digest(alerts)
+        msg = MIMEMultipart()
+        msg['From'] = f"Backup Agent <{smtp_settings.get('email')}>"
+        msg['To'] = ", ".join(recipients)
+        msg['Subject'] = subject
+        msg.attach(MIMEText(body, 'html'))
+        try:
+            self.pool.send(smtp_settings, list(recipients), msg.as_string())
+            self._count("emails_sent_total")
+            return
+        except (smtplib.SMTPAuthenticationError, smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused) as e:
+            print(f"❌ Email Failed (rejected, not retrying): {e}")
+            self._count("emails_failed_total")
+            return
+        except (smtplib.SMTPException, OSError) as e:
+            error = e
+
+        attempts = alerts[0].get("attempts", 0)
+        if final or attempts >= len(RETRY_DELAYS):
+            print(f"❌ Email Failed: {error}")
+            self._count("emails_failed_total")
+            return
+        delay = RETRY_DELAYS[attempts]
+        print(f"⚠️ Email failed ({error}), retrying in {delay}s")
+        self._count("email_retries_total")
+        with self._cond:
+            for alert in alerts:
+                alert["attempts"] = attempts + 1
+                alert["retry_at"] = time.monotonic() + delay
+            self._pending[:0] = alerts
+
+    def _count(self, name):
+        if self.metrics is not None:
+            self.metrics.inc(name)
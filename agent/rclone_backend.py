@@ -0,0 +1,568 @@
+"""
+rclone access layer.
+
+Two interchangeable backends expose the operations the agent needs
+(listremotes, config_create, sync, copy, move, list, purge, delete, cat,
+rcat):
+
+- RcdBackend starts ONE `rclone rcd` on 127.0.0.1 with random credentials and
+  drives it over its HTTP API (sync/sync, sync/copy, operations/list,
+  operations/purge, core/stats ...). Config parsing and OAuth token setup
+  happen once, HTTP connections are kept alive per thread, and transfers run
+  as async rc jobs whose stats are polled. If the daemon dies it is
+  restarted on the next call.
+- SubprocessBackend spawns one rclone process per operation (the original
+  behaviour). It is the fallback when the daemon cannot be started, and is
+  also used by RcdBackend for cat/rcat (and streamed rcat), which have no rc
+  equivalent.
+
+Transfers accept `files_from` (a --files-from list path) and `options`
+(rclone options by flag name, e.g. {"transfers": 8, "drive-chunk-size": "32M"}).
+The bandwidth limit is per process for subprocesses ("bwlimit" option, which
+may be an rclone timetable) but global to the daemon in rcd mode, where it is
+changed live with set_bwlimit().
+Progress is reported through on_event(StatsEvent / FileErrorEvent / ...),
+and a CancelToken stops the transfer in either mode.
+
+pids() / hold() / release_hold() let the resource governor lower the
+priority of, or suspend, the rclone processes: hold() first waits for
+in-flight rc calls and keeps new ones waiting, so the daemon is never
+stopped in the middle of an HTTP request.
+"""
+import base64
+import http.client
+import json
+import os
+import re
+import secrets
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+
+from rclone_progress import RcloneLogParser, StatsEvent, FileErrorEvent, LogEvent, stats_event
+
+# CLI flag name -> rc `_config` field name
+_RC_CONFIG_NAMES = {
+    "transfers": "Transfers",
+    "checkers": "Checkers",
+    "bwlimit-file": "BwLimitFile",
+    "no-traverse": "NoTraverse",
+    "server-side-across-configs": "ServerSideAcrossConfigs",
+    "retries": "Retries",
+    "low-level-retries": "LowLevelRetries",
+    "buffer-size": "BufferSize",
+    "multi-thread-streams": "MultiThreadStreams",
+}
+# Backend flags have no `_config` field; in rcd mode they go into the destination's connection string,
+# and only for remotes of the backend they belong to (flag prefix).
+_RC_BACKEND_PARAMS = {
+    "drive-chunk-size": "chunk_size",
+    "drive-upload-cutoff": "upload_cutoff",
+}
+_REMOTE_RE = re.compile(r"^([\w.][\w. -]+?)(,[^:]*)?:(.*)$")
+
+
+class RcloneError(Exception):
+    def __init__(self, message, not_found=False):
+        super().__init__(message)
+        self.not_found = not_found
+
+
+def _cli_flags(options):
+    flags = []
+    for name, value in (options or {}).items():
+        if value is True:
+            flags.append(f"--{name}")
+        elif value not in (None, False):
+            flags += [f"--{name}", str(value)]
+    return flags
+
+
+def remote_name(remote):
+    """Name of the configured remote in "name:path" (or "name,params:path"), None for local paths."""
+    match = _REMOTE_RE.match(remote)
+    return match.group(1) if match else None
+
+
+def _with_params(remote, options, remote_type=None):
+    """
+    Adds backend flags to a named remote of type remote_type:
+    gdrive:path -> gdrive,chunk_size=32M:path when gdrive is a drive remote.
+    """
+    params = [f"{_RC_BACKEND_PARAMS[name]}={value}" for name, value in (options or {}).items()
+              if name in _RC_BACKEND_PARAMS and value is not None and remote_type
+              and name.startswith(f"{remote_type}-")]
+    match = _REMOTE_RE.match(remote)
+    if not params or not match: # local paths (including C:\...) take no backend flags
+        return remote
+    return f"{match.group(1)}{match.group(2) or ''},{','.join(params)}:{match.group(3)}"
+
+
+def _rc_config(options):
+    config = {}
+    for name, value in (options or {}).items():
+        if value is None or name not in _RC_CONFIG_NAMES:
+            continue
+        config[_RC_CONFIG_NAMES[name]] = value
+    return config
+
+
+class SubprocessBackend:
+    mode = "subprocess"
+    live_bwlimit = False
+
+    def __init__(self, rclone_bin):
+        self.rclone_bin = rclone_bin
+        self.process_count = 0
+        self._active = set() # running transfer processes
+
+    def _run(self, args, input=None, cancel_token=None):
+        self.process_count += 1
+        cmd = [self.rclone_bin] + args
+        if cancel_token is not None:
+            result = cancel_token.run(cmd, check=False, input=input,
+                                      stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        else:
+            result = subprocess.run(cmd, input=input, capture_output=True)
+        if result.returncode != 0:
+            err = result.stderr.decode("utf-8", errors="replace").strip()
+            raise RcloneError(err or f"rclone {args[0]} failed ({result.returncode})",
+                              not_found=result.returncode in (3, 4))
+        return result.stdout
+
+    # --- config ---
+    def version(self):
+        """rclone version string, e.g. "v1.65.0"."""
+        return self._run(["version"]).decode("utf-8").split()[1]
+
+    def config_path(self):
+        """Path of the rclone.conf this binary uses."""
+        return self._run(["config", "file"]).decode("utf-8").strip().splitlines()[-1].strip()
+
+    def listremotes(self):
+        return self._run(["listremotes"]).decode("utf-8").split()
+
+    def config_create(self, name, remote_type, parameters):
+        args = ["config", "create", name, remote_type]
+        for key, value in parameters.items():
+            args += [key, str(value)]
+        self._run(args)
+
+    # --- transfers ---
+    def _transfer(self, command, src, dst, files_from, options, cancel_token, on_event):
+        self.process_count += 1
+        args = [self.rclone_bin, command, src, dst, "--use-json-log", "--stats", "1s", "--stats-log-level", "NOTICE"]
+        if files_from:
+            args += ["--files-from", files_from]
+        args += _cli_flags(options)
+        process = subprocess.Popen(args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        self._active.add(process)
+        if cancel_token is not None:
+            cancel_token.attach(process)
+
+        last_stats = None
+        errors = []
+        try:
+            for event in RcloneLogParser().iter_stream(process.stderr):
+                if isinstance(event, StatsEvent):
+                    last_stats = event
+                elif isinstance(event, FileErrorEvent):
+                    errors.append(f"{event.path}: {event.message}")
+                elif isinstance(event, LogEvent) and event.level == "error":
+                    errors.append(event.message)
+                if on_event:
+                    on_event(event)
+            process.wait()
+        finally:
+            self._active.discard(process)
+            if cancel_token is not None:
+                cancel_token.detach(process)
+        if cancel_token is not None:
+            cancel_token.check()
+        if process.returncode != 0:
+            raise RcloneError("; ".join(errors[-3:]) or f"rclone {command} failed ({process.returncode})")
+        return last_stats
+
+    def sync(self, src, dst, files_from=None, options=None, cancel_token=None, on_event=None):
+        return self._transfer("sync", src, dst, files_from, options, cancel_token, on_event)
+
+    def copy(self, src, dst, files_from=None, options=None, cancel_token=None, on_event=None):
+        return self._transfer("copy", src, dst, files_from, options, cancel_token, on_event)
+
+    def move(self, src, dst, files_from=None, options=None, cancel_token=None, on_event=None):
+        return self._transfer("move", src, dst, files_from, options, cancel_token, on_event)
+
+    # --- operations ---
+    def list(self, remote, recursive=False, dirs_only=False, files_only=False, hash_type=None):
+        args = ["lsjson", remote]
+        if recursive:
+            args.append("-R")
+        if dirs_only:
+            args.append("--dirs-only")
+        if files_only:
+            args.append("--files-only")
+        if hash_type:
+            args += ["--hash", "--hash-type", hash_type]
+        return json.loads(self._run(args).decode("utf-8") or "[]")
+
+    def purge(self, remote):
+        self._run(["purge", remote])
+
+    def delete(self, remote, files_from=None):
+        args = ["delete", remote]
+        if files_from:
+            args += ["--files-from", files_from]
+        self._run(args)
+
+    def cat(self, remote, offset=None, count=None):
+        args = ["cat", remote]
+        if offset is not None:
+            args += ["--offset", str(offset)]
+        if count is not None:
+            args += ["--count", str(count)]
+        return self._run(args)
+
+    def rcat(self, remote, data, cancel_token=None):
+        self._run(["rcat", remote], input=data, cancel_token=cancel_token)
+
+    def open_rcat(self, remote, cancel_token=None):
+        """Returns a writable stream uploaded to remote as it is written (no local copy)."""
+        self.process_count += 1
+        return _RcatStream([self.rclone_bin, "rcat", remote], cancel_token)
+
+    def set_bwlimit(self, rate):
+        return False # each process carries its own --bwlimit
+
+    # --- process control (resource governor) ---
+    def pids(self):
+        return [p.pid for p in list(self._active) if p.poll() is None]
+
+    def hold(self, timeout):
+        return True # transfer processes can be suspended at any time
+
+    def release_hold(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class _RcatStream:
+    def __init__(self, cmd, cancel_token):
+        self.cancel_token = cancel_token
+        self.bytes_written = 0
+        # stderr goes to a temp file so a chatty rclone can never block our writes.
+        self._stderr = tempfile.TemporaryFile()
+        self._process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                                         stderr=self._stderr)
+        if cancel_token is not None:
+            cancel_token.attach(self._process)
+
+    def write(self, data):
+        try:
+            self._process.stdin.write(data)
+        except (BrokenPipeError, OSError):
+            self._finish()
+            raise RcloneError("rclone rcat stopped accepting data")
+        self.bytes_written += len(data)
+        return len(data)
+
+    def _finish(self):
+        try:
+            self._process.stdin.close()
+        except OSError:
+            pass
+        self._process.wait()
+        if self.cancel_token is not None:
+            self.cancel_token.detach(self._process)
+            self.cancel_token.check()
+        self._stderr.seek(0)
+        err = self._stderr.read().decode("utf-8", errors="replace").strip()
+        self._stderr.close()
+        if self._process.returncode != 0:
+            raise RcloneError(err or f"rclone rcat failed ({self._process.returncode})")
+
+    def close(self):
+        self._finish()
+
+    def abort(self):
+        self._process.kill()
+        try:
+            self._finish()
+        except Exception:
+            pass
+
+
+class _RcJob:
+    """Lets CancelToken.cancel() stop an rc job like it terminates a process."""
+
+    def __init__(self, backend, jobid):
+        self.backend = backend
+        self.jobid = jobid
+
+    def terminate(self):
+        try:
+            self.backend.call("job/stop", {"jobid": self.jobid})
+        except Exception:
+            pass
+
+
+class RcdBackend(SubprocessBackend):
+    mode = "rcd"
+    live_bwlimit = True
+
+    def __init__(self, rclone_bin, poll_interval=1.0, start_timeout=15):
+        super().__init__(rclone_bin)
+        self.poll_interval = poll_interval
+        self.start_timeout = start_timeout
+        self.calls = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._daemon = None
+        self._port = None
+        self._auth = None
+        self._bwlimit = None
+        self._remote_types = {}
+        self._gate = threading.Condition()
+        self._held = False
+        self._pending_bwlimit = None
+        self._in_flight = 0
+
+    # --- daemon lifecycle ---
+    def start(self):
+        with self._lock:
+            if self._daemon is not None and self._daemon.poll() is None:
+                return
+            with socket.socket() as s:
+                s.bind(("127.0.0.1", 0))
+                self._port = s.getsockname()[1]
+            user, password = "agent", secrets.token_urlsafe(24)
+            self._auth = "Basic " + base64.b64encode(f"{user}:{password}".encode()).decode()
+            self.process_count += 1
+            # Credentials go through the environment: command lines are visible to every local user.
+            self._daemon = subprocess.Popen(
+                [self.rclone_bin, "rcd", "--rc-addr", f"127.0.0.1:{self._port}"],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                env=dict(os.environ, RCLONE_RC_USER=user, RCLONE_RC_PASS=password)
+            )
+            self._local = threading.local() # old keep-alive connections point at the dead daemon
+        deadline = time.monotonic() + self.start_timeout
+        while time.monotonic() < deadline:
+            if self._daemon.poll() is not None:
+                raise RcloneError("rclone rcd exited during start-up")
+            try:
+                self.call("rc/noop", {}, _ensure=False)
+                print(f"✅ rclone rcd running on 127.0.0.1:{self._port}")
+                if self._bwlimit: # a restarted daemon starts unlimited
+                    self.call("core/bwlimit", {"rate": self._bwlimit}, _ensure=False)
+                return
+            except (OSError, http.client.HTTPException):
+                time.sleep(0.2)
+        self.close()
+        raise RcloneError("rclone rcd did not become ready")
+
+    def close(self):
+        with self._lock:
+            if self._daemon is not None and self._daemon.poll() is None:
+                self._daemon.terminate()
+                try:
+                    self._daemon.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    self._daemon.kill()
+            self._daemon = None
+
+    # --- HTTP ---
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = http.client.HTTPConnection("127.0.0.1", self._port, timeout=300)
+            self._local.conn = conn
+        return conn
+
+    def call(self, method, params, _ensure=True):
+        with self._gate:
+            while self._held:
+                self._gate.wait()
+            self._in_flight += 1
+        try:
+            return self._call(method, params, _ensure)
+        finally:
+            with self._gate:
+                self._in_flight -= 1
+                self._gate.notify_all()
+
+    def _call(self, method, params, _ensure):
+        if _ensure and (self._daemon is None or self._daemon.poll() is not None):
+            print("⚠️ rclone rcd is not running, restarting it...")
+            self.start()
+        body = json.dumps(params)
+        headers = {"Content-Type": "application/json", "Authorization": self._auth}
+        for attempt in (1, 2):
+            conn = self._connection()
+            try:
+                conn.request("POST", f"/{method}", body=body, headers=headers)
+                response = conn.getresponse()
+                payload = response.read()
+                break
+            except (OSError, http.client.HTTPException):
+                # Stale keep-alive connection: reconnect once.
+                conn.close()
+                self._local.conn = None
+                if attempt == 2:
+                    raise
+        self.calls += 1
+        try:
+            data = json.loads(payload.decode("utf-8") or "{}")
+        except ValueError:
+            data = {"error": payload.decode("utf-8", errors="replace")}
+        if response.status != 200:
+            message = data.get("error", f"HTTP {response.status}")
+            raise RcloneError(f"{method}: {message}",
+                              not_found=response.status == 404 or "not found" in message.lower())
+        return data
+
+    # --- process control (resource governor) ---
+    def pids(self):
+        daemon = self._daemon
+        running = [daemon.pid] if daemon is not None and daemon.poll() is None else []
+        return running + super().pids()
+
+    def hold(self, timeout):
+        """Lets in-flight rc calls finish and holds new ones. False (and nothing held) on timeout."""
+        deadline = time.monotonic() + timeout
+        with self._gate:
+            self._held = True
+            while self._in_flight:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.release_hold() # the gate is reentrant
+                    return False
+                self._gate.wait(remaining)
+            return True
+
+    def release_hold(self):
+        with self._gate:
+            rate, self._pending_bwlimit = self._pending_bwlimit, None
+            if rate is not None and self._held:
+                # Limit changed while suspended: in place before the held calls go on.
+                try:
+                    self._call("core/bwlimit", {"rate": rate}, _ensure=False)
+                except (RcloneError, OSError, http.client.HTTPException) as e:
+                    print(f"⚠️ Could not change bandwidth limit: {e}")
+            self._held = False
+            self._gate.notify_all()
+
+    @staticmethod
+    def _split(remote):
+        """rc operations take fs + remote; a full remote string is a valid fs with an empty path."""
+        return {"fs": remote, "remote": ""}
+
+    def set_bwlimit(self, rate):
+        """
+        Changes the daemon-wide limit; running transfers slow down or speed up
+        immediately. While the daemon is held (suspended) the change waits for
+        release_hold(), so the thread that owns the hold never blocks on it.
+        """
+        with self._gate:
+            if self._held:
+                self._pending_bwlimit = self._bwlimit = rate or "off"
+                return True
+        self.call("core/bwlimit", {"rate": rate or "off"})
+        self._bwlimit = rate or "off"
+        return True
+
+    # --- config ---
+    def version(self):
+        return self.call("core/version", {})["version"]
+
+    def config_path(self):
+        return self.call("config/paths", {})["config"]
+
+    def listremotes(self):
+        return [f"{name}:" for name in self.call("config/listremotes", {}).get("remotes") or []]
+
+    def config_create(self, name, remote_type, parameters):
+        self.call("config/create", {"name": name, "type": remote_type, "parameters": parameters})
+        self._remote_types.pop(name, None)
+
+    def _remote_type(self, remote):
+        """Backend type of a configured remote ("drive", ...), looked up once per name."""
+        name = remote_name(remote)
+        if name is None:
+            return None
+        if name not in self._remote_types:
+            try:
+                self._remote_types[name] = self.call("config/get", {"name": name}).get("type")
+            except RcloneError:
+                return None
+        return self._remote_types[name]
+
+    # --- transfers ---
+    def _transfer(self, command, src, dst, files_from, options, cancel_token, on_event):
+        if cancel_token is not None:
+            cancel_token.check()
+        params = {"srcFs": src, "dstFs": _with_params(dst, options, self._remote_type(dst)), "_async": True}
+        config = _rc_config(options)
+        if config:
+            params["_config"] = config
+        if files_from:
+            params["_filter"] = {"FilesFrom": [files_from]}
+        jobid = self.call(f"sync/{command}", params)["jobid"]
+        group = f"job/{jobid}"
+        handle = _RcJob(self, jobid)
+        if cancel_token is not None:
+            cancel_token.attach(handle)
+
+        last_stats = None
+        try:
+            while True:
+                status = self.call("job/status", {"jobid": jobid})
+                last_stats = stats_event(self.call("core/stats", {"group": group}))
+                if on_event:
+                    on_event(last_stats)
+                if status.get("finished"):
+                    break
+                time.sleep(self.poll_interval)
+        finally:
+            if cancel_token is not None:
+                cancel_token.detach(handle)
+            try:
+                self.call("core/stats-delete", {"group": group})
+            except Exception:
+                pass
+        if cancel_token is not None:
+            cancel_token.check()
+        if not status.get("success"):
+            raise RcloneError(status.get("error") or f"rclone {command} failed")
+        return last_stats
+
+    # --- operations ---
+    def list(self, remote, recursive=False, dirs_only=False, files_only=False, hash_type=None):
+        params = self._split(remote)
+        params["opt"] = {"recurse": recursive, "dirsOnly": dirs_only, "filesOnly": files_only}
+        if hash_type:
+            params["opt"].update({"showHash": True, "hashTypes": [hash_type]})
+        return self.call("operations/list", params).get("list") or []
+
+    def purge(self, remote):
+        self.call("operations/purge", self._split(remote))
+
+    def delete(self, remote, files_from=None):
+        params = {"fs": remote}
+        if files_from:
+            params["_filter"] = {"FilesFrom": [files_from]}
+        self.call("operations/delete", params)
+
+
+def create_backend(rclone_bin, mode="rcd"):
+    """Starts the requested backend, falling back to one process per operation."""
+    if mode == "rcd":
+        backend = RcdBackend(rclone_bin)
+        try:
+            backend.start()
+            return backend
+        except Exception as e:
+            print(f"⚠️ Could not start rclone rcd ({e}). Using one rclone process per operation.")
+    return SubprocessBackend(rclone_bin)
@@ -0,0 +1,183 @@
+"""
+Streaming parser for rclone's --use-json-log output and a throttled
+publisher for job progress.
+
+rclone writes one JSON object per line on stderr. RcloneLogParser turns that
+stream into typed events:
+
+- StatsEvent      periodic transfer stats (--stats N)
+- FileErrorEvent  an error tied to one file ("object" field)
+- RetryEvent      "Attempt 2/3 failed ..." whole-run retries
+- LogEvent        anything else (including non-JSON lines such as auth errors)
+
+Partial lines are buffered until their newline arrives, so the parser can be
+fed arbitrary chunks of text.
+
+StatePublisher merges progress fields and writes them at most once per
+`interval` seconds, so a 1-second stats stream costs one database update
+every few seconds instead of one per line.
+"""
+import collections
+import json
+import re
+import threading
+import time
+
+StatsEvent = collections.namedtuple("StatsEvent", [
+    "bytes", "total_bytes", "speed", "eta", "elapsed",
+    "checks", "total_checks", "transfers", "total_transfers",
+    "errors", "deletes", "transferring",
+])
+FileErrorEvent = collections.namedtuple("FileErrorEvent", ["path", "message"])
+RetryEvent = collections.namedtuple("RetryEvent", ["attempt", "max_attempts", "message"])
+LogEvent = collections.namedtuple("LogEvent", ["level", "message"])
+
+_RETRY_RE = re.compile(r"Attempt (\d+)/(\d+) failed")
+
+
+def stats_event(stats):
+    return StatsEvent(
+        bytes=stats.get("bytes", 0) or 0,
+        total_bytes=stats.get("totalBytes", 0) or 0,
+        speed=stats.get("speed", 0) or 0,
+        eta=stats.get("eta"),
+        elapsed=stats.get("elapsedTime", 0) or 0,
+        checks=stats.get("checks", 0) or 0,
+        total_checks=stats.get("totalChecks", 0) or 0,
+        transfers=stats.get("transfers", 0) or 0,
+        total_transfers=stats.get("totalTransfers", 0) or 0,
+        errors=stats.get("errors", 0) or 0,
+        deletes=stats.get("deletes", 0) or 0,
+        transferring=len(stats.get("transferring") or []),
+    )
+
+
+def merge_stats(first, second):
+    """Adds up the final StatsEvents of consecutive transfers (either may be None)."""
+    if first is None or second is None:
+        return first or second
+    return StatsEvent(
+        bytes=first.bytes + second.bytes,
+        total_bytes=first.total_bytes + second.total_bytes,
+        speed=second.speed,
+        eta=second.eta,
+        elapsed=first.elapsed + second.elapsed,
+        checks=first.checks + second.checks,
+        total_checks=first.total_checks + second.total_checks,
+        transfers=first.transfers + second.transfers,
+        total_transfers=first.total_transfers + second.total_transfers,
+        errors=first.errors + second.errors,
+        deletes=first.deletes + second.deletes,
+        transferring=second.transferring,
+    )
+
+
+def parse_line(line):
+    """Parses one rclone log line into an event (or None for blank lines)."""
+    line = line.strip()
+    if not line:
+        return None
+    try:
+        entry = json.loads(line)
+    except ValueError:
+        return LogEvent("error", line) # Raw output, e.g. config / auth failures
+    if not isinstance(entry, dict):
+        return LogEvent("info", line)
+
+    if "stats" in entry:
+        return stats_event(entry["stats"])
+
+    level = entry.get("level", "info")
+    msg = entry.get("msg", "")
+    match = _RETRY_RE.search(msg)
+    if match:
+        return RetryEvent(int(match.group(1)), int(match.group(2)), msg)
+    if level == "error" and entry.get("object"):
+        return FileErrorEvent(entry["object"], msg)
+    return LogEvent(level, msg)
+
+
+class RcloneLogParser:
+    def __init__(self):
+        self._buffer = ""
+
+    def feed(self, text):
+        """Feeds a chunk of output; returns the events for every completed line."""
+        self._buffer += text
+        *lines, self._buffer = self._buffer.split("\n")
+        return [e for e in map(parse_line, lines) if e is not None]
+
+    def close(self):
+        """Flushes a trailing line that never got its newline."""
+        rest, self._buffer = self._buffer, ""
+        event = parse_line(rest)
+        return [event] if event is not None else []
+
+    def iter_stream(self, stream):
+        """Yields events from a text stream until EOF."""
+        while True:
+            line = stream.readline()
+            if not line:
+                break
+            yield from self.feed(line)
+        yield from self.close()
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return "?"
+    seconds = int(seconds)
+    if seconds < 60:
+        return f"{seconds}s"
+    minutes, seconds = divmod(seconds, 60)
+    if minutes < 60:
+        return f"{minutes}m {seconds}s"
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h {minutes}m"
+
+
+def progress_fields(event):
+    """Numeric progress for runtime_state/{id}/job_states/{job}/progress."""
+    percent = round(100.0 * event.bytes / event.total_bytes, 1) if event.total_bytes else None
+    return {
+        "bytes": event.bytes,
+        "total_bytes": event.total_bytes,
+        "percent": percent,
+        "speed_bps": int(event.speed),
+        "eta_s": event.eta,
+        "files_checked": event.checks,
+        "files_transferred": event.transfers,
+        "files_total": event.total_transfers,
+        "errors": event.errors,
+        "updated": int(time.time()),
+    }
+
+
+class StatePublisher:
+    """
+    Coalesces state updates and writes them through write(dict) at most once
+    every `interval` seconds. Later values for the same key win.
+    """
+
+    def __init__(self, write, interval=5.0):
+        self._write = write
+        self.interval = interval
+        self._pending = {}
+        self._last = 0.0
+        self._lock = threading.Lock()
+
+    def publish(self, fields, force=False):
+        with self._lock:
+            self._pending.update(fields)
+            if not force and time.monotonic() - self._last < self.interval:
+                return
+            pending, self._pending = self._pending, {}
+            self._last = time.monotonic()
+        if pending:
+            try:
+                self._write(pending)
+            except Exception as e:
+                print(f"⚠️ Progress update failed: {e}")
+
+    def flush(self):
+        self.publish({}, force=True)
@@ -0,0 +1,549 @@
+"""
+Host-aware resource governor: keeps rclone out of the way of the people
+using the machine.
+
+While jobs run, the main loop calls Governor.tick() and the host is sampled
+every `interval` seconds:
+
+- CPU used by other programs (host CPU minus rclone's own share)
+- disk busy time
+- seconds since the last keyboard / mouse input (Windows only)
+
+From that the governor picks one of three levels, with hysteresis (a level
+goes up after `busy_samples` samples in a row, and down after `calm_samples`):
+
+- normal     the host is idle or not busy: full speed
+- throttled  someone is working, or CPU / disk is busy: rclone runs at
+             below-normal priority, the bandwidth limit drops to `bwlimit`
+             and new transfers use at most `transfers` / `checkers`
+- suspended  other programs need (almost) all the CPU: rclone is paused
+             outright, for at most `max_suspend` seconds at a time
+
+The daemon's bandwidth changes immediately; rclone cannot change the number
+of transfers of a running operation, so the caps apply from the next one
+(large uploads go out in checkpoint batches, so that is soon).
+
+Samplers, per platform:
+- Windows: GetSystemTimes, GetProcessTimes, PDH "% Idle Time" of the
+           physical disks, GetLastInputInfo (ctypes)
+- Linux:   /proc/stat, /proc/{pid}/stat, /proc/diskstats (no idle time)
+- else:    load average only
+
+    "governor": {"enabled": true, "idle_after": 120, "cpu_busy": 60, "cpu_suspend": 90,
+                 "disk_busy": 70, "bwlimit": "2M", "transfers": 2}
+"""
+import os
+import platform
+import signal
+import threading
+import time
+
+DEFAULTS = {
+    "enabled": True,
+    "interval": 5, # seconds between samples
+    "idle_after": 120, # seconds without input after which the user counts as away
+    "throttle_when_active": True, # throttle whenever someone is using the machine
+    "cpu_busy": 60, # % CPU used by other programs -> throttled
+    "cpu_suspend": 90, # % CPU used by other programs -> suspended
+    "disk_busy": 70, # % disk busy time while the user is active -> throttled
+    "bwlimit": "2M", # bandwidth limit while throttled
+    "transfers": 2, # caps while throttled (from the next rclone operation)
+    "checkers": 4,
+    "busy_samples": 2,
+    "calm_samples": 6,
+    "max_suspend": 900, # seconds; then throttled only, and no new suspension for as long
+}
+LEVELS = ["normal", "throttled", "suspended"]
+LOW_NICE = 10 # POSIX niceness for rclone while throttled
+HOLD_TIMEOUT = 10 # seconds to wait for in-flight rc calls before suspending the daemon
+RELEASE_HOLD_OFF = 30 # seconds without suspension after a forced release (e.g. force stop)
+
+
+def governor_policy(global_config):
+    """global_config `governor` on top of DEFAULTS (`"governor": false` turns it off)."""
+    value = global_config.get("governor", {})
+    policy = dict(DEFAULTS)
+    if isinstance(value, dict):
+        policy.update({k: v for k, v in value.items() if k in DEFAULTS})
+    elif not value:
+        policy["enabled"] = False
+    for key in ("interval", "idle_after", "cpu_busy", "cpu_suspend", "disk_busy", "max_suspend"):
+        policy[key] = float(policy[key])
+    for key in ("transfers", "checkers", "busy_samples", "calm_samples"):
+        policy[key] = max(1, int(policy[key]))
+    return policy
+
+
+# --- PROCESS CONTROL ---
+_WINDOWS = platform.system() == "Windows"
+PROCESS_SET_INFORMATION = 0x0200
+PROCESS_SUSPEND_RESUME = 0x0800
+PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+NORMAL_PRIORITY_CLASS = 0x20
+BELOW_NORMAL_PRIORITY_CLASS = 0x4000
+
+
+def _open_process(access, pid):
+    import ctypes
+    kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+    kernel32.OpenProcess.restype = ctypes.c_void_p
+    handle = kernel32.OpenProcess(access, False, pid)
+    if not handle:
+        raise ctypes.WinError(ctypes.get_last_error())
+    return kernel32, handle
+
+
+def set_process_priority(pid, low):
+    """Below-normal (low) or normal priority. False if it could not be changed (e.g. no rights to raise it)."""
+    import ctypes
+    try:
+        if _WINDOWS:
+            kernel32, handle = _open_process(PROCESS_SET_INFORMATION, pid)
+            try:
+                return bool(kernel32.SetPriorityClass(ctypes.c_void_p(handle),
+                                                      BELOW_NORMAL_PRIORITY_CLASS if low else NORMAL_PRIORITY_CLASS))
+            finally:
+                kernel32.CloseHandle(ctypes.c_void_p(handle))
+        os.setpriority(os.PRIO_PROCESS, pid, LOW_NICE if low else 0)
+        return True
+    except OSError:
+        return False
+
+
+def suspend_process(pid):
+    return _signal_process(pid, "NtSuspendProcess", "SIGSTOP")
+
+
+def resume_process(pid):
+    return _signal_process(pid, "NtResumeProcess", "SIGCONT")
+
+
+def _signal_process(pid, nt_call, posix_signal):
+    import ctypes
+    try:
+        if _WINDOWS:
+            kernel32, handle = _open_process(PROCESS_SUSPEND_RESUME, pid)
+            try:
+                return getattr(ctypes.WinDLL("ntdll"), nt_call)(ctypes.c_void_p(handle)) == 0
+            finally:
+                kernel32.CloseHandle(ctypes.c_void_p(handle))
+        os.kill(pid, getattr(signal, posix_signal))
+        return True
+    except OSError:
+        return False
+
+
+# --- SAMPLERS ---
+class _Sampler:
+    """Raw counters; HostSampler turns them into percentages. None means "not available here"."""
+
+    def cpu_times(self):
+        """(busy, total) CPU seconds of the whole host since boot."""
+        return None
+
+    def process_cpu(self, pid):
+        """CPU seconds used by one process."""
+        return None
+
+    def disk_busy(self):
+        """{disk: milliseconds spent doing I/O}, or a ready percentage as {"_percent": value}."""
+        return None
+
+    def idle_seconds(self):
+        return None
+
+
+class LinuxSampler(_Sampler):
+    def __init__(self):
+        self._ticks = os.sysconf("SC_CLK_TCK")
+        try:
+            self._disks = {name for name in os.listdir("/sys/block") if not name.startswith(("loop", "ram", "zram"))}
+        except OSError:
+            self._disks = set()
+
+    def cpu_times(self):
+        with open("/proc/stat") as f:
+            values = [int(v) for v in f.readline().split()[1:9]]
+        idle = values[3] + values[4] # idle + iowait
+        total = sum(values)
+        return (total - idle) / self._ticks, total / self._ticks
+
+    def process_cpu(self, pid):
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except (OSError, IndexError):
+            return None
+        return (int(fields[11]) + int(fields[12])) / self._ticks # utime + stime
+
+    def disk_busy(self):
+        busy = {}
+        with open("/proc/diskstats") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) > 12 and fields[2] in self._disks:
+                    busy[fields[2]] = int(fields[12]) # io_ticks
+        return busy
+
+
+class WindowsSampler(_Sampler):
+    PDH_FMT_DOUBLE = 0x200
+    DISK_COUNTER = "\\PhysicalDisk(_Total)\\% Idle Time"
+
+    def __init__(self):
+        import ctypes
+        from ctypes import wintypes
+
+        class FILETIME(ctypes.Structure):
+            _fields_ = [("low", wintypes.DWORD), ("high", wintypes.DWORD)]
+
+        class LASTINPUTINFO(ctypes.Structure):
+            _fields_ = [("cbSize", wintypes.UINT), ("dwTime", wintypes.DWORD)]
+
+        class PDH_FMT_COUNTERVALUE(ctypes.Structure):
+            _fields_ = [("CStatus", wintypes.DWORD), ("doubleValue", ctypes.c_double)]
+
+        self._FILETIME, self._LASTINPUTINFO, self._COUNTERVALUE = FILETIME, LASTINPUTINFO, PDH_FMT_COUNTERVALUE
+        self._kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+        self._kernel32.OpenProcess.restype = ctypes.c_void_p
+        self._user32 = ctypes.WinDLL("user32")
+        self._pdh = None
+        try:
+            pdh = ctypes.WinDLL("pdh")
+            self._query, self._counter = ctypes.c_void_p(), ctypes.c_void_p()
+            if (pdh.PdhOpenQueryW(None, None, ctypes.byref(self._query)) == 0
+                    and pdh.PdhAddEnglishCounterW(self._query, self.DISK_COUNTER, None, ctypes.byref(self._counter)) == 0):
+                pdh.PdhCollectQueryData(self._query)
+                self._pdh = pdh
+        except OSError:
+            pass
+
+    def _seconds(self, filetime):
+        return ((filetime.high << 32) | filetime.low) / 1e7
+
+    def cpu_times(self):
+        import ctypes
+        idle, kernel, user = self._FILETIME(), self._FILETIME(), self._FILETIME()
+        if not self._kernel32.GetSystemTimes(ctypes.byref(idle), ctypes.byref(kernel), ctypes.byref(user)):
+            return None
+        total = self._seconds(kernel) + self._seconds(user) # kernel time includes idle time
+        return total - self._seconds(idle), total
+
+    def process_cpu(self, pid):
+        import ctypes
+        handle = self._kernel32.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+        if not handle:
+            return None
+        try:
+            times = [self._FILETIME() for _ in range(4)] # creation, exit, kernel, user
+            if not self._kernel32.GetProcessTimes(ctypes.c_void_p(handle), *map(ctypes.byref, times)):
+                return None
+            return self._seconds(times[2]) + self._seconds(times[3])
+        finally:
+            self._kernel32.CloseHandle(ctypes.c_void_p(handle))
+
+    def disk_busy(self):
+        import ctypes
+        if self._pdh is None or self._pdh.PdhCollectQueryData(self._query) != 0:
+            return None
+        value = self._COUNTERVALUE()
+        if self._pdh.PdhGetFormattedCounterValue(self._counter, self.PDH_FMT_DOUBLE, None, ctypes.byref(value)) != 0:
+            return None
+        return {"_percent": max(0.0, 100.0 - value.doubleValue)}
+
+    def idle_seconds(self):
+        import ctypes
+        info = self._LASTINPUTINFO()
+        info.cbSize = ctypes.sizeof(info)
+        if not self._user32.GetLastInputInfo(ctypes.byref(info)):
+            return None
+        return ((self._kernel32.GetTickCount() - info.dwTime) & 0xFFFFFFFF) / 1000.0
+
+
+class LoadSampler(_Sampler):
+    """Fallback: the 1-minute load average stands in for CPU use."""
+
+    def cpu_times(self):
+        return None
+
+
+class HostSample:
+    def __init__(self, cpu=None, own_cpu=0.0, disk=None, idle_s=None):
+        self.cpu = cpu # % of all cores, whole host
+        self.own_cpu = own_cpu # % of all cores used by rclone
+        self.disk = disk # % busy time of the busiest disk
+        self.idle_s = idle_s # seconds since the last user input
+
+    @property
+    def other_cpu(self):
+        return None if self.cpu is None else max(0.0, self.cpu - self.own_cpu)
+
+    def fields(self):
+        def rounded(value):
+            return None if value is None else round(value, 1)
+        return {"cpu": rounded(self.cpu), "other_cpu": rounded(self.other_cpu), "disk": rounded(self.disk),
+                "idle_s": None if self.idle_s is None else int(self.idle_s)}
+
+
+class HostSampler:
+    """Turns counter readings into percentages over the time between two sample() calls."""
+
+    def __init__(self, sampler=None):
+        if sampler is None:
+            system = platform.system()
+            sampler = WindowsSampler() if system == "Windows" else LinuxSampler() if system == "Linux" else LoadSampler()
+        self.sampler = sampler
+        self._cpus = os.cpu_count() or 1
+        self._previous = None
+
+    def _read(self, pids):
+        def safe(read, *args):
+            try:
+                return read(*args)
+            except (OSError, ValueError):
+                return None
+        return {
+            "at": time.monotonic(),
+            "cpu": safe(self.sampler.cpu_times),
+            "own": {pid: safe(self.sampler.process_cpu, pid) for pid in pids},
+            "disk": safe(self.sampler.disk_busy),
+        }
+
+    def sample(self, pids):
+        """A HostSample, or None on the first call (percentages need two readings)."""
+        current = self._read(pids)
+        previous, self._previous = self._previous, current
+        idle_s = self.sampler.idle_seconds()
+        if previous is None:
+            return None
+        elapsed = current["at"] - previous["at"]
+        if elapsed <= 0:
+            return None
+        sample = HostSample(idle_s=idle_s)
+        if current["cpu"] and previous["cpu"]:
+            busy, total = (c - p for c, p in zip(current["cpu"], previous["cpu"]))
+            sample.cpu = 100.0 * busy / total if total > 0 else None
+        elif isinstance(self.sampler, LoadSampler) and hasattr(os, "getloadavg"):
+            sample.cpu = min(100.0, 100.0 * os.getloadavg()[0] / self._cpus)
+        own = sum(now - previous["own"][pid] for pid, now in current["own"].items()
+                  if now is not None and previous["own"].get(pid) is not None)
+        sample.own_cpu = 100.0 * own / (elapsed * self._cpus)
+        if current["disk"] and "_percent" in current["disk"]:
+            sample.disk = current["disk"]["_percent"]
+        elif current["disk"] and previous["disk"]:
+            deltas = [ms - previous["disk"].get(disk, ms) for disk, ms in current["disk"].items()]
+            sample.disk = min(100.0, max(deltas or [0]) / (elapsed * 10.0)) # ms busy per s -> %
+        return sample
+
+
+def wanted_level(sample, policy):
+    """(level, reason) the host asks for right now, before hysteresis."""
+    other = sample.other_cpu
+    active = sample.idle_s is not None and sample.idle_s < policy["idle_after"]
+    if other is not None and other >= policy["cpu_suspend"]:
+        return "suspended", f"CPU {other:.0f}% used by other programs"
+    if other is not None and other >= policy["cpu_busy"]:
+        return "throttled", f"CPU {other:.0f}% used by other programs"
+    if active and sample.disk is not None and sample.disk >= policy["disk_busy"]:
+        return "throttled", f"disk {sample.disk:.0f}% busy while the computer is in use"
+    if active and policy["throttle_when_active"]:
+        return "throttled", "computer in use"
+    return "normal", "host idle" if sample.idle_s is not None else "host not busy"
+
+
+# --- GOVERNOR ---
+class Governor:
+    def __init__(self, sampler=None, report=None):
+        """
+        report(job_id, record) receives each running job's throttling record when it changes.
+        The host sampler is created on the first tick (it loads PDH on Windows).
+        """
+        self.sampler = sampler
+        self.report = report
+        self.policy = governor_policy({})
+        self.level = "normal"
+        self.reason = None
+        self.since = time.time()
+        self.last_sample = None
+        self._lock = threading.Lock() # job records (read from worker threads)
+        self._control = threading.RLock() # level changes (main loop vs. force stop)
+        self._last_tick = 0.0
+        self._up = self._down = 0
+        self._no_suspend_until = 0.0
+        self._lowered = set() # pids running at below-normal priority
+        self._suspended = set()
+        self._backend = None
+        self._jobs = {} # job_id -> record
+
+    @property
+    def bwlimit(self):
+        """Limit the governor asks for (None at normal level)."""
+        return self.policy["bwlimit"] if self.level != "normal" and self.policy["enabled"] else None
+
+    def limit_options(self, options, live_bwlimit):
+        """rclone options for a new operation, capped while throttled or suspended."""
+        if self.level == "normal" or not self.policy["enabled"]:
+            return options
+        options = dict(options or {})
+        for name in ("transfers", "checkers"):
+            options[name] = min(int(options.get(name) or self.policy[name]), self.policy[name])
+        if not live_bwlimit and self.policy["bwlimit"]:
+            options["bwlimit"] = self.policy["bwlimit"] # a per-process timetable gives way while throttled
+        return options
+
+    def job_totals(self, job_id):
+        """Seconds the job has spent throttled / suspended so far."""
+        with self._lock:
+            record = self._jobs.get(job_id)
+            if record is None:
+                return {"throttled_s": 0, "suspended_s": 0, "changes": 0}
+            self._account(time.time())
+            return {k: record[k] for k in ("throttled_s", "suspended_s", "changes")}
+
+    def tick(self, backend, running, global_config, now=None):
+        """
+        Samples the host (every `interval` seconds) while jobs run and moves
+        rclone between levels. Returns the new level when it changed, else None.
+        """
+        with self._control:
+            return self._tick(backend, running, global_config, now or time.time())
+
+    def _tick(self, backend, running, global_config, now):
+        self.policy = policy = governor_policy(global_config)
+        if now - self._last_tick < policy["interval"]:
+            return None
+        if self.sampler is None:
+            self.sampler = HostSampler()
+        self._last_tick = now
+        self._backend = backend
+        with self._lock:
+            self._account(now)
+            finished = [job_id for job_id in self._jobs if job_id not in running]
+            started = [job_id for job_id in running if job_id not in self._jobs]
+            for job_id in started:
+                self._jobs[job_id] = {"level": self.level, "reason": self.reason, "since": int(now),
+                                      "throttled_s": 0.0, "suspended_s": 0.0, "changes": 0}
+            ended = {job_id: self._jobs.pop(job_id) for job_id in finished}
+        for job_id, record in ended.items():
+            self._publish(job_id, dict(record, finished=int(now)))
+
+        if not running or not policy["enabled"]:
+            self.sampler.sample([]) # keep the baseline fresh for the next job
+            self._up = self._down = 0
+            return self._change("normal", "no jobs running" if policy["enabled"] else "governor off", backend, now)
+
+        pids = backend.pids()
+        sample = self.sampler.sample(pids)
+        if sample is None:
+            return None
+        self.last_sample = sample
+        wanted, reason = wanted_level(sample, policy)
+        if wanted == "suspended" and now < self._no_suspend_until:
+            wanted = "throttled"
+        if self.level == "suspended" and now - self.since >= policy["max_suspend"]:
+            self._no_suspend_until = now + policy["max_suspend"]
+            self._up = self._down = 0
+            return self._change("throttled", f"suspended for {policy['max_suspend']:.0f}s, resuming throttled",
+                                backend, now)
+
+        rank, current = LEVELS.index(wanted), LEVELS.index(self.level)
+        if rank > current:
+            self._up, self._down = self._up + 1, 0
+            if self._up < policy["busy_samples"]:
+                wanted = self.level
+        elif rank < current:
+            self._up, self._down = 0, self._down + 1
+            if self._down < policy["calm_samples"]:
+                wanted = self.level
+        else:
+            self._up = self._down = 0
+
+        if wanted != self.level:
+            self._up = self._down = 0
+            return self._change(wanted, reason, backend, now)
+        # Processes started since the last change (one per operation in subprocess mode) join the level.
+        self._apply_processes(backend, pids)
+        return None
+
+    def release(self, backend=None, hold_off=RELEASE_HOLD_OFF):
+        """Back to normal at once (force stop, shutdown); no suspension for hold_off seconds."""
+        with self._control:
+            self._no_suspend_until = time.time() + hold_off
+            backend = backend or self._backend
+            if backend is not None:
+                self._change("normal", "released", backend, time.time())
+
+    # --- internals ---
+    def _account(self, now):
+        """Adds the time since the last accounting to every running job's total for the current level."""
+        for record in self._jobs.values():
+            last = record.get("_accounted", now)
+            if self.level != "normal":
+                record[f"{self.level}_s"] += now - last
+            record["_accounted"] = now
+
+    def _change(self, level, reason, backend, now):
+        if level == self.level:
+            return None
+        with self._lock:
+            self._account(now)
+        if self.level == "suspended":
+            for pid in self._suspended:
+                resume_process(pid)
+            self._suspended.clear()
+            backend.release_hold()
+        if level == "suspended" and not self._suspend(backend):
+            level, reason = "throttled", f"{reason} (rclone busy, throttled instead)"
+        if level != "normal":
+            self._apply_processes(backend, backend.pids(), level)
+        else:
+            for pid in self._lowered:
+                set_process_priority(pid, low=False)
+            self._lowered.clear()
+        print(f"🎛️ Governor: {self.level} -> {level} ({reason})")
+        self.level, self.reason, self.since = level, reason, now
+        with self._lock:
+            updates = []
+            for job_id, record in self._jobs.items():
+                record.update({"level": level, "reason": reason, "since": int(now), "changes": record["changes"] + 1})
+                updates.append((job_id, dict(record)))
+        for job_id, record in updates:
+            self._publish(job_id, record)
+        return level
+
+    def _suspend(self, backend):
+        if not backend.hold(HOLD_TIMEOUT): # never stop the daemon in the middle of an rc call
+            return False
+        for pid in backend.pids():
+            if suspend_process(pid):
+                self._suspended.add(pid)
+        if not self._suspended:
+            backend.release_hold()
+            return False
+        return True
+
+    def _apply_processes(self, backend, pids, level=None):
+        level = level or self.level
+        if level == "normal":
+            return
+        for pid in pids:
+            if pid not in self._lowered and set_process_priority(pid, low=True):
+                self._lowered.add(pid)
+            if level == "suspended" and pid not in self._suspended and suspend_process(pid):
+                self._suspended.add(pid)
+        live = set(pids)
+        self._lowered &= live | self._suspended
+
+    def _publish(self, job_id, record):
+        if self.report is None:
+            return
+        record = {k: v for k, v in record.items() if not k.startswith("_")}
+        for key in ("throttled_s", "suspended_s"):
+            record[key] = round(record[key], 1)
+        if self.last_sample is not None:
+            record.update(self.last_sample.fields())
+        record["updated"] = int(time.time())
+        try:
+            self.report(job_id, record)
+        except Exception as e:
+            print(f"⚠️ Governor report failed: {e}")
@@ -0,0 +1,460 @@
+"""
+Point-in-time restore of Backup_* snapshots (rclone engine).
+
+A restore picks one snapshot folder of a job, either by name or as the
+newest one taken at or before a point in time, optionally narrowed to a
+set of files/folders, and downloads it into a local target folder:
+
+1. the snapshot is resolved into a file list: one recursive lsjson (with
+   hashes) per folder that holds data; incremental snapshots spread over
+   the folders their manifest points to,
+2. files are downloaded in batches (`rclone copy --files-from`), several
+   batches at once, each with its own transfers,
+3. every downloaded file is checked against the remote size and hash, and
+   batches that failed are retried once,
+4. verified files are appended to a checkpoint journal under config_dir,
+   so an interrupted restore (force stop, crash, reboot) picks up where it
+   left off when the same request is made again, or at the next start.
+
+Request (control/{agent}/restore):
+
+    job_id      job whose snapshots are restored
+    snapshot    exact Backup_ folder, or
+    at          "YYYY-MM-DD HH:MM[:SS]": newest snapshot at or before this time (default: newest)
+    paths       files/folders relative to the source root (default: everything)
+    target      local folder to restore into (default: next to the source, never the source itself)
+    workers     batches downloaded at once (default 4)
+    transfers   rclone transfers per batch (default 4)
+    verify      hash-check downloaded files (default true)
+    hash_type   md5 (default), sha1 or sha256; must be supported by the remote
+
+From the command line (`python restore.py` or `agent.py restore`, same
+arguments) against a job root, e.g. on a replacement machine:
+
+    python restore.py gdrive:Backups/Tally --list
+    python restore.py gdrive:Backups/Tally --at "2025-01-02 21:00" --target D:\\Restore --path Company
+"""
+import datetime
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from integrity import HASH_TYPES, hash_file
+from retention import list_job_root, parse_snapshot_time
+from snapshots import MANIFEST_NAME, restore_sources
+
+DEFAULT_WORKERS = 4
+DEFAULT_TRANSFERS = 4
+MULTI_THREAD_STREAMS = 4 # large files are fetched in parallel ranges
+BATCH_FILES = 200
+BATCH_BYTES = 256 * 1024 * 1024
+MAX_REPORTED = 20 # failed paths listed in job_states
+
+
+def parse_time(text):
+    """"YYYY-MM-DD[ HH:MM[:SS]]" (or a Backup_ folder name) -> datetime."""
+    text = str(text).strip()
+    parsed = parse_snapshot_time(text)
+    if parsed:
+        return parsed
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M", "%Y-%m-%d"):
+        try:
+            return datetime.datetime.strptime(text, fmt)
+        except ValueError:
+            pass
+    raise ValueError(f"Unrecognised point in time: {text!r}")
+
+
+def list_snapshots(rclone, job_root):
+    """Backup_ folders under a job root (e.g. "gdrive:Backups/Tally"), oldest first."""
+    names = [name for name in list_job_root(rclone, job_root) if parse_snapshot_time(name)]
+    return sorted(names, key=parse_snapshot_time)
+
+
+def pick_snapshot(snapshots, snapshot=None, at=None):
+    """The requested snapshot: by name, the newest at or before `at`, or the newest overall."""
+    if snapshot:
+        if snapshot not in snapshots:
+            raise ValueError(f"Snapshot {snapshot} not found")
+        return snapshot
+    if at is not None:
+        when = parse_time(at) if not isinstance(at, datetime.datetime) else at
+        candidates = [name for name in snapshots if parse_snapshot_time(name) <= when]
+        if not candidates:
+            raise ValueError(f"No snapshot taken at or before {when:%Y-%m-%d %H:%M:%S}")
+        return candidates[-1]
+    if not snapshots:
+        raise ValueError("No snapshots found")
+    return snapshots[-1]
+
+
+def normalise_paths(paths):
+    if not paths:
+        return None
+    if isinstance(paths, str):
+        paths = [paths]
+    cleaned = sorted({str(p).replace("\\", "/").strip("/") for p in paths} - {""})
+    return cleaned or None
+
+
+def _selected(path, paths):
+    return paths is None or any(path == p or path.startswith(p + "/") for p in paths)
+
+
+def default_target(source_path, snapshot):
+    """A sibling of the source folder, so a restore never overwrites live data unless asked to."""
+    source = os.path.normpath(source_path or os.getcwd())
+    return os.path.join(os.path.dirname(source), f"{os.path.basename(source)}_Restore_{snapshot[len('Backup_'):]}")
+
+
+def restore_request(request, job_config, global_config):
+    """Fills in the defaults of a restore request (see module docstring)."""
+    request = dict(request or {})
+    hash_type = str(request.get("hash_type", "md5")).lower()
+    if hash_type not in HASH_TYPES:
+        raise ValueError(f"Unsupported hash_type {hash_type!r}")
+    defaults = global_config.get("restore") or {}
+    return {
+        "job_id": request.get("job_id"),
+        "snapshot": request.get("snapshot"),
+        "at": request.get("at"),
+        "paths": normalise_paths(request.get("paths")),
+        "target": request.get("target"),
+        "workers": max(1, int(request.get("workers", defaults.get("workers", DEFAULT_WORKERS)))),
+        "transfers": max(1, int(request.get("transfers", defaults.get("transfers", DEFAULT_TRANSFERS)))),
+        "verify": bool(request.get("verify", defaults.get("verify", True))),
+        "hash_type": hash_type,
+    }
+
+
+# --- PLAN ---
+class RestorePlan:
+    def __init__(self, snapshot, files):
+        self.snapshot = snapshot
+        self.files = files # {path: (folder holding it, size, hash or None)}
+
+    @property
+    def total_bytes(self):
+        return sum(max(0, size) for _, size, _ in self.files.values())
+
+
+def plan_restore(rclone, catalog, job_root, snapshot, paths=None, hash_type="md5"):
+    """
+    Resolves a snapshot (full or incremental) into a RestorePlan.
+    catalog is the job's SnapshotCatalog, or None when manifests are unknown.
+    """
+    manifest = catalog.load(snapshot) if catalog is not None else None
+    if manifest is None:
+        sources = {snapshot: None} # full snapshot: everything in its own folder
+    else:
+        wanted = {p: m for p, m in manifest.get("files", {}).items() if _selected(p, paths)}
+        sources = restore_sources({"files": wanted})
+
+    files = {}
+    for folder, members in sorted(sources.items()):
+        members = set(members) if members is not None else None
+        found = set()
+        for item in rclone.list(f"{job_root}/{folder}", recursive=True, files_only=True, hash_type=hash_type):
+            path = item["Path"]
+            if path == MANIFEST_NAME or not _selected(path, paths):
+                continue
+            if members is not None and path not in members:
+                continue
+            files[path] = (folder, item.get("Size", -1), (item.get("Hashes") or {}).get(hash_type))
+            found.add(path)
+        if members is not None:
+            missing = members - found
+            if missing:
+                raise RuntimeError(f"{len(missing)} files of {snapshot} are missing from {folder}, "
+                                   f"e.g. {sorted(missing)[0]}")
+    return RestorePlan(snapshot, files)
+
+
+def plan_batches(plan, pending, max_files=BATCH_FILES, max_bytes=BATCH_BYTES):
+    """Splits the pending paths into (folder, [paths]) download batches, large files first."""
+    by_folder = {}
+    for path in pending:
+        by_folder.setdefault(plan.files[path][0], []).append(path)
+    batches = []
+    for folder, paths in sorted(by_folder.items()):
+        paths.sort(key=lambda p: -plan.files[p][1])
+        batch, size = [], 0
+        for path in paths:
+            if batch and (len(batch) >= max_files or size + plan.files[path][1] > max_bytes):
+                batches.append((folder, batch))
+                batch, size = [], 0
+            batch.append(path)
+            size += max(0, plan.files[path][1])
+        if batch:
+            batches.append((folder, batch))
+    return batches
+
+
+# --- CHECKPOINT JOURNAL ---
+def restore_id(request):
+    """Stable id of a restore: the same job, snapshot, paths and target resume the same journal."""
+    key = json.dumps([request["job_id"], request["snapshot"], request["paths"],
+                      os.path.normcase(os.path.abspath(request["target"]))])
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+
+class RestoreJournal:
+    """
+    Append-only checkpoint of one restore (config_dir/restores/{id}.jsonl):
+    the request, then one line per verified batch, then a final line.
+    A restore that was cancelled, or that ended with files failing
+    verification, is marked stopped: it is not resumed at start-up, but
+    asking for it again still continues from the checkpoint.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.request = None
+        self.done = set()
+        self.finished = None
+        self.stopped = None
+        self._lock = threading.Lock()
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue # torn last line after a crash
+                    if "request" in record:
+                        self.request = record["request"]
+                    self.done.update(record.get("done", ()))
+                    self.finished = record.get("finished", self.finished)
+                    if "stopped" in record or "resumed" in record:
+                        self.stopped = record.get("reason") if "stopped" in record else None
+        except OSError:
+            pass
+
+    def start(self, request):
+        """Starts a new journal, or continues an unfinished one. Returns True when resuming."""
+        if self.request is None or self.finished:
+            self.request, self.done, self.finished, self.stopped = request, set(), None, None
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._write({"request": request, "started": time.strftime("%Y-%m-%d %H:%M:%S")}, mode="w")
+            return False
+        self.stopped = None
+        self._write({"resumed": time.strftime("%Y-%m-%d %H:%M:%S")})
+        return True
+
+    def record(self, paths):
+        with self._lock:
+            self.done.update(paths)
+            self._write({"done": sorted(paths)})
+
+    def finish(self, summary):
+        self.finished = time.strftime("%Y-%m-%d %H:%M:%S")
+        self._write({"finished": self.finished, "summary": summary})
+
+    def stop(self, reason):
+        self.stopped = reason
+        self._write({"stopped": time.strftime("%Y-%m-%d %H:%M:%S"), "reason": reason})
+
+    def _write(self, record, mode="a"):
+        with open(self.path, mode, encoding="utf-8") as f:
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def unfinished_restores(journal_dir):
+    """Requests of restores interrupted by a crash or shutdown, for resuming at start-up."""
+    try:
+        names = sorted(os.listdir(journal_dir))
+    except OSError:
+        return []
+    requests = []
+    for name in names:
+        if name.endswith(".jsonl"):
+            journal = RestoreJournal(os.path.join(journal_dir, name))
+            if journal.request and not journal.finished and not journal.stopped:
+                requests.append(journal.request)
+    return requests
+
+
+# --- DOWNLOAD ---
+class RestoreResult:
+    def __init__(self, plan, target, resumed):
+        self.snapshot = plan.snapshot
+        self.target = target
+        self.files_total = len(plan.files)
+        self.bytes_total = plan.total_bytes
+        self.resumed = resumed # files already restored by an earlier, interrupted attempt
+        self.files_done = resumed
+        self.bytes_done = 0
+        self.failed = [] # (path, reason)
+        self._lock = threading.Lock()
+
+    def add(self, files, size):
+        with self._lock:
+            self.files_done += files
+            self.bytes_done += size
+
+    def fail(self, failed):
+        with self._lock:
+            self.failed += failed
+
+    def summary(self):
+        return {
+            "snapshot": self.snapshot,
+            "target": self.target,
+            "files_total": self.files_total,
+            "files_done": self.files_done,
+            "bytes_total": self.bytes_total,
+            "bytes_done": self.bytes_done,
+            "resumed": self.resumed,
+            "failed": len(self.failed),
+            "problems": [f"{path}: {reason}" for path, reason in sorted(self.failed)[:MAX_REPORTED]],
+        }
+
+
+def _check(target, path, size, expected_hash, hash_type, verify):
+    """None if the restored copy matches the remote, otherwise the reason it does not."""
+    local = os.path.join(target, *path.split("/"))
+    try:
+        st = os.stat(local)
+    except OSError:
+        return "not downloaded"
+    if size >= 0 and st.st_size != size:
+        return f"size {st.st_size}, expected {size}"
+    if verify and expected_hash and hash_file(local, hash_type) != expected_hash.lower():
+        return f"{hash_type} mismatch"
+    return None
+
+
+def run_restore(rclone, job_root, plan, target, journal, workers=DEFAULT_WORKERS, transfers=DEFAULT_TRANSFERS,
+                verify=True, hash_type="md5", cancel_token=None, on_progress=None):
+    """
+    Downloads the files of plan not yet in the journal into target, verifies
+    them and records each verified batch. Returns a RestoreResult.
+    """
+    pending = [path for path in plan.files if path not in journal.done]
+    result = RestoreResult(plan, target, len(plan.files) - len(pending))
+    os.makedirs(target, exist_ok=True)
+    list_dir = os.path.dirname(journal.path)
+    options = {"transfers": transfers, "checkers": transfers * 2,
+               "multi-thread-streams": MULTI_THREAD_STREAMS, "no-traverse": True}
+    name = os.path.splitext(os.path.basename(journal.path))[0]
+
+    def download(index, batch, final):
+        folder, paths = batch
+        if cancel_token is not None:
+            cancel_token.check()
+        list_path = os.path.join(list_dir, f"{name}_{int(final)}_{index}.txt")
+        with open(list_path, "w", encoding="utf-8") as f:
+            f.writelines(path + "\n" for path in paths)
+        error = None
+        try:
+            rclone.copy(f"{job_root}/{folder}", target, files_from=list_path, options=options,
+                        cancel_token=cancel_token)
+        except Exception as e:
+            if cancel_token is not None:
+                cancel_token.check()
+            error = str(e)
+        finally:
+            os.remove(list_path)
+
+        ok, failed = [], []
+        for path in paths:
+            _, size, expected = plan.files[path]
+            reason = _check(target, path, size, expected, hash_type, verify)
+            if reason is None:
+                ok.append(path)
+            else:
+                failed.append((path, error or reason))
+                if reason != "not downloaded":
+                    try:
+                        os.remove(os.path.join(target, *path.split("/"))) # never leave a bad copy behind
+                    except OSError:
+                        pass
+        if ok:
+            journal.record(ok)
+            result.add(len(ok), sum(max(0, plan.files[p][1]) for p in ok))
+        if final:
+            result.fail(failed)
+        if on_progress:
+            on_progress(result)
+        return [path for path, _ in failed]
+
+    # Second pass: batches that failed (network error, bad copy) are downloaded once more.
+    for final in (False, True):
+        batches = plan_batches(plan, pending)
+        if not batches:
+            break
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="restore") as pool:
+            futures = [pool.submit(download, index, batch, final) for index, batch in enumerate(batches)]
+            try:
+                pending = [path for future in futures for path in future.result()]
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+    return result
+
+
+# --- CLI ---
+def main(argv=None, rclone=None):
+    import argparse
+    from rclone_backend import create_backend
+    from snapshots import SnapshotCatalog
+
+    parser = argparse.ArgumentParser(description="Restore a Backup_ snapshot from a job root.")
+    parser.add_argument("job_root", help='remote job root, e.g. "gdrive:Backups/Tally"')
+    parser.add_argument("--list", action="store_true", help="list the snapshots and exit")
+    parser.add_argument("--snapshot", help="exact Backup_ folder to restore")
+    parser.add_argument("--at", help='newest snapshot at or before "YYYY-MM-DD HH:MM[:SS]"')
+    parser.add_argument("--path", action="append", dest="paths", help="file or folder to restore (repeatable)")
+    parser.add_argument("--target", help="local folder to restore into")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="batches downloaded at once")
+    parser.add_argument("--transfers", type=int, default=DEFAULT_TRANSFERS, help="rclone transfers per batch")
+    parser.add_argument("--no-verify", action="store_true", help="skip the hash check")
+    parser.add_argument("--hash-type", choices=HASH_TYPES, default="md5")
+    parser.add_argument("--rclone", default="rclone", help="rclone binary")
+    args = parser.parse_args(argv)
+
+    own_backend = rclone is None
+    rclone = rclone or create_backend(args.rclone, "subprocess")
+    try:
+        snapshots = list_snapshots(rclone, args.job_root)
+        if args.list:
+            for name in snapshots:
+                print(name)
+            return 0
+        snapshot = pick_snapshot(snapshots, args.snapshot, args.at)
+        target = args.target or os.path.join(os.getcwd(), f"Restore_{snapshot[len('Backup_'):]}")
+        request = {"job_id": args.job_root, "snapshot": snapshot, "paths": normalise_paths(args.paths),
+                   "target": target}
+        # Journal and cached manifests live next to the target, so re-running the command resumes.
+        work_dir = os.path.normpath(target) + ".restore"
+        journal = RestoreJournal(os.path.join(work_dir, f"{restore_id(request)}.jsonl"))
+        journal.start(request)
+        catalog = SnapshotCatalog(rclone, os.path.join(work_dir, "manifests"), "", args.job_root)
+        plan = plan_restore(rclone, catalog, args.job_root, snapshot, request["paths"], args.hash_type)
+        print(f"📥 Restoring {snapshot}: {len(plan.files)} files into {target}")
+
+        def progress(result):
+            print(f"   {result.files_done}/{result.files_total} files, {result.bytes_done} bytes")
+
+        result = run_restore(rclone, args.job_root, plan, target, journal, args.workers, args.transfers,
+                             not args.no_verify, args.hash_type, on_progress=progress)
+        summary = result.summary()
+        if result.failed:
+            journal.stop("failed")
+        else:
+            journal.finish(summary)
+        print(json.dumps(summary, indent=1))
+        return 1 if result.failed else 0
+    finally:
+        if own_backend:
+            rclone.close()
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
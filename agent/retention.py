@@ -0,0 +1,191 @@
+"""
+Retention engine for Backup_* snapshot folders.
+
+One `rclone lsjson` per job root gives every snapshot folder (and, for a
+dry run, every file size in a single recursive listing). The keep set is
+computed in memory with a grandfather-father-son policy and expired folders
+are purged in parallel on a small thread pool.
+
+Policy keys (job `retention`, falling back to global_config `retention_policy`):
+
+    keep_last           newest N snapshots, always kept (default 1)
+    days                keep everything younger than N days (legacy behaviour)
+    keep_hourly_hours   newest snapshot of each hour for the last N hours
+    keep_daily_days     newest snapshot of each day for the last N days
+    keep_weekly_weeks   newest snapshot of each ISO week for the last N weeks
+    keep_monthly_months newest snapshot of each month for the last N months
+    dry_run             compute and report the plan, purge nothing
+
+A policy without any positive rule (e.g. `{"days": 0}` or `{"days": ""}`
+from an empty field) means retention is off, as it always has.
+"""
+import collections
+import datetime
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+SNAPSHOT_RE = re.compile(r"^Backup_(\d{4}-\d{2}-\d{2})(?:_(\d{2}-\d{2}-\d{2}))?")
+DEFAULT_PURGE_WORKERS = 4
+KEEP_RULES = ("keep_last", "days", "keep_hourly_hours", "keep_daily_days", "keep_weekly_weeks",
+              "keep_monthly_months")
+
+
+def parse_snapshot_time(name):
+    """Backup_YYYY-MM-DD_HH-MM-SS (as written by perform_backup) -> datetime, or None."""
+    match = SNAPSHOT_RE.match(name)
+    if not match:
+        return None
+    try:
+        if match.group(2):
+            return datetime.datetime.strptime(f"{match.group(1)}_{match.group(2)}", "%Y-%m-%d_%H-%M-%S")
+        return datetime.datetime.strptime(match.group(1), "%Y-%m-%d")
+    except ValueError:
+        return None
+
+
+def list_job_root(rclone, remote_root, with_sizes=False):
+    """
+    Lists the snapshot folders under a job root in one rclone call.
+    Returns {folder_name: size_in_bytes or None}.
+    """
+    if with_sizes:
+        items = rclone.list(remote_root, recursive=True, files_only=True)
+    else:
+        items = rclone.list(remote_root, dirs_only=True)
+
+    folders = {}
+    for item in items:
+        top = item["Path"].split("/", 1)[0]
+        if with_sizes:
+            if "/" not in item["Path"]:
+                continue # loose file at the job root
+            folders[top] = folders.get(top, 0) + max(0, item.get("Size", 0))
+        else:
+            folders[top] = None
+    return folders
+
+
+def _number(policy, key):
+    try:
+        return int(policy.get(key) or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def retention_enabled(policy):
+    """True when the policy has at least one positive keep rule; anything else disables retention."""
+    return bool(policy) and any(_number(policy, key) > 0 for key in KEEP_RULES)
+
+
+def _bucket_keep(snapshots, key, cutoff, reason, keep):
+    """Keeps the newest snapshot of every bucket that is newer than cutoff."""
+    seen = set()
+    for name, when in snapshots: # newest first
+        if when < cutoff:
+            break
+        bucket = key(when)
+        if bucket not in seen:
+            seen.add(bucket)
+            keep[name].append(reason)
+
+
+def compute_keep_set(snapshot_times, policy, now=None):
+    """
+    snapshot_times is {name: datetime}. Returns {name: [reasons]} for every
+    snapshot the policy keeps.
+    """
+    now = now or datetime.datetime.now()
+    snapshots = sorted(snapshot_times.items(), key=lambda item: item[1], reverse=True)
+    keep = collections.defaultdict(list)
+
+    def number(key):
+        return _number(policy, key)
+
+    for name, _ in snapshots[:max(number("keep_last") if "keep_last" in policy else 1, 0)]:
+        keep[name].append("last")
+
+    days = number("days")
+    if days:
+        cutoff = now - datetime.timedelta(days=days)
+        for name, when in snapshots:
+            if when >= cutoff:
+                keep[name].append("days")
+
+    hours = number("keep_hourly_hours")
+    if hours:
+        _bucket_keep(snapshots, lambda t: t.strftime("%Y-%m-%d %H"),
+                     now - datetime.timedelta(hours=hours), "hourly", keep)
+    daily = number("keep_daily_days")
+    if daily:
+        _bucket_keep(snapshots, lambda t: t.date(), now - datetime.timedelta(days=daily), "daily", keep)
+    weekly = number("keep_weekly_weeks")
+    if weekly:
+        _bucket_keep(snapshots, lambda t: t.isocalendar()[:2],
+                     now - datetime.timedelta(weeks=weekly), "weekly", keep)
+    monthly = number("keep_monthly_months")
+    if monthly:
+        _bucket_keep(snapshots, lambda t: (t.year, t.month),
+                     now - datetime.timedelta(days=31 * monthly), "monthly", keep)
+    return dict(keep)
+
+
+class RetentionPlan:
+    def __init__(self, keep, purge, sizes, dry_run):
+        self.keep = keep # {name: [reasons]}
+        self.purge = purge # [names], oldest first
+        self.sizes = sizes # {name: bytes or None}
+        self.dry_run = dry_run
+
+    @property
+    def remaining(self):
+        return sorted(self.keep)
+
+    @property
+    def reclaim_bytes(self):
+        return sum(self.sizes.get(name) or 0 for name in self.purge)
+
+    def summary(self):
+        return {
+            "dry_run": self.dry_run,
+            "keep": len(self.keep),
+            "purge": list(self.purge),
+            "reclaim_bytes": self.reclaim_bytes if any(v is not None for v in self.sizes.values()) else None,
+            "computed": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        }
+
+
+def plan_retention(rclone, remote_root, policy, now=None):
+    """Lists the job root once and works out what the policy keeps and purges."""
+    dry_run = bool(policy.get("dry_run"))
+    folders = list_job_root(rclone, remote_root, with_sizes=dry_run)
+    times = {}
+    for name in folders:
+        when = parse_snapshot_time(name)
+        if when is not None:
+            times[name] = when
+    keep = compute_keep_set(times, policy, now)
+    purge = sorted((name for name in times if name not in keep), key=lambda n: times[n])
+    return RetentionPlan(keep, purge, {n: folders[n] for n in times}, dry_run)
+
+
+def purge_folders(rclone, remote_root, names, workers=DEFAULT_PURGE_WORKERS):
+    """Purges folders in parallel. Returns (purged, failed) name lists."""
+    def purge(name):
+        try:
+            rclone.purge(f"{remote_root}/{name}")
+            return name, True, ""
+        except Exception as e:
+            return name, False, str(e)
+
+    purged, failed = [], []
+    if not names:
+        return purged, failed
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(names)))) as pool:
+        for name, ok, err in pool.map(purge, names):
+            if ok:
+                print(f"   🗑️ Purged {name}")
+                purged.append(name)
+            else:
+                print(f"   ⚠️ Failed to purge {name}: {err}")
+                failed.append(name)
+    return purged, failed
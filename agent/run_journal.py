@@ -0,0 +1,142 @@
+"""
+Checkpoint journal of backup runs, so a run cut short by a crash, reboot or
+log-off is resumed or cleaned up instead of silently redone.
+
+Each job has at most one journal, config_dir/runs/{job_id}.json, rewritten
+atomically at every phase change and after every checkpointed upload batch:
+
+    {
+      "run_id": "3f2a9c1b7d4e", "job_id": "job_1", "trigger_type": "Scheduled",
+      "timestamp": "2025-01-02_21-00-00", "snapshot": "Backup_2025-01-02_21-00-00",
+      "source_path": "D:\\TallyData", "engine": "rclone",
+      "phase": "sync", "completed": ["scan"],
+      "snapshots": {"gdrive:Backups/Tally": "pending"},
+      "files_done": 4000, "bytes_done": 7340032, "resumes": 0,
+      "started": "2025-01-02 21:00:00", "updated": 1735832000, "abandoned": null
+    }
+
+`snapshots` maps every job root to the state of this run's Backup_ folder
+there ("pending" once creation started, "done" when complete), so a partial
+folder can be found and purged. Large uploads are committed to the file
+index batch by batch while the journal counts them, so after a restart only
+the files that never reached the mirror are sent again.
+
+A successful run deletes its journal. A failed or cancelled run marks it
+abandoned; its partial snapshots are cleaned up by the next run of the job
+or at the next start of the agent.
+"""
+import json
+import os
+import threading
+import time
+import uuid
+
+DEFAULT_RESUME_MAX_AGE = 24 # hours; older interrupted runs are cleaned up instead
+
+
+class RunJournal:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                self.record = json.load(f)
+        except (OSError, ValueError):
+            self.record = None
+
+    @property
+    def snapshot(self):
+        return self.record.get("snapshot") if self.record else None
+
+    def begin(self, job_id, trigger_type, timestamp, source_path, engine, roots):
+        self.record = {
+            "run_id": uuid.uuid4().hex[:12],
+            "job_id": job_id,
+            "trigger_type": trigger_type,
+            "timestamp": timestamp,
+            "snapshot": f"Backup_{timestamp}",
+            "source_path": source_path,
+            "engine": engine,
+            "phase": None,
+            "completed": [],
+            "snapshots": {root: None for root in roots},
+            "files_done": 0,
+            "bytes_done": 0,
+            "resumes": 0,
+            "started": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "abandoned": None,
+        }
+        self._save()
+
+    def resume(self):
+        with self._lock:
+            self.record["resumes"] = self.record.get("resumes", 0) + 1
+            self.record["abandoned"] = None
+        self._save()
+
+    def phase(self, name):
+        """Enters a phase; the previous one counts as completed."""
+        with self._lock:
+            previous = self.record.get("phase")
+            if previous and previous not in self.record["completed"]:
+                self.record["completed"].append(previous)
+            self.record["phase"] = name
+        self._save()
+
+    def snapshot_state(self, root, state):
+        with self._lock:
+            self.record["snapshots"][root] = state
+        self._save()
+
+    def progress(self, files, size):
+        with self._lock:
+            self.record["files_done"] += files
+            self.record["bytes_done"] += size
+        self._save()
+
+    def abandon(self, reason):
+        with self._lock:
+            self.record["abandoned"] = reason
+        self._save()
+
+    def finish(self):
+        self.record = None
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def age_hours(self, now=None):
+        return ((now or time.time()) - self.record.get("updated", 0)) / 3600.0
+
+    def partial_snapshots(self):
+        """Job roots where this run's Backup_ folder was started but never completed."""
+        return [root for root, state in (self.record or {}).get("snapshots", {}).items() if state == "pending"]
+
+    def _save(self):
+        with self._lock:
+            if self.record is None:
+                return
+            self.record["updated"] = int(time.time())
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = self.path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(self.record, f, indent=1)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+
+
+def interrupted_runs(runs_dir):
+    """Journals left behind by runs that never finished (crash, reboot, failure)."""
+    try:
+        names = sorted(os.listdir(runs_dir))
+    except OSError:
+        return []
+    journals = []
+    for name in names:
+        if name.endswith(".json"):
+            journal = RunJournal(os.path.join(runs_dir, name))
+            if journal.record and journal.record.get("job_id"):
+                journals.append(journal)
+    return journals
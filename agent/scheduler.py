@@ -0,0 +1,266 @@
+"""
+Next-fire-time scheduling for backup jobs.
+
+Every job's next run time is computed up front and kept in a priority
+queue, so a job is never lost just because the main loop was busy (or the
+machine asleep) during its minute. Supported schedules:
+
+- Daily:   { "type": "daily", "time": "HH:MM" }
+- Monthly: { "type": "monthly", "day": 1, "time": "HH:MM" }  (day clamps to month end)
+- Cron:    { "type": "cron", "expr": "30 21 * * 1-5" }     (min hour dom month dow)
+
+Optional per schedule: "jitter_minutes" (falls back to global_config
+`schedule_jitter_minutes`) spreads fleet start times over a window, and
+"catch_up": false disables catch-up.
+
+The nominal time of the last run of each job is persisted; on start-up (or
+after sleep) a job whose next run after that record is already in the past
+runs once, within the jitter window from now. A run only counts as done
+once the runner accepted it (record_run).
+"""
+import calendar
+import datetime
+import heapq
+import json
+import os
+import random
+import threading
+
+
+# --- CRON ---
+_FIELD_RANGES = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)] # weekday 7 is Sunday too
+
+
+def _parse_field(field, low, high):
+    values = set()
+    for part in field.split(","):
+        step = 1
+        if "/" in part:
+            part, step = part.split("/", 1)
+            step = int(step)
+            if step < 1:
+                raise ValueError("cron step must be >= 1")
+        if part == "*":
+            start, end = low, high
+        elif "-" in part:
+            start, end = (int(x) for x in part.split("-", 1))
+        else:
+            start = int(part)
+            end = high if step > 1 else start
+        if start < low or end > high or start > end:
+            raise ValueError(f"cron value out of range: {part}")
+        values.update(range(start, end + 1, step))
+    return values
+
+
+class CronExpression:
+    def __init__(self, expr):
+        fields = expr.split()
+        if len(fields) != 5:
+            raise ValueError(f"cron expression needs 5 fields: {expr!r}")
+        self.expr = expr
+        self.minutes, self.hours, self.days, self.months, weekdays = (
+            sorted(_parse_field(f, lo, hi)) for f, (lo, hi) in zip(fields, _FIELD_RANGES)
+        )
+        # Sunday may be written as 7, also inside ranges (1-7, 5-7); fold it after expanding.
+        self.weekdays = sorted({day % 7 for day in weekdays})
+        self._dom_any = fields[2] == "*"
+        self._dow_any = fields[4] == "*"
+
+    def _day_matches(self, day):
+        if day.month not in self.months:
+            return False
+        dom = day.day in self.days
+        dow = (day.isoweekday() % 7) in self.weekdays
+        # Classic cron: when both day fields are restricted, either one matching is enough.
+        if self._dom_any or self._dow_any:
+            return dom and dow
+        return dom or dow
+
+    def next_after(self, after):
+        start = after.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        day = start.date()
+        for _ in range(366 * 5):
+            if self._day_matches(day):
+                for hour in self.hours:
+                    for minute in self.minutes:
+                        candidate = datetime.datetime.combine(day, datetime.time(hour, minute))
+                        if candidate >= start:
+                            return candidate
+            day += datetime.timedelta(days=1)
+        raise ValueError(f"cron expression never fires: {self.expr!r}")
+
+
+# --- SCHEDULE TYPES ---
+def _parse_time(value):
+    hour, minute = (int(x) for x in str(value or "00:00").split(":")[:2])
+    return datetime.time(hour, minute)
+
+
+def next_fire(schedule_config, after):
+    """Returns the first nominal fire time strictly after `after` (or None for unknown types)."""
+    sched_type = schedule_config.get('type', 'daily')
+
+    if sched_type == 'daily':
+        at = _parse_time(schedule_config.get('time', '00:00'))
+        candidate = datetime.datetime.combine(after.date(), at)
+        if candidate <= after:
+            candidate += datetime.timedelta(days=1)
+        return candidate
+
+    if sched_type == 'monthly':
+        at = _parse_time(schedule_config.get('time', '00:00'))
+        wanted = int(schedule_config.get('day', 1))
+        year, month = after.year, after.month
+        for _ in range(13):
+            day = min(wanted, calendar.monthrange(year, month)[1])
+            candidate = datetime.datetime.combine(datetime.date(year, month, day), at)
+            if candidate > after:
+                return candidate
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        return None
+
+    if sched_type == 'cron':
+        return CronExpression(schedule_config.get('expr', '')).next_after(after)
+
+    return None
+
+
+# --- TIMETABLE ---
+class Timetable:
+    """
+    Priority queue of upcoming job runs with catch-up and jitter.
+    refresh() is cheap to call every loop; pop_due() hands out runs whose time has come.
+    """
+
+    def __init__(self, state_file, seed=""):
+        self.state_file = state_file
+        self.seed = seed
+        self._lock = threading.Lock()
+        self._heap = []
+        self._entries = {} # job_id -> (schedule_json, fire_at, nominal)
+        self._last_run = self._load()
+
+    def _load(self):
+        try:
+            with open(self.state_file, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self):
+        tmp = self.state_file + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self._last_run, f)
+        os.replace(tmp, self.state_file)
+
+    def _jitter(self, job_id, nominal, minutes):
+        if not minutes:
+            return nominal
+        # Stable per agent/job/run so refreshes do not reshuffle the fire time.
+        rng = random.Random(f"{self.seed}:{job_id}:{nominal.isoformat()}")
+        return nominal + datetime.timedelta(seconds=rng.uniform(0, float(minutes) * 60))
+
+    def _plan(self, job_id, schedule, global_config, now):
+        last = self._last_run.get(job_id)
+        nominal = None
+        if last and schedule.get('catch_up', True):
+            try:
+                # First run after the last one we did; if that is already past, it was missed.
+                nominal = next_fire(schedule, datetime.datetime.fromisoformat(last))
+            except ValueError:
+                nominal = None
+        if nominal is not None and nominal < now:
+            # Several runs missed: catch up once, labelled with the most recent one.
+            for _ in range(1000):
+                following = next_fire(schedule, nominal)
+                if following is None or following >= now:
+                    break
+                nominal = following
+        if nominal is None:
+            nominal = next_fire(schedule, now)
+        if nominal is None:
+            return None
+        jitter = schedule.get('jitter_minutes', global_config.get('schedule_jitter_minutes', 0))
+        fire_at = self._jitter(job_id, nominal, jitter)
+        if nominal < now:
+            # Catch-ups keep their offset from now, or a fleet back from an outage starts at once.
+            fire_at = now + (fire_at - nominal)
+        return fire_at, nominal
+
+    def refresh(self, jobs, global_config, now=None):
+        """Syncs the queue with the current job configs (added, removed or rescheduled jobs)."""
+        now = now or datetime.datetime.now()
+        with self._lock:
+            changed = False
+            for job_id in list(self._entries):
+                if job_id not in jobs:
+                    del self._entries[job_id]
+                    changed = True
+            for job_id, job_config in jobs.items():
+                schedule = job_config.get('schedule') or {}
+                jitter = global_config.get('schedule_jitter_minutes', 0)
+                key = json.dumps([schedule, jitter], sort_keys=True)
+                current = self._entries.get(job_id)
+                if current and current[0] == key:
+                    continue
+                try:
+                    planned = self._plan(job_id, schedule, global_config, now)
+                except ValueError as e:
+                    print(f"⚠️ Invalid schedule for {job_id}: {e}")
+                    planned = None
+                if planned is None:
+                    self._entries.pop(job_id, None)
+                else:
+                    self._entries[job_id] = (key,) + planned
+                    if planned[1] < now:
+                        print(f"⏪ Missed run of {job_id} at {planned[1]:%Y-%m-%d %H:%M}, catching up")
+                changed = True
+            if changed:
+                self._heap = [(fire_at, job_id) for job_id, (_, fire_at, _) in self._entries.items()]
+                heapq.heapify(self._heap)
+
+    def pop_due(self, now=None):
+        """
+        Returns [(job_id, nominal_time)] for every run that is due, and schedules
+        each job's next run. Call record_run() for the runs that were accepted.
+        """
+        now = now or datetime.datetime.now()
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                fire_at, job_id = heapq.heappop(self._heap)
+                entry = self._entries.get(job_id)
+                if entry is None or entry[1] != fire_at:
+                    continue # stale heap item
+                key, _, nominal = entry
+                due.append((job_id, nominal))
+                # Next run strictly after now, so a long outage yields a single catch-up.
+                schedule = json.loads(key)[0]
+                following = next_fire(schedule, max(now, nominal))
+                if following is None:
+                    del self._entries[job_id]
+                    continue
+                jitter = schedule.get('jitter_minutes', json.loads(key)[1])
+                fire_next = self._jitter(job_id, following, jitter)
+                self._entries[job_id] = (key, fire_next, following)
+                heapq.heappush(self._heap, (fire_next, job_id))
+        return due
+
+    def record_run(self, job_id, nominal):
+        """Persists a run as done; a refused run stays unrecorded and is caught up after a restart."""
+        with self._lock:
+            self._last_run[job_id] = nominal.isoformat()
+            self._save()
+
+    def next_run(self, job_id):
+        with self._lock:
+            entry = self._entries.get(job_id)
+            return entry[1] if entry else None
+
+    def seconds_until_next(self, now=None):
+        now = now or datetime.datetime.now()
+        with self._lock:
+            if not self._heap:
+                return None
+            return max(0.0, (self._heap[0][0] - now).total_seconds())
@@ -0,0 +1,256 @@
+"""
+Incremental snapshots for Backup_* folders.
+
+In the default "full" mode every run server-side copies all of
+Current_Mirror into Backup_{timestamp}. In "incremental" mode a snapshot
+folder only receives the files that changed since the previous snapshot,
+plus a manifest (_snapshot_manifest.json) describing the complete
+point-in-time view:
+
+    {
+      "version": 1,
+      "snapshot": "Backup_2025-01-02_21-00-00",
+      "base": "Backup_2025-01-01_21-00-00",
+      "created": "2025-01-02 21:00:04",
+      "files":   {"Company/data.900": {"size": 123, "mtime_ns": 1, "in": "Backup_2025-01-01_21-00-00"}},
+      "deleted": ["old.tmp"]
+    }
+
+"in" names the snapshot folder that physically holds that version, so any
+snapshot can be rebuilt from its own manifest. Manifests are cached under
+config_dir (the folder is created with the first one) and fetched from the
+remote when the cache is missing.
+
+Because snapshots reference older ones, retention must not simply purge an
+expired folder: release() first moves any file still needed by a kept
+snapshot into the oldest kept snapshot that needs it, rewrites the affected
+manifests, and only then reports the folder as safe to purge.
+"""
+import collections
+import datetime
+import json
+import os
+
+from rclone_backend import RcloneError
+
+MANIFEST_NAME = "_snapshot_manifest.json"
+MANIFEST_VERSION = 1
+SERVER_SIDE = {"no-traverse": True, "server-side-across-configs": True}
+
+
+def restore_sources(manifest):
+    """Groups a manifest's files by the snapshot folder holding them: {folder: [paths]}."""
+    groups = collections.defaultdict(list)
+    for path, meta in manifest.get("files", {}).items():
+        groups[meta["in"]].append(path)
+    return dict(groups)
+
+
+class SnapshotCatalog:
+    """Manifest bookkeeping for one job root (the folder holding Current_Mirror and Backup_*)."""
+
+    def __init__(self, rclone, cache_dir, base_remote, job_root):
+        self.rclone = rclone
+        self.cache_dir = cache_dir
+        self.base_remote = base_remote
+        self.job_root = job_root
+
+    def remote(self, folder):
+        return f"{self.base_remote}{self.job_root}/{folder}"
+
+    # --- manifest storage ---
+    def _cache_path(self, folder):
+        return os.path.join(self.cache_dir, f"{folder}.json")
+
+    def cached_snapshots(self):
+        if not os.path.isdir(self.cache_dir):
+            return []
+        return sorted(f[:-5] for f in os.listdir(self.cache_dir) if f.startswith("Backup_") and f.endswith(".json"))
+
+    def has_manifests(self):
+        """True once any incremental manifest of this job is cached (legacy full snapshots leave none)."""
+        return bool(self.cached_snapshots())
+
+    def load(self, folder, fetch=True):
+        """Returns the manifest for a snapshot, or None for legacy full snapshots without one."""
+        try:
+            with open(self._cache_path(folder), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            pass
+        # Full-mode snapshots have no manifest; remember that so we only ask once.
+        if not fetch or os.path.exists(self._cache_path(folder) + ".none"):
+            return None
+        try:
+            data = self.rclone.cat(f"{self.remote(folder)}/{MANIFEST_NAME}")
+        except RcloneError as e:
+            if e.not_found:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                open(self._cache_path(folder) + ".none", "w").close()
+                return None
+            # Unknown dependencies must never be treated as "none".
+            raise RuntimeError(f"Could not read manifest of {folder}: {e}")
+        try:
+            manifest = json.loads(data.decode("utf-8"))
+        except ValueError:
+            return None
+        self._store_local(folder, manifest)
+        return manifest
+
+    def _store_local(self, folder, manifest):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp = self._cache_path(folder) + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(manifest, f)
+        os.replace(tmp, self._cache_path(folder))
+
+    def save(self, folder, manifest, cancel_token=None):
+        self.rclone.rcat(f"{self.remote(folder)}/{MANIFEST_NAME}", json.dumps(manifest).encode("utf-8"),
+                         cancel_token=cancel_token)
+        self._store_local(folder, manifest)
+
+    def forget(self, folder):
+        for path in (self._cache_path(folder), self._cache_path(folder) + ".none"):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    # --- snapshot creation ---
+    def latest(self):
+        snapshots = self.cached_snapshots()
+        return self.load(snapshots[-1], fetch=False) if snapshots else None
+
+    def create(self, folder, entries, mirror_remote, list_path, cancel_token=None):
+        """
+        Creates an incremental snapshot of Current_Mirror.
+        entries is {path: (size, mtime_ns)} of the mirrored tree.
+        Returns (manifest, copied_paths).
+        """
+        base = self.latest()
+        base_files = base.get("files", {}) if base else {}
+
+        files, changed = {}, []
+        for path, (size, mtime_ns) in entries.items():
+            previous = base_files.get(path)
+            if previous and previous["size"] == size and previous["mtime_ns"] == mtime_ns:
+                files[path] = previous
+            else:
+                files[path] = {"size": size, "mtime_ns": mtime_ns, "in": folder}
+                changed.append(path)
+
+        if changed:
+            with open(list_path, "w", encoding="utf-8") as f:
+                for path in sorted(changed):
+                    f.write(path + "\n")
+            try:
+                self.rclone.copy(mirror_remote, self.remote(folder), files_from=list_path,
+                                 options=SERVER_SIDE, cancel_token=cancel_token)
+            finally:
+                os.remove(list_path)
+
+        manifest = {
+            "version": MANIFEST_VERSION,
+            "snapshot": folder,
+            "base": base["snapshot"] if base else None,
+            "created": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "files": files,
+            "deleted": sorted(p for p in base_files if p not in entries),
+        }
+        self.save(folder, manifest, cancel_token=cancel_token)
+        return manifest, changed
+
+    # --- retention support ---
+    def release(self, expired, kept, list_path):
+        """
+        Makes the expired snapshot folders safe to purge.
+        Files in an expired folder that a kept snapshot still references are
+        moved (server-side) into the oldest kept snapshot referencing them and
+        the kept manifests are rewritten. Returns the folders that may now be
+        purged; folders whose dependents could not be fixed up are left alone.
+        """
+        expired_set = set(expired)
+        manifests = {}
+        for folder in sorted(kept):
+            manifest = self.load(folder)
+            if manifest is not None:
+                manifests[folder] = manifest
+
+        releasable = []
+        for victim in sorted(expired):
+            # path -> oldest kept snapshot that references victim for it
+            targets = {}
+            for folder, manifest in sorted(manifests.items()):
+                for path, meta in manifest["files"].items():
+                    if meta["in"] == victim and path not in targets:
+                        targets[path] = folder
+            if targets:
+                try:
+                    self._rebase(victim, targets, manifests, list_path)
+                except Exception as e:
+                    print(f"   ⚠️ Keeping {victim}: newer snapshots depend on it ({e})")
+                    continue
+            releasable.append(victim)
+            self.forget(victim)
+
+        # Cached manifests of folders that no longer exist on the remote
+        for folder in self.cached_snapshots():
+            if folder not in kept and folder not in expired_set:
+                self.forget(folder)
+        return releasable
+
+    def stored_bytes(self, folders):
+        """
+        Bytes each snapshot folder holds itself (the files whose "in" is that
+        folder, plus its manifest), from the cached manifests. Folders without
+        one are left out.
+        """
+        sizes, seen = {}, set()
+        for folder in folders:
+            manifest = self.load(folder, fetch=False)
+            if manifest is None:
+                continue
+            # The cached copy is written with the same serialisation as the uploaded one.
+            sizes[folder] = sizes.get(folder, 0) + os.path.getsize(self._cache_path(folder))
+            for path, meta in manifest["files"].items():
+                if (meta["in"], path) not in seen and meta["in"] in folders:
+                    seen.add((meta["in"], path))
+                    sizes[meta["in"]] = sizes.get(meta["in"], 0) + meta["size"]
+        return sizes
+
+    def _rebase(self, victim, targets, manifests, list_path):
+        by_target = collections.defaultdict(list)
+        for path, folder in targets.items():
+            by_target[folder].append(path)
+
+        # One target at a time: its files are moved (or moved back if the move
+        # fails part-way), then every manifest is pointed at them before the
+        # next move, so no manifest names a folder the files have left.
+        for folder, paths in sorted(by_target.items()):
+            print(f"   ↪️ Moving {len(paths)} files {victim} -> {folder} before purge")
+            with open(list_path, "w", encoding="utf-8") as f:
+                for path in sorted(paths):
+                    f.write(path + "\n")
+            try:
+                self.rclone.move(self.remote(victim), self.remote(folder), files_from=list_path,
+                                 options=SERVER_SIDE)
+            except Exception:
+                # Part of the list may have moved; the target has no copy of its own of these paths.
+                try:
+                    self.rclone.move(self.remote(folder), self.remote(victim), files_from=list_path,
+                                     options=SERVER_SIDE)
+                except Exception as e:
+                    print(f"   ⚠️ Could not move files back to {victim}: {e}")
+                raise
+            finally:
+                os.remove(list_path)
+
+            moved = set(paths)
+            for name, manifest in sorted(manifests.items()):
+                dirty = False
+                for path, meta in manifest["files"].items():
+                    if meta["in"] == victim and path in moved:
+                        meta["in"] = folder
+                        dirty = True
+                if dirty:
+                    self.save(name, manifest)
@@ -0,0 +1,79 @@
+"""
+Cache for the slow probes the agent runs at every start.
+
+Each entry is stored with a validity key built from whatever the probe
+depends on (size + mtime of the rclone binary or rclone.conf, relevant
+environment variables). An entry is only used while its key still matches,
+so replacing rclone.exe or editing rclone.conf simply re-runs the probe.
+
+    config_dir/startup_cache.json
+    {"rclone_version": {"key": [...], "value": "v1.65.0"}, ...}
+"""
+import json
+import os
+import threading
+
+
+def file_key(path):
+    """[absolute path, size, mtime_ns] of a file, or None if it does not exist."""
+    try:
+        st = os.stat(path)
+    except (OSError, TypeError):
+        return None
+    return [os.path.abspath(path), st.st_size, st.st_mtime_ns]
+
+
+def _normalise(key):
+    return json.loads(json.dumps(key)) # tuples -> lists, as they come back from disk
+
+
+class StartupCache:
+    def __init__(self, path):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        try:
+            with open(path, "r") as f:
+                self._entries = json.load(f)
+        except (OSError, ValueError):
+            self._entries = {}
+
+    def get(self, name, key):
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None and entry.get("key") == _normalise(key):
+                self.hits += 1
+                return entry.get("value")
+            self.misses += 1
+            return None
+
+    def put(self, name, key, value):
+        entry = {"key": _normalise(key), "value": value}
+        with self._lock:
+            if self._entries.get(name) != entry:
+                self._entries[name] = entry
+                self._save()
+
+    def drop(self, name):
+        with self._lock:
+            if self._entries.pop(name, None) is not None:
+                self._save()
+
+    def cached(self, name, key, probe):
+        """Returns the cached value for key, or runs probe() and caches its result (None is not cached)."""
+        value = self.get(name, key)
+        if value is None:
+            value = probe()
+            if value is not None:
+                self.put(name, key, value)
+        return value
+
+    def _save(self):
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump(self._entries, f, indent=1)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            print(f"⚠️ Could not write startup cache: {e}")
@@ -0,0 +1,152 @@
+"""
+Cloud storage ledger: how many bytes each job keeps on each destination,
+without walking the remote.
+
+The ledger records the size of every top-level folder under a job root
+(Current_Mirror, each Backup_*, the chunk / pack store) from what the agent
+already knows:
+
+- after a sync, Current_Mirror holds exactly the scanned tree
+- a full snapshot is a copy of the mirror; an incremental one stores only
+  the files it copied (its manifest tells which)
+- the chunk and pack engines add the bytes they uploaded and subtract what
+  garbage collection deleted
+- retention removes the purged folders (after incremental rebasing, the
+  kept folders are re-sized from their manifests)
+
+Every `storage_reconcile_days` (global_config, default 7) one recursive
+listing of the job root replaces the ledger's figures, so drift (manual
+deletions, failed runs, manifests) cannot build up. A job root that has
+never been listed is reconciled on its next run.
+
+State lives in config_dir/storage_ledger.json:
+
+    {"jobs": {"job_1": {"primary": {"root": "gdrive:Backups/Tally",
+        "folders": {"Current_Mirror": 7340032, "Backup_2025-01-02_21-00-00": 7340032},
+        "reconciled": 1735832000, "drift_bytes": -1024, "updated": 1735832000}}}}
+"""
+import json
+import os
+import threading
+import time
+
+DEFAULT_RECONCILE_DAYS = 7
+MIRROR_DIR = "Current_Mirror"
+
+
+def folder_kind(name, store_dirs=()):
+    if name == MIRROR_DIR:
+        return "mirror"
+    if name.startswith("Backup_"):
+        return "snapshots"
+    if name in store_dirs:
+        return "store"
+    return "other"
+
+
+class StorageLedger:
+    def __init__(self, path, store_dirs=()):
+        self.path = path
+        self.store_dirs = tuple(store_dirs)
+        self._lock = threading.Lock()
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                self._state = json.load(f)
+        except (OSError, ValueError):
+            self._state = {}
+        self._state.setdefault("jobs", {})
+
+    def _entry(self, job_id, dest_id, root):
+        entry = self._state["jobs"].setdefault(job_id, {}).setdefault(dest_id, {"folders": {}, "reconciled": None})
+        entry["root"] = root
+        entry["updated"] = int(time.time())
+        return entry
+
+    def set_folder(self, job_id, dest_id, root, folder, size):
+        """Records the full size of one folder (the mirror after a sync, a new snapshot)."""
+        with self._lock:
+            self._entry(job_id, dest_id, root)["folders"][folder] = max(0, int(size))
+            self._save()
+
+    def add(self, job_id, dest_id, root, folder, size):
+        """Adds (or, negative, subtracts) bytes to a folder, e.g. a chunk store upload or GC."""
+        with self._lock:
+            folders = self._entry(job_id, dest_id, root)["folders"]
+            folders[folder] = max(0, folders.get(folder, 0) + int(size))
+            self._save()
+
+    def update_folders(self, job_id, dest_id, root, sizes):
+        with self._lock:
+            self._entry(job_id, dest_id, root)["folders"].update({k: max(0, int(v)) for k, v in sizes.items()})
+            self._save()
+
+    def remove(self, job_id, dest_id, root, folders):
+        """Drops purged folders. Returns the bytes freed."""
+        with self._lock:
+            known = self._entry(job_id, dest_id, root)["folders"]
+            freed = sum(known.pop(folder, 0) or 0 for folder in folders)
+            self._save()
+            return freed
+
+    def reconcile_due(self, job_id, dest_id, days=DEFAULT_RECONCILE_DAYS, now=None):
+        with self._lock:
+            entry = self._state["jobs"].get(job_id, {}).get(dest_id)
+        if not entry or not entry.get("reconciled"):
+            return True
+        return (now or time.time()) - entry["reconciled"] >= float(days) * 86400
+
+    def reconcile(self, job_id, dest_id, root, listed):
+        """Replaces the figures with a listing ({folder: bytes}). Returns listed minus recorded bytes."""
+        with self._lock:
+            entry = self._entry(job_id, dest_id, root)
+            drift = sum(listed.values()) - sum(entry["folders"].values())
+            entry["folders"] = {name: int(size or 0) for name, size in listed.items()}
+            entry["reconciled"] = int(time.time())
+            entry["drift_bytes"] = drift
+            self._save()
+            return drift
+
+    def forget(self, job_id, dest_id=None):
+        with self._lock:
+            if dest_id is None:
+                self._state["jobs"].pop(job_id, None)
+            else:
+                self._state["jobs"].get(job_id, {}).pop(dest_id, None)
+            self._save()
+
+    # --- totals ---
+    def _totals(self, entry):
+        totals = {"bytes": 0, "mirror_bytes": 0, "snapshot_bytes": 0, "store_bytes": 0, "other_bytes": 0,
+                  "snapshots": 0}
+        for name, size in entry["folders"].items():
+            kind = folder_kind(name, self.store_dirs)
+            totals["bytes"] += size
+            totals[{"mirror": "mirror_bytes", "snapshots": "snapshot_bytes",
+                    "store": "store_bytes"}.get(kind, "other_bytes")] += size
+            if kind == "snapshots":
+                totals["snapshots"] += 1
+        totals["reconciled"] = entry.get("reconciled")
+        totals["drift_bytes"] = entry.get("drift_bytes")
+        return totals
+
+    def job_totals(self, job_id):
+        """Numeric totals for one job: overall and per destination."""
+        with self._lock:
+            destinations = {dest_id: self._totals(entry)
+                            for dest_id, entry in self._state["jobs"].get(job_id, {}).items()}
+        record = {"bytes": sum(d["bytes"] for d in destinations.values()),
+                  "snapshots": sum(d["snapshots"] for d in destinations.values()),
+                  "destinations": destinations, "updated": int(time.time())}
+        return record
+
+    def agent_totals(self):
+        with self._lock:
+            job_ids = list(self._state["jobs"])
+        jobs = {job_id: self.job_totals(job_id)["bytes"] for job_id in job_ids}
+        return {"bytes": sum(jobs.values()), "jobs": jobs, "updated": int(time.time())}
+
+    def _save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self._state, f)
+        os.replace(tmp, self.path)
@@ -0,0 +1,324 @@
+"""
+Adaptive transfer settings and bandwidth timetables for rclone transfers.
+
+TransferTuner learns `transfers`, `checkers` and the Drive upload chunk size
+per job. Each run that moves enough data to be a fair sample reports its
+throughput (bytes / elapsed from the final rclone stats). The tuner then
+hill-climbs one setting at a time:
+
+- The next run tries one step up or down the ladder of the current setting.
+- The step is kept if it beats the best known throughput by IMPROVEMENT and
+  the run had no errors. Otherwise it is reverted and the other direction is
+  tried.
+- When neither direction helps, the tuner moves on to the next setting.
+- When a full round finds nothing better, the job is "settled" and only
+  re-explores every EXPLORE_EVERY runs, so a changed link is noticed.
+
+Learned values are persisted per job in a small JSON file under config_dir.
+
+BandwidthSchedule turns a `bandwidth_schedule` (job or global_config) into
+the rate that applies at a given time:
+
+    "bandwidth_schedule": [
+        {"time": "08:00", "limit": "1M", "days": "1-5"},   # cron day-of-week, 0 = Sunday
+        {"time": "18:00", "limit": "off"}
+    ]
+
+A plain string ("2M") is a constant limit. The schedule is applied live:
+the rcd backend is re-limited on every boundary via core/bwlimit. A
+one-process-per-operation rclone gets the equivalent --bwlimit timetable and
+switches by itself.
+"""
+import datetime
+import json
+import os
+import re
+import threading
+
+# Ladders the tuner climbs; the defaults match the old hard-coded behaviour
+# (--transfers 8, rclone's own 8 checkers and 8M Drive chunks).
+LADDERS = {
+    "transfers": [2, 4, 6, 8, 12, 16, 24, 32],
+    "checkers": [4, 8, 16, 24, 32, 48, 64],
+    "drive-chunk-size": ["8M", "16M", "32M", "64M", "128M", "256M"],
+}
+DEFAULTS = {"transfers": 8, "checkers": 8, "drive-chunk-size": "8M"}
+PIN_KEYS = {"transfers": "transfers", "checkers": "checkers", "drive-chunk-size": "drive_chunk_size"}
+
+MIN_SAMPLE_BYTES = 64 * 1024 * 1024 # smaller runs say more about latency than about the link
+MIN_SAMPLE_SECONDS = 20
+IMPROVEMENT = 0.05 # a trial must be 5% faster to be adopted
+BASELINE_WEIGHT = 0.3 # EWMA weight for re-measuring the adopted settings
+EXPLORE_EVERY = 10 # runs between rounds once settled
+MAX_CHUNK_MEMORY = 1024 * 1024 * 1024 # Drive buffers one chunk per transfer in RAM
+CHUNKED_UPLOAD_MIN_FILE = 16 * 1024 * 1024 # chunk size only matters for large files
+
+_WEEKDAYS = ["Sun", "Mon", "Tue", "Wed", "Thu", "Fri", "Sat"]
+_SIZE_RE = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*([bkmgt]?)i?b?\s*$", re.IGNORECASE)
+
+
+def parse_size(value):
+    """rclone size suffix ("512k", "8M", "1.5G"; binary units) -> bytes, or None for off/unlimited."""
+    if value is None:
+        return None
+    text = str(value).split(":", 1)[0] # "upload:download" -> upload
+    if text.strip().lower() in ("", "off", "0"):
+        return None
+    match = _SIZE_RE.match(text)
+    if not match:
+        raise ValueError(f"Bad size: {value!r}")
+    scale = {"": 1024, "b": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3, "t": 1024 ** 4}[match.group(2).lower()]
+    return int(float(match.group(1)) * scale)
+
+
+# --- BANDWIDTH ---
+def _parse_days(days):
+    if days is None or days == "*":
+        return set(range(7))
+    values = set()
+    for part in str(days).split(","):
+        if "-" in part:
+            low, high = (int(x) for x in part.split("-", 1))
+            values.update(range(low, high + 1))
+        else:
+            values.add(int(part))
+    if any(v < 0 or v > 7 for v in values):
+        raise ValueError(f"Bad days: {days!r}")
+    return {v % 7 for v in values}
+
+
+def _cron_weekday(date):
+    return (date.weekday() + 1) % 7
+
+
+class BandwidthSchedule:
+    def __init__(self, spec):
+        self.spec = spec
+        self.entries = [] # (days, (hour, minute), limit)
+        self.constant = None
+        if isinstance(spec, str):
+            parse_size(spec) # validate
+            self.constant = spec
+            return
+        for entry in spec or []:
+            hour, minute = (int(x) for x in str(entry["time"]).split(":"))
+            if not (0 <= hour < 24 and 0 <= minute < 60):
+                raise ValueError(f"Bad time: {entry['time']!r}")
+            limit = str(entry.get("limit", "off"))
+            parse_size(limit)
+            self.entries.append((_parse_days(entry.get("days")), (hour, minute), limit))
+
+    def __bool__(self):
+        return bool(self.constant or self.entries)
+
+    def limit_at(self, now=None):
+        """The limit string in force at `now` ("off" when unlimited)."""
+        if self.constant:
+            return self.constant
+        if not self.entries:
+            return "off"
+        now = now or datetime.datetime.now()
+        best = None
+        for back in range(8): # the latest boundary is at most a week ago
+            date = now.date() - datetime.timedelta(days=back)
+            weekday = _cron_weekday(date)
+            for days, (hour, minute), limit in self.entries:
+                if weekday not in days:
+                    continue
+                at = datetime.datetime.combine(date, datetime.time(hour, minute))
+                if at <= now and (best is None or at > best[0]):
+                    best = (at, limit)
+            if best:
+                return best[1]
+        return "off"
+
+    def rclone_timetable(self):
+        """Equivalent rclone --bwlimit value ("Mon-08:00,1M Mon-18:00,off ...")."""
+        if self.constant:
+            return self.constant
+        if not self.entries:
+            return None
+        every_day = all(len(days) == 7 for days, _, _ in self.entries)
+        slots = []
+        for days, (hour, minute), limit in self.entries:
+            if every_day:
+                slots.append(f"{hour:02d}:{minute:02d},{limit}")
+            else:
+                slots += [f"{_WEEKDAYS[d]}-{hour:02d}:{minute:02d},{limit}" for d in sorted(days)]
+        return " ".join(slots)
+
+
+def schedule_for(job_config, global_config):
+    """The job's bandwidth schedule, falling back to the global one (invalid specs are ignored)."""
+    spec = job_config.get("bandwidth_schedule") or global_config.get("bandwidth_schedule")
+    try:
+        return BandwidthSchedule(spec)
+    except (KeyError, TypeError, ValueError) as e:
+        print(f"⚠️ Ignoring bad bandwidth_schedule: {e}")
+        return BandwidthSchedule(None)
+
+
+def tightest_limit(limits):
+    """Most restrictive of several limit strings (None/"off" when nothing is limited)."""
+    limited = [(parse_size(l), l) for l in limits if parse_size(l) is not None]
+    return min(limited)[1] if limited else "off"
+
+
+# --- TUNER ---
+class TransferTuner:
+    def __init__(self, state_file):
+        self.state_file = state_file
+        self._lock = threading.Lock()
+        self._state = self._load()
+
+    def _load(self):
+        try:
+            with open(self.state_file, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self):
+        tmp = self.state_file + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self._state, f, indent=1)
+        os.replace(tmp, self.state_file)
+
+    def _job(self, job_id):
+        job = self._state.setdefault(job_id, {})
+        job.setdefault("best", dict(DEFAULTS))
+        job.setdefault("best_bps", None)
+        job.setdefault("param", 0)
+        job.setdefault("direction", 1)
+        job.setdefault("flipped", False)
+        job.setdefault("unimproved", 0)
+        job.setdefault("runs", 0)
+        job.setdefault("settled_at", None)
+        job.setdefault("trial", None) # [setting, value] being tried
+        return job
+
+    @staticmethod
+    def _step(value, name, direction):
+        ladder = LADDERS[name]
+        try:
+            index = ladder.index(value)
+        except ValueError:
+            index = min(range(len(ladder)), key=lambda i: abs(_ladder_number(ladder[i]) - _ladder_number(value)))
+        index += direction
+        return ladder[index] if 0 <= index < len(ladder) else None
+
+    def _tunable(self, job, pinned):
+        names = [n for n in LADDERS if n not in pinned]
+        if (job.get("avg_file_bytes") or 0) < CHUNKED_UPLOAD_MIN_FILE:
+            names = [n for n in names if n != "drive-chunk-size"]
+        return names
+
+    def _next_trial(self, job, pinned):
+        """Proposes the next setting to try, or None when there is nothing left to try this round."""
+        names = self._tunable(job, pinned)
+        if not names:
+            return None
+        for _ in range(2 * len(names)):
+            name = names[job["param"] % len(names)]
+            value = self._step(job["best"][name], name, job["direction"])
+            if value is not None:
+                candidate = dict(job["best"], **{name: value})
+                if parse_size(candidate["drive-chunk-size"]) * candidate["transfers"] <= MAX_CHUNK_MEMORY:
+                    return [name, value]
+            self._advance(job, len(names))
+        return None
+
+    @staticmethod
+    def _advance(job, count):
+        """Trial failed: try the other direction, then the next setting."""
+        if not job["flipped"]:
+            job["direction"] = -job["direction"]
+            job["flipped"] = True
+            return
+        job["flipped"] = False
+        job["direction"] = 1
+        job["param"] = (job["param"] + 1) % max(count, 1)
+        job["unimproved"] += 1
+
+    def options_for(self, job_id, job_config=None, enabled=True):
+        """rclone options for the next run of job_id. Values set on the job itself are pinned."""
+        pinned = pinned_settings(job_config)
+        with self._lock:
+            job = self._job(job_id)
+            options = dict(job["best"])
+            if job["trial"] is not None and job["trial"][0] in pinned:
+                job["trial"] = None # pinned since the trial was proposed
+            if enabled and job["best_bps"] is not None:
+                settled = job["settled_at"] is not None and job["runs"] - job["settled_at"] < EXPLORE_EVERY
+                if job["trial"] is None and not settled:
+                    job["settled_at"] = None
+                    job["trial"] = self._next_trial(job, pinned)
+                if job["trial"] is not None:
+                    name, value = job["trial"]
+                    options[name] = value
+            options.update(pinned)
+            return options
+
+    def record(self, job_id, options, stats, job_config=None):
+        """
+        Feeds back the final StatsEvent of a run made with `options` (job_config
+        gives the pinned settings, as for options_for).
+        Returns the job's tuning summary (for job_states), or None if the
+        run was too small to learn from.
+        """
+        if stats is None or stats.bytes < MIN_SAMPLE_BYTES or stats.elapsed < MIN_SAMPLE_SECONDS:
+            return None
+        bps = stats.bytes / stats.elapsed
+        with self._lock:
+            job = self._job(job_id)
+            job["runs"] += 1
+            if stats.transfers:
+                job["avg_file_bytes"] = int(stats.bytes / stats.transfers)
+            trial = job["trial"]
+
+            if job["best_bps"] is None:
+                job["best_bps"] = bps
+            elif trial is not None and options.get(trial[0]) == trial[1]:
+                names = self._tunable(job, pinned_settings(job_config))
+                if not stats.errors and bps > job["best_bps"] * (1 + IMPROVEMENT):
+                    job["best"][trial[0]], job["best_bps"] = trial[1], bps
+                    job["flipped"] = True # keep climbing in this direction
+                    job["unimproved"] = 0
+                else:
+                    self._advance(job, len(names))
+                    if job["unimproved"] >= len(names):
+                        job["settled_at"], job["unimproved"] = job["runs"], 0
+                job["trial"] = None
+            elif trial is None:
+                # Re-measured the adopted settings: track slow drift of the link.
+                job["best_bps"] += BASELINE_WEIGHT * (bps - job["best_bps"])
+            self._save()
+            return self.summary(job_id)
+
+    def summary(self, job_id):
+        job = self._state.get(job_id)
+        if not job:
+            return None
+        return {
+            "transfers": job["best"]["transfers"],
+            "checkers": job["best"]["checkers"],
+            "drive_chunk_size": job["best"]["drive-chunk-size"],
+            "best_bps": int(job["best_bps"] or 0),
+            "settled": job["settled_at"] is not None,
+            "runs": job["runs"],
+        }
+
+    def forget(self, job_id):
+        with self._lock:
+            if self._state.pop(job_id, None) is not None:
+                self._save()
+
+
+def pinned_settings(job_config):
+    """Settings the job sets itself ({rclone name: value}); the tuner leaves those alone."""
+    job_config = job_config or {}
+    return {name: job_config[key] for name, key in PIN_KEYS.items() if job_config.get(key) is not None}
+
+
+def _ladder_number(value):
+    return parse_size(value) if isinstance(value, str) else value
@@ -0,0 +1,377 @@
+"""
+Continuous protection: file-system watchers feeding small mirror pushes.
+
+A job with `continuous` enabled gets a watcher on its source_path. Changed
+paths are collected and debounced (a file still being saved keeps producing
+events, so it is only pushed once it has been quiet for `debounce` seconds,
+or after `max_delay` at the latest). The main loop submits a "Continuous"
+run whenever a job has paths ready; that run syncs just those paths into
+Current_Mirror with --files-from. The scheduled run still creates the
+Backup_{timestamp} snapshot as before.
+
+Watchers, best first:
+- Linux:   inotify (ctypes, one watch per directory)
+- Windows: ReadDirectoryChangesW on the source root (ctypes, whole subtree)
+- else:    polling, a local scan_tree() diff every `poll_interval` seconds
+
+If the kernel drops events (inotify queue overflow, Windows buffer
+overflow) the watch asks for a rescan, and the next push diffs the tree
+against the file index instead.
+
+    "continuous": true
+    "continuous": {"debounce": 10, "max_delay": 300, "batch_size": 200}
+"""
+import ctypes
+import ctypes.util
+import os
+import platform
+import select
+import struct
+import threading
+import time
+
+from file_index import scan_tree
+
+DEFAULTS = {"debounce": 10, "max_delay": 300, "batch_size": 200, "poll_interval": 60}
+
+
+def continuous_settings(job_config):
+    """The job's continuous-mode settings, or None when it is off."""
+    value = job_config.get("continuous")
+    if not value:
+        return None
+    settings = dict(DEFAULTS)
+    if isinstance(value, dict):
+        if not value.get("enabled", True):
+            return None
+        settings.update({k: float(v) for k, v in value.items() if k in DEFAULTS})
+    settings["batch_size"] = max(1, int(settings["batch_size"]))
+    return settings
+
+
+# --- COLLECTOR ---
+class ChangeCollector:
+    """Debounces changed paths: {path: (first_seen, last_seen)}."""
+
+    def __init__(self, debounce, max_delay):
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self._lock = threading.Lock()
+        self._paths = {}
+        self._rescan = False
+
+    def add(self, path, now=None):
+        now = now or time.monotonic()
+        with self._lock:
+            first, _ = self._paths.get(path, (now, now))
+            self._paths[path] = (first, now)
+
+    def request_rescan(self):
+        with self._lock:
+            self._rescan = True
+
+    def _ready(self, now):
+        return [path for path, (first, last) in self._paths.items()
+                if now - last >= self.debounce or now - first >= self.max_delay]
+
+    def has_ready(self, now=None):
+        now = now or time.monotonic()
+        with self._lock:
+            return self._rescan or bool(self._ready(now))
+
+    def take(self, limit, now=None):
+        """Pops up to `limit` settled paths (oldest first). Returns (paths, rescan)."""
+        now = now or time.monotonic()
+        with self._lock:
+            rescan, self._rescan = self._rescan, False
+            ready = sorted(self._ready(now), key=lambda p: self._paths[p][0])[:limit]
+            for path in ready:
+                del self._paths[path]
+            return ready, rescan
+
+    def put_back(self, paths, rescan=False):
+        """Re-queues a batch whose push failed."""
+        now = time.monotonic()
+        with self._lock:
+            for path in paths:
+                self._paths.setdefault(path, (now, now))
+            self._rescan = self._rescan or rescan
+
+    @property
+    def pending(self):
+        with self._lock:
+            return len(self._paths)
+
+
+# --- WATCHERS ---
+class _Watcher:
+    kind = None
+
+    def __init__(self, root, collector):
+        self.root = os.path.abspath(root)
+        self.collector = collector
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _relative(self, path):
+        return os.path.relpath(path, self.root).replace(os.sep, "/")
+
+    def start(self):
+        self._open()
+        self._thread = threading.Thread(target=self._loop, name=f"watch-{self.kind}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._close()
+        if self._thread is not None:
+            self._thread.join(5)
+
+    def _open(self):
+        pass
+
+    def _close(self):
+        pass
+
+
+class InotifyWatcher(_Watcher):
+    kind = "inotify"
+    IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE = 0x2, 0x4, 0x8
+    IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x40, 0x80, 0x100, 0x200
+    IN_DELETE_SELF, IN_MOVE_SELF = 0x400, 0x800
+    IN_Q_OVERFLOW, IN_IGNORED, IN_ISDIR = 0x4000, 0x8000, 0x40000000
+    MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+            | IN_DELETE_SELF | IN_MOVE_SELF)
+    EVENT = struct.Struct("iIII")
+
+    def _open(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._dirs = {}
+        try:
+            self._watch_tree(self.root)
+        except OSError:
+            os.close(self._fd)
+            raise
+
+    def _watch_tree(self, top):
+        for dirpath, dirnames, _ in os.walk(top):
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(dirpath), self.MASK)
+            if wd < 0:
+                errno = ctypes.get_errno()
+                if dirpath == top and top == self.root:
+                    raise OSError(errno, f"inotify_add_watch failed for {dirpath} (fs.inotify.max_user_watches?)")
+                print(f"⚠️ Cannot watch {dirpath}: {os.strerror(errno)}")
+                continue
+            self._dirs[wd] = dirpath
+
+    def _close(self):
+        try:
+            os.close(self._fd)
+        except OSError:
+            pass
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                readable, _, _ = select.select([self._fd], [], [], 1.0)
+                if not readable:
+                    continue
+                data = os.read(self._fd, 64 * 1024)
+            except (OSError, ValueError):
+                if self._stop.is_set():
+                    return
+                self.collector.request_rescan()
+                time.sleep(1)
+                continue
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = self.EVENT.unpack_from(data, offset)
+                name = data[offset + self.EVENT.size:offset + self.EVENT.size + length].rstrip(b"\0")
+                offset += self.EVENT.size + length
+                self._handle(wd, mask, os.fsdecode(name))
+
+    def _handle(self, wd, mask, name):
+        if mask & self.IN_Q_OVERFLOW:
+            self.collector.request_rescan()
+            return
+        if mask & self.IN_IGNORED:
+            self._dirs.pop(wd, None)
+            return
+        directory = self._dirs.get(wd)
+        if directory is None or not name:
+            return
+        path = os.path.join(directory, name)
+        if mask & self.IN_ISDIR:
+            if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                self._watch_tree(path)
+                self.collector.add(self._relative(path)) # the push expands it to the files inside
+            elif mask & (self.IN_DELETE | self.IN_MOVED_FROM):
+                self.collector.add(self._relative(path)) # the push looks up the files it held
+            return
+        self.collector.add(self._relative(path))
+
+
+class WindowsWatcher(_Watcher):
+    kind = "windows"
+    FILE_LIST_DIRECTORY = 0x1
+    SHARE_ALL = 0x1 | 0x2 | 0x4
+    OPEN_EXISTING = 3
+    FILE_FLAG_BACKUP_SEMANTICS = 0x02000000
+    NOTIFY_FILTER = 0x1 | 0x2 | 0x8 | 0x10 | 0x40 # file name, dir name, size, last write, creation
+    BUFFER_SIZE = 256 * 1024
+
+    def _open(self):
+        from ctypes import wintypes
+        self._kernel32 = kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+        kernel32.CreateFileW.argtypes = [wintypes.LPCWSTR, wintypes.DWORD, wintypes.DWORD, ctypes.c_void_p,
+                                         wintypes.DWORD, wintypes.DWORD, wintypes.HANDLE]
+        kernel32.CreateFileW.restype = wintypes.HANDLE
+        kernel32.ReadDirectoryChangesW.argtypes = [wintypes.HANDLE, ctypes.c_void_p, wintypes.DWORD, wintypes.BOOL,
+                                                   wintypes.DWORD, ctypes.POINTER(wintypes.DWORD),
+                                                   ctypes.c_void_p, ctypes.c_void_p]
+        kernel32.ReadDirectoryChangesW.restype = wintypes.BOOL
+        kernel32.CancelIoEx.argtypes = [wintypes.HANDLE, ctypes.c_void_p]
+        kernel32.CloseHandle.argtypes = [wintypes.HANDLE]
+        self._handle = kernel32.CreateFileW(self.root, self.FILE_LIST_DIRECTORY, self.SHARE_ALL, None,
+                                            self.OPEN_EXISTING, self.FILE_FLAG_BACKUP_SEMANTICS, None)
+        if self._handle in (None, ctypes.c_void_p(-1).value):
+            raise ctypes.WinError(ctypes.get_last_error())
+        self._buffer = ctypes.create_string_buffer(self.BUFFER_SIZE)
+
+    def _close(self):
+        # Unblocks the pending ReadDirectoryChangesW in _loop.
+        self._kernel32.CancelIoEx(self._handle, None)
+        self._kernel32.CloseHandle(self._handle)
+
+    def _loop(self):
+        from ctypes import wintypes
+        returned = wintypes.DWORD()
+        while not self._stop.is_set():
+            ok = self._kernel32.ReadDirectoryChangesW(self._handle, self._buffer, self.BUFFER_SIZE, True,
+                                                      self.NOTIFY_FILTER, ctypes.byref(returned), None, None)
+            if self._stop.is_set():
+                return
+            if not ok:
+                self.collector.request_rescan()
+                time.sleep(5)
+                continue
+            if returned.value == 0: # buffer overflow: events were lost
+                self.collector.request_rescan()
+                continue
+            self._parse(self._buffer.raw[:returned.value])
+
+    def _parse(self, data):
+        offset = 0
+        while True:
+            next_offset, action, length = struct.unpack_from("III", data, offset)
+            name = data[offset + 12:offset + 12 + length].decode("utf-16-le")
+            if name:
+                # Directories are reported like files; the push expands them (new) or looks
+                # up what the file index had below them (removed).
+                self.collector.add(name.replace("\\", "/"))
+            if not next_offset:
+                break
+            offset += next_offset
+
+
+class PollingWatcher(_Watcher):
+    kind = "polling"
+
+    def __init__(self, root, collector, interval):
+        super().__init__(root, collector)
+        self.interval = interval
+        self._entries = None
+
+    def _open(self):
+        self._entries = scan_tree(self.root)
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            entries = scan_tree(self.root)
+            for path, meta in entries.items():
+                if self._entries.get(path) != meta:
+                    self.collector.add(path)
+            for path in self._entries:
+                if path not in entries:
+                    self.collector.add(path)
+            self._entries = entries
+
+
+def create_watcher(root, collector, poll_interval=DEFAULTS["poll_interval"]):
+    """Starts the best watcher available on this platform."""
+    system = platform.system()
+    candidates = []
+    if system == "Linux":
+        candidates.append(InotifyWatcher)
+    elif system == "Windows":
+        candidates.append(WindowsWatcher)
+    for cls in candidates:
+        watcher = cls(root, collector)
+        try:
+            watcher.start()
+            return watcher
+        except (OSError, AttributeError) as e:
+            print(f"⚠️ {cls.kind} watcher unavailable for {root} ({e}), polling instead")
+    watcher = PollingWatcher(root, collector, poll_interval)
+    watcher.start()
+    return watcher
+
+
+# --- MANAGER ---
+class ContinuousProtection:
+    """Keeps one watcher per continuous job in line with the job configuration."""
+
+    def __init__(self):
+        self._watches = {} # job_id -> (source_path, settings, collector, watcher)
+        self._failed = {} # job_id -> monotonic time of the last failed start
+        self.retry_after = 300
+
+    def refresh(self, jobs):
+        wanted = {}
+        for job_id, job_config in jobs.items():
+            settings = continuous_settings(job_config)
+            if settings and job_config.get("source_path") and job_config.get("engine", "rclone") == "rclone":
+                wanted[job_id] = (job_config["source_path"], settings)
+
+        for job_id in list(self._watches):
+            source_path, settings, _, watcher = self._watches[job_id]
+            if wanted.get(job_id) != (source_path, settings):
+                watcher.stop()
+                del self._watches[job_id]
+                print(f"👁️ Stopped watching {job_id}")
+
+        now = time.monotonic()
+        for job_id, (source_path, settings) in wanted.items():
+            if job_id in self._watches or now - self._failed.get(job_id, -self.retry_after) < self.retry_after:
+                continue
+            collector = ChangeCollector(settings["debounce"], settings["max_delay"])
+            try:
+                if not os.path.isdir(source_path):
+                    raise OSError(f"source not found: {source_path}")
+                watcher = create_watcher(source_path, collector, settings["poll_interval"])
+            except OSError as e:
+                print(f"⚠️ Continuous mode unavailable for {job_id}: {e}")
+                self._failed[job_id] = now
+                continue
+            self._failed.pop(job_id, None)
+            self._watches[job_id] = (source_path, settings, collector, watcher)
+            print(f"👁️ Watching {source_path} for {job_id} ({watcher.kind})")
+
+    def ready_jobs(self):
+        return [job_id for job_id, (_, _, collector, _) in self._watches.items() if collector.has_ready()]
+
+    def collector(self, job_id):
+        watch = self._watches.get(job_id)
+        return (watch[2], watch[1]) if watch else (None, None)
+
+    def status(self, job_id):
+        watch = self._watches.get(job_id)
+        return {"watcher": watch[3].kind, "pending": watch[2].pending} if watch else None
+
+    def stop(self):
+        for _, _, _, watcher in self._watches.values():
+            watcher.stop()
+        self._watches.clear()
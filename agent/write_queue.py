@@ -0,0 +1,358 @@
+"""
+Write-behind queue for every state, log and heartbeat write the agent makes.
+
+Callers never block on the network: update() / set() / push() / delete()
+record the write in memory and in a local journal, and a background thread
+sends everything pending as ONE multi-path update per flush. Repeated writes
+to the same node are merged before they are sent, so a job that updates its
+state ten times a second still costs one request per interval.
+
+If the link is down the queue keeps the writes (and the journal keeps them
+across restarts) and retries with backoff. Push ids are generated locally
+and journalled with the entry, so a replayed log entry lands under the same
+key instead of being duplicated.
+
+A write the database will never accept (a key containing . # $ [ ] or a
+control character, a rules denial, an unserialisable value) must not hold
+up everything merged with it. Invalid keys are caught when the write is
+recorded; when the server rejects a batch for good it is split in halves
+until the offending paths are isolated. Rejected writes are dropped from the
+queue, logged and appended to {journal}.rejected.
+"""
+import json
+import os
+import random
+import threading
+import time
+
+INVALID_KEY_CHARS = set(".#$[]/")
+SPECIAL_KEYS = (".sv", ".value", ".priority")
+# firebase_admin.exceptions.FirebaseError codes retrying cannot fix
+PERMANENT_CODES = ("INVALID_ARGUMENT", "PERMISSION_DENIED", "FAILED_PRECONDITION", "OUT_OF_RANGE")
+PUSH_CHARS = "-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz"
+
+_push_lock = threading.Lock()
+_last_push_ms = 0
+_last_rand = [0] * 12
+
+
+def generate_push_id():
+    """Chronologically sortable id, same format as Firebase push()."""
+    global _last_push_ms
+    with _push_lock:
+        now = int(time.time() * 1000)
+        duplicate = now == _last_push_ms
+        _last_push_ms = now
+        ts_chars = []
+        for _ in range(8):
+            ts_chars.append(PUSH_CHARS[now % 64])
+            now //= 64
+        if not duplicate:
+            for i in range(12):
+                _last_rand[i] = random.randrange(64)
+        else:
+            i = 11
+            while i >= 0 and _last_rand[i] == 63:
+                _last_rand[i] = 0
+                i -= 1
+            if i >= 0:
+                _last_rand[i] += 1
+        return "".join(reversed(ts_chars)) + "".join(PUSH_CHARS[r] for r in _last_rand)
+
+
+def _norm(path):
+    return "/".join(p for p in str(path).split("/") if p)
+
+
+def _bad_key(key):
+    key = str(key)
+    if key in SPECIAL_KEYS:
+        return False
+    return not key or any(c in INVALID_KEY_CHARS or ord(c) < 32 or ord(c) == 127 for c in key)
+
+
+def invalid_key(path, value):
+    """The first key in path or value RTDB would refuse, or None."""
+    for part in _norm(path).split("/"):
+        if part and _bad_key(part):
+            return part
+    stack = [value]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, dict):
+            for key, child in node.items():
+                if _bad_key(key):
+                    return key
+                stack.append(child)
+        elif isinstance(node, list):
+            stack.extend(node)
+    return None
+
+
+def is_permanent(error):
+    """True for errors resending the same batch cannot fix."""
+    if isinstance(error, (ValueError, TypeError)) and not isinstance(error, json.JSONDecodeError):
+        return True # refused before it left the client
+    if getattr(error, "code", None) in PERMANENT_CODES:
+        return True
+    status = getattr(getattr(error, "http_response", None), "status_code", None)
+    return status in (400, 403, 413)
+
+
+def _merge_into(pending, path, value):
+    """
+    Adds path=value to a multi-path update while keeping it valid: RTDB
+    rejects an update where one key is an ancestor of another, so writes
+    below a pending key are folded into that key's value, and a write above
+    pending keys replaces them.
+    """
+    path = _norm(path)
+    for key in list(pending):
+        if path.startswith(key + "/"):
+            rel = path[len(key) + 1:].split("/")
+            node = pending[key] if isinstance(pending[key], dict) else {}
+            pending[key] = node
+            for part in rel[:-1]:
+                child = node.get(part)
+                if not isinstance(child, dict):
+                    child = node[part] = {}
+                node = child
+            node[rel[-1]] = value
+            return
+    for key in list(pending):
+        if key.startswith(path + "/"):
+            del pending[key]
+    pending.pop(path, None) # re-insert so ordering reflects the latest write
+    pending[path] = value
+
+
+class QueuedReference:
+    def __init__(self, queue, path):
+        self._queue = queue
+        self.path = _norm(path)
+
+    def update(self, values):
+        self._queue.update(self.path, values)
+
+    def set(self, value):
+        self._queue.set(self.path, value)
+
+    def delete(self):
+        self._queue.delete(self.path)
+
+    def push(self, value):
+        return self._queue.push(self.path, value)
+
+
+class WriteBehindQueue:
+    def __init__(self, send, journal_path, flush_interval=1.0, max_backoff=60, on_rejected=None):
+        """
+        send(dict) performs one multi-path update at the database root.
+        on_rejected(path, reason) is called for every write dropped as undeliverable.
+        """
+        self._send = send
+        self.on_rejected = on_rejected
+        self.journal_path = journal_path
+        self.flush_interval = flush_interval
+        self.max_backoff = max_backoff
+        self._pending = {}
+        self._in_flight = False
+        self._lock = threading.Condition()
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread = None
+        self._journal = None
+        self.failures = 0
+        self.rejected = 0
+        self._replay()
+
+    # --- public API ---
+    def update(self, path, values):
+        for key, value in values.items():
+            self._record(f"{_norm(path)}/{_norm(key)}", value)
+
+    def set(self, path, value):
+        self._record(path, value)
+
+    def delete(self, path):
+        self._record(path, None)
+
+    def push(self, path, value):
+        key = generate_push_id()
+        self._record(f"{_norm(path)}/{key}", value)
+        return key
+
+    def reference(self, path):
+        """db.reference()-style handle whose writes go through the queue."""
+        return QueuedReference(self, path)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=10):
+        self.flush(timeout)
+        self._stop.set()
+        self._wake.set()
+
+    def discard(self):
+        """Stops sending and forgets everything still queued (used on decommission)."""
+        self._stop.set()
+        self._wake.set()
+        with self._lock:
+            self._pending = {}
+            self._rewrite_journal()
+
+    def flush(self, timeout=None):
+        """Asks for an immediate send and waits until the queue drains. Returns True if it did."""
+        self._wake.set()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            while self._pending or self._in_flight:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._lock.wait(remaining)
+        return True
+
+    @property
+    def idle(self):
+        with self._lock:
+            return not self._pending and not self._in_flight
+
+    @property
+    def backlog(self):
+        with self._lock:
+            return len(self._pending)
+
+    # --- journal ---
+    def _record(self, path, value):
+        bad = invalid_key(path, value)
+        if bad is not None:
+            self._reject({_norm(path): value}, f"invalid key {bad!r}")
+            return
+        with self._lock:
+            _merge_into(self._pending, path, value)
+            self._append_journal(path, value)
+        self._wake.set()
+
+    def _append_journal(self, path, value):
+        try:
+            if self._journal is None:
+                self._journal = open(self.journal_path, "a", encoding="utf-8")
+            self._journal.write(json.dumps({"p": _norm(path), "v": value}) + "\n")
+            self._journal.flush()
+        except Exception as e:
+            print(f"⚠️ Write journal unavailable: {e}")
+
+    def _rewrite_journal(self):
+        """Called with the lock held: the journal becomes exactly what is still pending."""
+        try:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+            tmp = self.journal_path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                for path, value in self._pending.items():
+                    f.write(json.dumps({"p": path, "v": value}) + "\n")
+            os.replace(tmp, self.journal_path)
+        except Exception as e:
+            print(f"⚠️ Write journal unavailable: {e}")
+
+    def _replay(self):
+        if not os.path.exists(self.journal_path):
+            return
+        replayed = 0
+        with open(self.journal_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue # torn last line after a crash
+                bad = invalid_key(entry["p"], entry["v"])
+                if bad is not None:
+                    self._reject({entry["p"]: entry["v"]}, f"invalid key {bad!r}")
+                    continue
+                _merge_into(self._pending, entry["p"], entry["v"])
+                replayed += 1
+        if replayed:
+            print(f"📼 Replaying {len(self._pending)} queued writes from journal")
+
+    def _reject(self, writes, reason):
+        self.rejected += len(writes)
+        try:
+            with open(self.journal_path + ".rejected", "a", encoding="utf-8") as f:
+                for path, value in writes.items():
+                    f.write(json.dumps({"p": path, "v": value, "reason": reason}, default=str) + "\n")
+        except Exception as e:
+            print(f"⚠️ Write journal unavailable: {e}")
+        for path in writes:
+            print(f"🚫 Dropped write to {path}: {reason}")
+            if self.on_rejected:
+                try:
+                    self.on_rejected(path, reason)
+                except Exception:
+                    pass
+
+    def _deliver(self, batch):
+        """
+        Sends a batch. Parts the server refuses for good are split until the
+        offending paths are isolated and rejected. Returns (unsent, error):
+        the writes still to retry after a transient failure.
+        """
+        parts = [batch]
+        while parts:
+            part = parts.pop(0)
+            try:
+                self._send(part)
+            except Exception as e:
+                if not is_permanent(e):
+                    unsent = {}
+                    for rest in [part] + parts:
+                        unsent.update(rest)
+                    return unsent, e
+                if len(part) == 1:
+                    self._reject(part, str(e))
+                    continue
+                items = list(part.items())
+                half = len(items) // 2
+                parts[:0] = [dict(items[:half]), dict(items[half:])]
+        return {}, None
+
+    # --- sender ---
+    def _run(self):
+        backoff = 0
+        while not self._stop.is_set():
+            self._wake.wait(backoff or self.flush_interval)
+            self._wake.clear()
+            # Let bursts coalesce for a moment before sending.
+            if not backoff:
+                time.sleep(min(self.flush_interval, 0.2))
+
+            with self._lock:
+                if not self._pending:
+                    continue
+                batch, self._pending = self._pending, {}
+                self._in_flight = True
+            try:
+                unsent, error = self._deliver(batch)
+            except Exception as e:
+                unsent, error = batch, e
+            sent = not unsent
+            if not sent:
+                self.failures += 1
+                print(f"📴 Deferred {len(unsent)} writes ({error})")
+
+            with self._lock:
+                self._in_flight = False
+                if not sent:
+                    # Newer writes made while we were sending win over the failed batch.
+                    retry = {}
+                    for path, value in unsent.items():
+                        _merge_into(retry, path, value)
+                    for path, value in self._pending.items():
+                        _merge_into(retry, path, value)
+                    self._pending = retry
+                self._rewrite_journal()
+                self._lock.notify_all()
+            backoff = 0 if sent else min(self.max_backoff, (backoff * 2) or 1)